@@ -0,0 +1,211 @@
+"""
+Benchmark of the endpoint types with the same payload set.
+For every endpoint type of configs/benchmark_config.json, the endpoint of inference_config.json is
+invoked with the records of a jsonl manifest (same format as invoke_endpoint.py --manifest) and the
+report compares:
+    - cold start : latency of the first request compared with the warm p50
+    - p50/p99 latency and throughput at a fixed concurrency
+    - estimated cost per 1k inferences, from the instance type/count or serverless memory size of
+      endpoint_config.json and the prices of benchmark_config.json
+
+Instance based endpoints (real-time, multi-model, async) are costed at the measured throughput, i.e.
+fully utilised instances. Serverless endpoints are costed per GB-second of the measured latency and
+per GB of request and response data. Async completions are observed once per poll interval (from
+the SNS notifications, or by listing the outputs and checking the last ones with HEAD requests), so
+async latency is rounded up to the poll interval.
+
+For development, point endpoint_url of endpoint_overrides at inference/async_server.py, which serves
+the sagemaker-runtime API (and InvokeEndpointAsync when ASYNC_OUTPUT_PATH is set).
+
+usage:
+    python benchmark_endpoints.py --cfg configs/benchmark_config.json --manifest payloads.jsonl --output benchmark_report.json
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import threading
+from itertools import cycle, islice
+
+from invoke_endpoint import (
+    AsyncSubmitter,
+    get_record_invoke_args,
+    get_runtime_client,
+    read_manifest,
+)
+
+SYNC_ENDPOINT_TYPES = ["real-time-endpoint", "multi-model-endpoint", "serverless-endpoint"]
+ASYNC_ENDPOINT_TYPES = ["async-endpoint"]
+
+
+def get_percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {
+        "p50": round(values[int(len(values) * 0.50)], 2),
+        "p99": round(values[min(len(values) - 1, int(len(values) * 0.99))], 2),
+        "mean": round(sum(values) / len(values), 2),
+    }
+
+
+def run_sync_benchmark(inference_config, records, num_requests, concurrency):
+    """Cold request followed by num_requests requests from concurrency clients"""
+    client = get_runtime_client(inference_config, max_pool_connections=concurrency)
+    invoke_args_list = [get_record_invoke_args(inference_config, record) for _, record in records]
+
+    def invoke(invoke_args):
+        start_time = time.perf_counter()
+        response = client.invoke_endpoint(**invoke_args)
+        response_bytes = len(response["Body"].read())
+        return (time.perf_counter() - start_time) * 1000, len(invoke_args["Body"]) + response_bytes
+
+    first_request_ms, _ = invoke(invoke_args_list[0])
+
+    requests = iter(islice(cycle(invoke_args_list), num_requests))
+    requests_lock = threading.Lock()
+    latencies, data_bytes, errors = [], [0], [0]
+
+    def run_client():
+        while True:
+            with requests_lock:
+                invoke_args = next(requests, None)
+            if invoke_args is None:
+                return
+            try:
+                latency_ms, request_bytes = invoke(invoke_args)
+            except Exception:
+                with requests_lock:
+                    errors[0] += 1
+                continue
+            with requests_lock:
+                latencies.append(latency_ms)
+                data_bytes[0] += request_bytes
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=run_client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+    return {
+        "first_request_ms": round(first_request_ms, 2),
+        "requests": len(latencies) + errors[0],
+        "errors": errors[0],
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": get_percentiles(latencies),
+        "mean_data_bytes": data_bytes[0] / max(1, len(latencies)),
+    }
+
+
+def run_async_benchmark(inference_config, records, num_requests):
+    """Single cold submission followed by num_requests submissions through AsyncSubmitter"""
+    def submit(manifest_records):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir, "manifest.jsonl")
+            output_path = os.path.join(tmp_dir, "results.jsonl")
+            with open(manifest_path, "w") as f:
+                for index, (_, record) in enumerate(manifest_records):
+                    f.write(json.dumps(dict(record, id=index)) + "\n")
+            start_time = time.perf_counter()
+            AsyncSubmitter(inference_config).run(manifest_path, output_path)
+            elapsed = time.perf_counter() - start_time
+            results = [json.loads(line) for line in open(output_path)]
+        return results, elapsed
+
+    cold_results, _ = submit(records[:1])
+    results, elapsed = submit(list(islice(cycle(records), num_requests)))
+    latencies = [result["latency_ms"] for result in results if result.get("status") == "ok"]
+    return {
+        "first_request_ms": cold_results[0].get("latency_ms"),
+        "requests": len(results),
+        "errors": len(results) - len(latencies),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "latency_ms": get_percentiles(latencies),
+    }
+
+
+def estimate_cost_per_1k(endpoint_type, endpoint_config, report, pricing):
+    """Estimated cost of 1000 inferences in the currency of the pricing table, None when unknown"""
+    if endpoint_type == "serverless-endpoint":
+        memory_gb = endpoint_config.get("memory_size", 2048) / 1024
+        mean_seconds = report["latency_ms"].get("mean", 0) / 1000
+        compute_cost = mean_seconds * memory_gb * pricing.get("serverless_price_per_gb_second", 0)
+        data_cost = report.get("mean_data_bytes", 0) / 1024 ** 3 * pricing.get("serverless_price_per_gb_processed", 0)
+        return round((compute_cost + data_cost) * 1000, 6)
+    price_per_hour = pricing.get("instance_price_per_hour", {}).get(endpoint_config.get("instance_type"))
+    if price_per_hour is None or not report["throughput_rps"]:
+        return None
+    fleet_price_per_second = price_per_hour * endpoint_config.get("instance_count", 1) / 3600
+    return round(fleet_price_per_second / report["throughput_rps"] * 1000, 6)
+
+
+def print_report(reports):
+    columns = ["endpoint_type", "first_ms", "cold_ms", "p50_ms", "p99_ms", "rps", "errors", "cost_per_1k"]
+    print(" ".join(f"{column:>20}" for column in columns))
+    for report in reports:
+        row = [
+            report["endpoint_type"], report["first_request_ms"], report["cold_start_ms"],
+            report["latency_ms"].get("p50"), report["latency_ms"].get("p99"), report["throughput_rps"],
+            report["errors"], report["cost_per_1k"],
+        ]
+        print(" ".join(f"{str(value):>20}" for value in row))
+
+
+def run_benchmark(benchmark_config, manifest_path):
+    endpoint_configs = json.load(open(benchmark_config.get("endpoint_config_path")))
+    inference_configs = json.load(open(benchmark_config.get("inference_config_path")))
+    records = list(read_manifest(manifest_path))
+    assert len(records) > 0, f"{manifest_path} has no records"
+
+    reports = []
+    for endpoint_type in benchmark_config.get("endpoint_types"):
+        inference_config = dict(
+            inference_configs.get(endpoint_type), **benchmark_config.get("endpoint_overrides", {}).get(endpoint_type, {})
+        )
+        endpoint_config = endpoint_configs.get(endpoint_type)
+        print(f"Benchmarking {endpoint_type} : {inference_config.get('endpoint_name')}")
+        if endpoint_type in ASYNC_ENDPOINT_TYPES:
+            report = run_async_benchmark(inference_config, records, benchmark_config.get("requests"))
+        else:
+            assert endpoint_type in SYNC_ENDPOINT_TYPES, f"{endpoint_type} not supported"
+            report = run_sync_benchmark(
+                inference_config, records, benchmark_config.get("requests"), benchmark_config.get("concurrency")
+            )
+        report["endpoint_type"] = endpoint_type
+        report["endpoint_name"] = inference_config.get("endpoint_name")
+        if endpoint_type != "serverless-endpoint":
+            report["instance_type"] = endpoint_config.get("instance_type")
+            report["instance_count"] = endpoint_config.get("instance_count", 1)
+        report["cold_start_ms"] = None
+        if report["first_request_ms"] is not None and report["latency_ms"]:
+            report["cold_start_ms"] = round(max(0, report["first_request_ms"] - report["latency_ms"]["p50"]), 2)
+        report["cost_per_1k"] = estimate_cost_per_1k(
+            endpoint_type, endpoint_config, report, benchmark_config.get("pricing", {})
+        )
+        print(f"Report={json.dumps(report)}")
+        reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cfg", type=str, default="configs/benchmark_config.json", help="benchmark configuration file path")
+    parser.add_argument("--manifest", type=str, required=True, help="jsonl file of payloads sent to every endpoint")
+    parser.add_argument("--endpoint-types", type=str, default=None, help="comma separated subset of endpoint_types")
+    parser.add_argument("--output", type=str, default=None, help="json file the comparison report is written to")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.cfg), f"{args.cfg} does not exist"
+    benchmark_config = json.load(open(args.cfg))
+    if args.endpoint_types:
+        benchmark_config["endpoint_types"] = args.endpoint_types.split(",")
+
+    reports = run_benchmark(benchmark_config, args.manifest)
+    print_report(reports)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"benchmark_config": benchmark_config, "reports": reports}, f, indent=4)
+        print(f"Report written to {args.output}")
@@ -0,0 +1,334 @@
+"""
+Lightweight serving mode without the Java model server.
+Serves the SageMaker container contract (GET /ping, POST /invocations on port 8080) from a single
+python process with asyncio, calling the same model_handler.handle as MMS. GET /metrics returns the
+latency metrics of the handler. POST /endpoints/<endpoint_name>/invocations is served as well, so the
+server stands in for the sagemaker-runtime API when clients set endpoint_url to it. When ASYNC_OUTPUT_PATH
+is set, POST /endpoints/<endpoint_name>/async-invocations stands in for InvokeEndpointAsync : the input
+is read from its s3 InputLocation and the output is written under ASYNC_OUTPUT_PATH in the background.
+
+For MultiModel endpoints (SAGEMAKER_MULTI_MODEL=true) the server implements the multi-model container
+API that SageMaker calls to manage the target models : POST /models loads {"model_name", "url"},
+GET /models lists them, GET /models/<model_name> describes one, POST /models/<model_name>/invoke runs
+an invocation and DELETE /models/<model_name> unloads it. Models are kept by model_handler's ModelRegistry,
+so with MODEL_CACHE_MEMORY_MB the least recently used models are evicted and reloaded on their next invocation.
+
+Environment variables:
+    SAGEMAKER_BIND_TO_PORT : port to listen on (default 8080)
+    SERVER_MAX_CONCURRENCY : invocations executed at the same time, others wait (default 4)
+    SERVER_MAX_BODY_BYTES : largest accepted request body (default 6MB, the SageMaker limit)
+    SERVER_SHUTDOWN_TIMEOUT : seconds to wait for in-flight invocations on SIGTERM (default 30)
+    SERVER_KEEP_ALIVE_TIMEOUT : seconds an idle connection is kept open (default 60)
+    ASYNC_OUTPUT_PATH : s3://bucket/prefix of async invocation outputs (async invocations disabled when unset)
+    ASYNC_FAILURE_PATH : s3://bucket/prefix of async invocation errors (default ASYNC_OUTPUT_PATH)
+    SAGEMAKER_MULTI_MODEL : true to serve the multi-model API instead of loading SAGEMAKER_MODEL_DIR at startup
+"""
+import os
+import json
+import uuid
+import signal
+import asyncio
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+import model_handler
+
+MODEL_DIR = os.environ.get('SAGEMAKER_MODEL_DIR', '/opt/ml/model')
+PORT = int(os.environ.get('SAGEMAKER_BIND_TO_PORT', 8080))
+MAX_CONCURRENCY = int(os.environ.get('SERVER_MAX_CONCURRENCY', 4))
+MAX_BODY_BYTES = int(os.environ.get('SERVER_MAX_BODY_BYTES', 6 * 1024 * 1024))
+SHUTDOWN_TIMEOUT = float(os.environ.get('SERVER_SHUTDOWN_TIMEOUT', 30))
+KEEP_ALIVE_TIMEOUT = float(os.environ.get('SERVER_KEEP_ALIVE_TIMEOUT', 60))
+ASYNC_OUTPUT_PATH = os.environ.get('ASYNC_OUTPUT_PATH')
+ASYNC_FAILURE_PATH = os.environ.get('ASYNC_FAILURE_PATH', ASYNC_OUTPUT_PATH)
+MULTI_MODEL = os.environ.get('SAGEMAKER_MULTI_MODEL', 'false').lower() == 'true'
+
+STATUS_REASONS = {
+    200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 411: 'Length Required',
+    413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable', 507: 'Insufficient Storage'
+}
+
+
+def is_runtime_invocation(path, operation='invocations'):
+    """
+    True for the sagemaker-runtime paths /endpoints/<endpoint_name>/invocations (InvokeEndpoint)
+    and /endpoints/<endpoint_name>/async-invocations (InvokeEndpointAsync)
+    """
+    parts = path.strip('/').split('/')
+    return len(parts) == 3 and parts[0] == 'endpoints' and parts[2] == operation
+
+
+def parse_models_path(path):
+    """
+    Returns (model_name, operation) of the multi-model paths /models, /models/<model_name> and
+    /models/<model_name>/invoke, model_name and operation are None when absent. None for other paths
+    """
+    parts = path.strip('/').split('/')
+    if parts[0] != 'models' or len(parts) > 3:
+        return None
+    model_name = urllib.parse.unquote(parts[1]) if len(parts) > 1 else None
+    operation = parts[2] if len(parts) > 2 else None
+    return model_name, operation
+
+
+def read_s3_object(s3_uri):
+    s3_url = urllib.parse.urlparse(s3_uri)
+    s3_client = model_handler.get_s3_client(model_handler.DEFAULT_HANDLER_CONFIG)
+    return s3_client.get_object(Bucket=s3_url.netloc, Key=s3_url.path[1:])['Body'].read()
+
+
+def write_s3_object(s3_uri, body, content_type):
+    s3_url = urllib.parse.urlparse(s3_uri)
+    s3_client = model_handler.get_s3_client(model_handler.DEFAULT_HANDLER_CONFIG)
+    s3_client.put_object(Bucket=s3_url.netloc, Key=s3_url.path[1:], Body=body, ContentType=content_type)
+
+
+class RequestContext(object):
+    """
+    Minimal stand-in of the MMS Context used by model_handler.handle for a single request
+    """
+    def __init__(self, headers, model_dir=MODEL_DIR, gpu_id=None):
+        self.system_properties = {"model_dir": model_dir, "gpu_id": gpu_id}
+        self.headers = headers
+        self.response_content_type = 'application/json'
+
+    def get_request_header(self, request_index, header_name):
+        return self.headers.get(header_name.lower())
+
+    def set_response_content_type(self, request_index, content_type):
+        self.response_content_type = content_type
+
+
+class InferenceServer(object):
+    def __init__(self, max_concurrency=MAX_CONCURRENCY):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='invocation')
+        self.ready = False
+        self.in_flight = 0
+        self.server = None
+        self.async_tasks = set()
+        # Target models of the multi-model API, model name to model directory
+        self.models = {}
+
+    async def load_model(self):
+        """Loads the model before the first invocation, /ping reports healthy only afterwards"""
+        if MULTI_MODEL:
+            # SageMaker loads the target models through POST /models
+            self.ready = True
+            logger.info(f"Serving the multi-model API on port {PORT}")
+            return
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, model_handler.handle, None, RequestContext({}))
+        self.ready = True
+        logger.info(f"Model Loaded, serving on port {PORT}")
+
+    async def read_request(self, reader):
+        """Returns (method, path, headers, body) or None when the client closed the connection"""
+        try:
+            header_bytes = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        lines = header_bytes.decode('latin-1').split('\r\n')
+        method, path, _ = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        body = b''
+        if method == 'POST':
+            if 'content-length' not in headers:
+                return method, path, headers, 411
+            content_length = int(headers['content-length'])
+            if content_length > MAX_BODY_BYTES:
+                return method, path, headers, 413
+            body = await reader.readexactly(content_length)
+        return method, path.split('?')[0], headers, body
+
+    async def write_response(self, writer, status, body, content_type='application/json', keep_alive=True, headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        elif isinstance(body, str):
+            body = body.encode('utf-8')
+        header_lines = [
+            f"HTTP/1.1 {status} {STATUS_REASONS.get(status, '')}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ] + [f"{name}: {value}" for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(header_lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    async def invoke(self, headers, body, model_dir=MODEL_DIR):
+        """Runs model_handler.handle on the thread pool, at most MAX_CONCURRENCY at a time"""
+        context = RequestContext(headers, model_dir=model_dir)
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                outputs = await loop.run_in_executor(
+                    self.executor, model_handler.handle, [{'body': body}], context
+                )
+            finally:
+                self.in_flight -= 1
+        return outputs[0], context.response_content_type
+
+    async def handle_models_request(self, method, model_name, operation, headers, body):
+        """
+        Serves the multi-model API, returns (status, response body, content type).
+        Target models are loaded through ModelRegistry, which may evict and reload them under its memory budget
+        """
+        loop = asyncio.get_running_loop()
+        if model_name is None and method == 'GET':
+            models = [{"modelName": name, "modelUrl": url} for name, url in self.models.items()]
+            return 200, {"models": models}, 'application/json'
+
+        if model_name is None and method == 'POST':
+            try:
+                request = json.loads(body)
+                model_name, model_dir = request['model_name'], request['url']
+            except (ValueError, KeyError, TypeError) as e:
+                return 400, {"error": f"Invalid load request : {e}"}, 'application/json'
+            if model_name in self.models:
+                return 409, {"error": f"Model {model_name} is already loaded"}, 'application/json'
+            try:
+                await loop.run_in_executor(
+                    self.executor, model_handler.handle, None, RequestContext({}, model_dir=model_dir)
+                )
+            except MemoryError as e:
+                return 507, {"error": f"Not enough memory to load {model_name} : {e}"}, 'application/json'
+            except Exception as e:
+                logger.exception(f"Model Load Failed : {e}")
+                return 500, {"error": str(e)}, 'application/json'
+            self.models[model_name] = model_dir
+            logger.info(f"Target Model Loaded : {model_name} from {model_dir}")
+            return 200, {"status": f"Model {model_name} loaded"}, 'application/json'
+
+        if model_name not in self.models:
+            return 404, {"error": f"Model {model_name} is not loaded"}, 'application/json'
+        model_dir = self.models[model_name]
+
+        if method == 'GET' and operation is None:
+            return 200, {"modelName": model_name, "modelUrl": model_dir}, 'application/json'
+        if method == 'DELETE' and operation is None:
+            # Requests in flight keep their lease, the model is unloaded once they are done
+            del self.models[model_name]
+            await loop.run_in_executor(self.executor, model_handler.unload_model, model_dir)
+            logger.info(f"Target Model Unloaded : {model_name}")
+            return 200, {"status": f"Model {model_name} unloaded"}, 'application/json'
+        if method == 'POST' and operation == 'invoke':
+            try:
+                output, content_type = await self.invoke(headers, body, model_dir=model_dir)
+                return 200, output, content_type
+            except Exception as e:
+                logger.exception(f"Invocation Failed : {e}")
+                return 500, {"error": str(e)}, 'application/json'
+        return 404, {"error": f"{method} /models/{model_name}/{operation or ''} not found"}, 'application/json'
+
+    def submit_async_invocation(self, headers):
+        """
+        Queues an async invocation and returns (response body, response headers) right away,
+        the output or error is written to s3 once the invocation has run
+        """
+        name = uuid.uuid4().hex
+        output_location = f"{ASYNC_OUTPUT_PATH.rstrip('/')}/{name}.out"
+        failure_location = f"{ASYNC_FAILURE_PATH.rstrip('/')}/{name}-error.out"
+        # InvokeEndpointAsync sends the input content type and accept as X-Amzn-SageMaker-* headers
+        invoke_headers = {
+            'content-type': headers.get('x-amzn-sagemaker-content-type', 'application/json'),
+            'accept': headers.get('x-amzn-sagemaker-accept', ''),
+            'x-amzn-sagemaker-custom-attributes': headers.get('x-amzn-sagemaker-custom-attributes'),
+        }
+        task = asyncio.create_task(self.run_async_invocation(
+            headers.get('x-amzn-sagemaker-inputlocation'), invoke_headers, output_location, failure_location
+        ))
+        self.async_tasks.add(task)
+        task.add_done_callback(self.async_tasks.discard)
+        inference_id = headers.get('x-amzn-sagemaker-inference-id') or name
+        response_headers = {
+            'X-Amzn-SageMaker-OutputLocation': output_location,
+            'X-Amzn-SageMaker-FailureLocation': failure_location,
+        }
+        return {"InferenceId": inference_id}, response_headers
+
+    async def run_async_invocation(self, input_location, headers, output_location, failure_location):
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(self.executor, read_s3_object, input_location)
+            output, content_type = await self.invoke(headers, body)
+            if isinstance(output, (dict, list)):
+                output = json.dumps(output).encode('utf-8')
+            await loop.run_in_executor(self.executor, write_s3_object, output_location, output, content_type)
+        except Exception as e:
+            logger.exception(f"Async Invocation Failed : {e}")
+            await loop.run_in_executor(self.executor, write_s3_object, failure_location, str(e).encode('utf-8'), 'text/plain')
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request = await self.read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if isinstance(body, int):
+                    await self.write_response(writer, body, {"error": STATUS_REASONS[body]}, keep_alive=False)
+                    break
+
+                if method == 'GET' and path == '/ping':
+                    status = 200 if self.ready else 503
+                    await self.write_response(writer, status, b'', keep_alive=keep_alive)
+                elif method == 'GET' and path == '/metrics':
+                    await self.write_response(writer, 200, model_handler.get_metrics(), keep_alive=keep_alive)
+                elif method == 'POST' and (path == '/invocations' or is_runtime_invocation(path)):
+                    try:
+                        output, content_type = await self.invoke(headers, body)
+                        await self.write_response(writer, 200, output, content_type, keep_alive=keep_alive)
+                    except Exception as e:
+                        logger.exception(f"Invocation Failed : {e}")
+                        await self.write_response(writer, 500, {"error": str(e)}, keep_alive=keep_alive)
+                elif method == 'POST' and ASYNC_OUTPUT_PATH and is_runtime_invocation(path, 'async-invocations'):
+                    response, response_headers = self.submit_async_invocation(headers)
+                    await self.write_response(writer, 202, response, keep_alive=keep_alive, headers=response_headers)
+                elif MULTI_MODEL and parse_models_path(path) is not None:
+                    model_name, operation = parse_models_path(path)
+                    status, output, content_type = await self.handle_models_request(
+                        method, model_name, operation, headers, body
+                    )
+                    await self.write_response(writer, status, output, content_type, keep_alive=keep_alive)
+                else:
+                    await self.write_response(writer, 404, {"error": f"{method} {path} not found"}, keep_alive=keep_alive)
+
+                if not keep_alive:
+                    break
+        except Exception as e:
+            logger.error(f"Connection Error : {e}")
+        finally:
+            writer.close()
+
+    async def shutdown(self):
+        """Stops accepting connections and waits for in-flight invocations to finish"""
+        logger.info(f"Shutting down, {self.in_flight} invocations in flight")
+        self.ready = False
+        self.server.close()
+        deadline = asyncio.get_running_loop().time() + SHUTDOWN_TIMEOUT
+        while self.in_flight > 0 and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.1)
+        self.executor.shutdown(wait=False)
+        logger.info(f"Shutdown complete, {self.in_flight} invocations abandoned")
+
+    async def serve(self):
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signal_number in [signal.SIGTERM, signal.SIGINT]:
+            loop.add_signal_handler(signal_number, stop_event.set)
+
+        self.server = await asyncio.start_server(self.handle_connection, host='0.0.0.0', port=PORT)
+        await self.load_model()
+        await stop_event.wait()
+        await self.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(InferenceServer().serve())
@@ -0,0 +1,360 @@
+"""
+Offline batch inference over an s3 prefix without an endpoint.
+The images under --input are listed once with paginated list_objects_v2 (or read from the source-refs
+of a Ground Truth --manifest) and the key list is saved next to the outputs (_keys.txt, with the bucket
+in _input.json), then split into shards of --shard-size images. Shards run on a pool of worker
+processes sized to the cpu cores, each worker loads the model with ModelHandler.load (so model.json,
+handler_config and the inference artifact are honoured), prefetches the images of its shard
+concurrently and predicts them --batch-size at a time. Results are formatted with
+ModelHandler.format_output and written as one jsonl or parquet file per shard, with the decoded
+image_size of every image so that normalized boxes can be converted back to pixels.
+
+A shard file only appears once the shard is complete, so a crashed or interrupted job is resumed by
+running the same command again : the saved key list is reused and completed shards are skipped.
+
+usage:
+    cd inference
+    python batch_transform.py --model-dir /opt/ml/model --input s3://bucket/images/ \
+        --output s3://bucket/predictions/run-1/ --shard-size 1000 --batch-size 16 --conf 0.25
+    python batch_transform.py --model-dir /opt/ml/model --manifest s3://bucket/manifests/job.manifest \
+        --output s3://bucket/predictions/run-2/
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import urllib.parse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from loguru import logger
+
+import model_handler
+
+KEYS_FILE = '_keys.txt'
+INPUT_FILE = '_input.json'
+SUCCESS_FILE = '_SUCCESS'
+OUTPUT_TYPES = ['jsonl', 'parquet']
+
+
+def parse_s3_uri(s3_uri):
+    """Returns (bucket, key) of s3://bucket/key"""
+    s3_url = urllib.parse.urlparse(s3_uri)
+    return s3_url.netloc, s3_url.path[1:]
+
+
+class OutputStore(object):
+    """Output location of the job, a local directory or an s3 prefix"""
+    def __init__(self, output_uri, s3_client=None):
+        self.is_s3 = output_uri.startswith('s3://')
+        self.s3_client = s3_client
+        if self.is_s3:
+            self.bucket_name, self.prefix = parse_s3_uri(output_uri)
+            self.prefix = self.prefix.rstrip('/') + '/' if self.prefix else ''
+        else:
+            self.output_dir = output_uri
+            os.makedirs(output_uri, exist_ok=True)
+
+    def list_names(self):
+        if not self.is_s3:
+            return set(os.listdir(self.output_dir))
+        names = set()
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=self.prefix):
+            names.update(s3_object['Key'][len(self.prefix):] for s3_object in page.get('Contents', []))
+        return names
+
+    def put_file(self, local_path, name):
+        """Publishes a finished file under name, atomically for local outputs"""
+        if self.is_s3:
+            self.s3_client.upload_file(local_path, self.bucket_name, self.prefix + name)
+            os.remove(local_path)
+        else:
+            shutil.move(local_path, os.path.join(self.output_dir, name))
+
+    def read_text(self, name):
+        if self.is_s3:
+            return self.s3_client.get_object(Bucket=self.bucket_name, Key=self.prefix + name)['Body'].read().decode('utf-8')
+        with open(os.path.join(self.output_dir, name)) as f:
+            return f.read()
+
+    def write_text(self, name, text):
+        with tempfile.NamedTemporaryFile('w', delete=False, suffix='.tmp', dir=None if self.is_s3 else self.output_dir) as f:
+            f.write(text)
+        self.put_file(f.name, name)
+
+
+def list_image_keys(s3_client, bucket_name, prefix):
+    """Keys of the images under prefix in key order, extensions are matched case insensitively"""
+    keys = []
+    start_time = time.perf_counter()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000}):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Key'].split('.')[-1].lower() in model_handler.IMAGE_EXTENSIONS:
+                keys.append(s3_object['Key'])
+    logger.info(f"Listed {len(keys)} images under s3://{bucket_name}/{prefix} in {time.perf_counter() - start_time:.1f}s")
+    return keys
+
+
+def read_manifest_keys(s3_client, manifest_uri):
+    """
+    (bucket, keys) of the source-refs of a Ground Truth manifest stored on s3 or locally, in manifest
+    order. Every source-ref must be in the same bucket
+    """
+    if manifest_uri.startswith('s3://'):
+        manifest_bucket, manifest_key = parse_s3_uri(manifest_uri)
+        lines = s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)['Body'].iter_lines()
+    else:
+        lines = open(manifest_uri, 'rb')
+    bucket_names, keys = set(), []
+    for line in lines:
+        if not line.strip():
+            continue
+        bucket_name, key = parse_s3_uri(json.loads(line)['source-ref'])
+        bucket_names.add(bucket_name)
+        keys.append(key)
+    assert len(bucket_names) <= 1, f"{manifest_uri} references several buckets : {sorted(bucket_names)}"
+    logger.info(f"Read {len(keys)} images from {manifest_uri}")
+    return (bucket_names.pop() if bucket_names else None), keys
+
+
+def get_image_size(image):
+    return {"height": image.shape[0], "width": image.shape[1], "depth": image.shape[2] if image.ndim == 3 else 1}
+
+
+def get_shard_name(shard_index, output_type):
+    return f"part-{shard_index:05d}.{output_type}"
+
+
+def write_jsonl(path, rows):
+    with open(path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def write_parquet(path, rows):
+    """One row per image with the compact results as list columns"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("pyarrow is required for parquet outputs, pip install pyarrow")
+    columns = {
+        "image_key": [row["image_key"] for row in rows],
+        "error": [row.get("error") for row in rows],
+        "image_height": [row["image_size"]["height"] if "image_size" in row else None for row in rows],
+        "image_width": [row["image_size"]["width"] if "image_size" in row else None for row in rows],
+    }
+    for name in ["count", "boxes", "class_ids", "confidences"]:
+        columns[name] = [row["results"][name] if "results" in row else None for row in rows]
+    pyarrow.parquet.write_table(pyarrow.table(columns), path)
+
+
+_handler = None
+
+
+def init_worker(model_dir, num_workers, prefetch_threads):
+    """
+    Loads the model once per worker process, intra-op threads are split between the workers.
+    The s3 connection pool is sized to the prefetch threads so that no download waits for a connection
+    """
+    global _handler
+    os.environ['SAGEMAKER_MODEL_SERVER_WORKERS'] = str(num_workers)
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    _handler = model_handler.ModelHandler()
+    _handler.load(model_dir)
+    # The process wide s3 client is created on first access, after this override
+    _handler.handler_config['s3_max_pool_connections'] = max(
+        _handler.handler_config.get('s3_max_pool_connections'), prefetch_threads
+    )
+
+
+def iter_prefetched(keys, fetch, fetch_executor, look_ahead):
+    """Yields (key, image bytes or exception) in key order with up to look_ahead downloads in flight"""
+    def safe_fetch(key):
+        try:
+            return fetch(key)
+        except Exception as e:
+            return e
+
+    pending = deque()
+    for key in keys:
+        pending.append((key, fetch_executor.submit(safe_fetch, key)))
+        if len(pending) >= look_ahead:
+            key, future = pending.popleft()
+            yield key, future.result()
+    while pending:
+        key, future = pending.popleft()
+        yield key, future.result()
+
+
+def run_shard(shard_index, bucket_name, keys, output_uri, options):
+    """Predicts the images of one shard and publishes its output file, returns the shard stats"""
+    start_time = time.perf_counter()
+    handler = _handler
+    params = handler.get_inference_params(options.get('params', {}))
+    batch_size = options.get('batch_size')
+
+    def fetch(key):
+        return handler.s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+
+    def predict_batch(batch):
+        images = []
+        for key, image_bytes in batch:
+            try:
+                if isinstance(image_bytes, Exception):
+                    raise image_bytes
+                images.append((key, handler.decode_image(image_bytes)))
+            except Exception as e:
+                rows.append({"image_key": key, "error": str(e)})
+        if not images:
+            return
+        model_outputs = handler.predict([image for _, image in images], params)
+        for (key, image), result in zip(images, model_outputs):
+            rows.append({
+                "image_key": key,
+                "image_size": get_image_size(image),
+                "results": handler.format_output(
+                    [result], output_format=options.get('output_format'), top_k=options.get('top_k')
+                ),
+            })
+
+    rows, batch = [], []
+    with ThreadPoolExecutor(max_workers=options.get('prefetch_threads')) as fetch_executor:
+        for key, image_bytes in iter_prefetched(keys, fetch, fetch_executor, look_ahead=2 * batch_size):
+            batch.append((key, image_bytes))
+            if len(batch) == batch_size:
+                predict_batch(batch)
+                batch = []
+        if batch:
+            predict_batch(batch)
+
+    output_type = options.get('output_type')
+    output_store = OutputStore(output_uri, handler.s3_client)
+    # Local shards are staged next to the output so that publishing is a rename on the same filesystem
+    with tempfile.NamedTemporaryFile(delete=False, suffix='.tmp', dir=None if output_store.is_s3 else output_uri) as f:
+        local_path = f.name
+    if output_type == 'parquet':
+        write_parquet(local_path, rows)
+    else:
+        write_jsonl(local_path, rows)
+    output_store.put_file(local_path, get_shard_name(shard_index, output_type))
+    errors = sum(1 for row in rows if "error" in row)
+    return shard_index, len(keys), errors, time.perf_counter() - start_time
+
+
+def load_or_list_keys(output_store, s3_client, args):
+    """
+    Reuses the key list of a previous run so that shard boundaries stay the same when resuming.
+    The key list has one key per line, the bucket of the images is stored next to it in the input file.
+    Key lists of --input runs without an input file take the bucket of --input
+    returns:
+        bucket_name, keys
+    """
+    names = output_store.list_names()
+    if KEYS_FILE in names:
+        keys = output_store.read_text(KEYS_FILE).splitlines()
+        if INPUT_FILE in names:
+            bucket_name = json.loads(output_store.read_text(INPUT_FILE))['bucket']
+        elif args.manifest:
+            bucket_name, _ = read_manifest_keys(s3_client, args.manifest)
+        else:
+            bucket_name, _ = parse_s3_uri(args.input)
+        logger.info(f"Resuming with {len(keys)} keys of s3://{bucket_name} from {KEYS_FILE}")
+        return bucket_name, keys
+    if args.manifest:
+        bucket_name, keys = read_manifest_keys(s3_client, args.manifest)
+    else:
+        bucket_name, prefix = parse_s3_uri(args.input)
+        keys = list_image_keys(s3_client, bucket_name, prefix)
+    output_store.write_text(INPUT_FILE, json.dumps({'bucket': bucket_name, 'input': args.manifest or args.input}))
+    output_store.write_text(KEYS_FILE, '\n'.join(keys))
+    return bucket_name, keys
+
+
+def run_batch_transform(args):
+    s3_client = model_handler.get_s3_client(model_handler.DEFAULT_HANDLER_CONFIG)
+    output_store = OutputStore(args.output, s3_client)
+    bucket_name, keys = load_or_list_keys(output_store, s3_client, args)
+    shards = [keys[start:start + args.shard_size] for start in range(0, len(keys), args.shard_size)]
+    completed = output_store.list_names()
+    pending = [
+        shard_index for shard_index in range(len(shards))
+        if get_shard_name(shard_index, args.output_type) not in completed
+    ]
+    logger.info(f"{len(shards)} shards, {len(shards) - len(pending)} already completed, {len(pending)} to run")
+
+    options = {
+        "params": {name: getattr(args, name) for name in ['conf', 'iou', 'imgsz', 'max_det'] if getattr(args, name) is not None},
+        "batch_size": args.batch_size,
+        "output_format": args.output_format,
+        "output_type": args.output_type,
+        "top_k": args.top_k,
+        "prefetch_threads": args.prefetch_threads,
+    }
+    num_workers = min(args.workers, max(1, len(pending)))
+    start_time = time.perf_counter()
+    images_done, errors = 0, 0
+    if pending:
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(os.path.abspath(args.model_dir), num_workers, args.prefetch_threads),
+        ) as executor:
+            futures = [
+                executor.submit(run_shard, shard_index, bucket_name, shards[shard_index], args.output, options)
+                for shard_index in pending
+            ]
+            for shards_done, future in enumerate(as_completed(futures), start=1):
+                shard_index, shard_images, shard_errors, shard_seconds = future.result()
+                images_done += shard_images
+                errors += shard_errors
+                elapsed = time.perf_counter() - start_time
+                logger.info(
+                    f"Shard {shard_index} done ({shard_images} images, {shard_errors} errors, {shard_seconds:.1f}s), "
+                    f"Progress={shards_done}/{len(pending)}, Throughput={images_done / elapsed:.1f} images/s"
+                )
+
+    summary = {
+        "input": args.input or args.manifest,
+        "images": len(keys),
+        "shards": len(shards),
+        "images_this_run": images_done,
+        "errors_this_run": errors,
+        "seconds_this_run": round(time.perf_counter() - start_time, 1),
+        "workers": num_workers,
+    }
+    output_store.write_text(SUCCESS_FILE, json.dumps(summary, indent=4))
+    logger.info(f"Batch Transform Completed, Summary={summary}")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', type=str, required=True, help='model directory with model.json')
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('--input', type=str, help='s3://bucket/prefix of the images')
+    input_group.add_argument('--manifest', type=str, help='Ground Truth manifest (s3 or local) whose source-refs are predicted')
+    parser.add_argument('--output', type=str, required=True, help='output s3://bucket/prefix or local directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes, defaults to the cpu cores')
+    parser.add_argument('--shard-size', type=int, default=1000, help='images per output shard')
+    parser.add_argument('--batch-size', type=int, default=16, help='images per forward pass')
+    parser.add_argument('--prefetch-threads', type=int, default=16, help='concurrent downloads per worker')
+    parser.add_argument('--output-type', type=str, default='jsonl', choices=OUTPUT_TYPES)
+    parser.add_argument('--output-format', type=str, default='compact', choices=model_handler.OUTPUT_FORMATS)
+    parser.add_argument('--top-k', type=int, default=None, help='keep the top_k most confident boxes per image')
+    parser.add_argument('--conf', type=float, default=None)
+    parser.add_argument('--iou', type=float, default=None)
+    parser.add_argument('--imgsz', type=int, default=None)
+    parser.add_argument('--max-det', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.output_type == 'parquet':
+        assert args.output_format == 'compact', "parquet outputs use the compact output format"
+    run_batch_transform(args)
@@ -20,8 +20,17 @@ def _start_mms():
     model_server.start_model_server(handler_service="/home/model-server/model_handler.py:handle")
 
 
+def _start_async_server():
+    # Replaces this process so that SIGTERM from docker reaches the server for a graceful shutdown
+    os.execvp("python", ["python", "/home/model-server/async_server.py"])
+
+
 def main():
-    if sys.argv[1] == "serve":
+    # SAGEMAKER_SERVER_MODE=asyncio serves /ping and /invocations from a single python process
+    # instead of Multi Model Server, saving the JVM startup time and memory
+    if sys.argv[1] == "serve" and os.environ.get("SAGEMAKER_SERVER_MODE", "mms") == "asyncio":
+        _start_async_server()
+    elif sys.argv[1] == "serve":
         _start_mms()
     else:
         subprocess.check_call(shlex.split(" ".join(sys.argv[1:])))
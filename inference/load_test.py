@@ -0,0 +1,624 @@
+"""
+Local load-testing harness for the inference handler.
+Sends a weighted mix of requests built from a directory of images either to model_handler.handle
+running in a pool of worker processes (in-process, one process per MMS worker) or to a running
+server over HTTP (POST /invocations on :8080, MMS container or async_server.py). Images referenced
+by s3 requests are served by a local S3 stand-in, so the whole run is offline.
+
+Modes:
+    closed : --concurrency clients each send a request and wait for its response before the next
+    open   : requests arrive at --rate per second (poisson) whatever the response times, latency is
+             measured from the scheduled arrival so queueing in the server is included
+
+Every (workers, concurrency/rate) combination is one run. The report has throughput, latency
+percentiles, error count, result cache hit fraction and the cpu/rss/pss of the worker processes.
+
+usage:
+    cd inference
+    python load_test.py --model-dir /opt/ml/model --images-dir ../data/images \
+        --mix sample_files/load_test_mix.json --workers 1,2,4 --concurrency 4,8 --duration 60 \
+        --output load_test_results.json
+
+    # against a server started with AWS_ENDPOINT_URL_S3=http://127.0.0.1:9090
+    python load_test.py --target http://localhost:8080 --images-dir ../data/images \
+        --mode open --rate 5,10,20 --duration 60 --server-pid <pid>
+"""
+import os
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import http.client
+import multiprocessing
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from loguru import logger
+
+curr_dir = os.path.abspath(os.path.dirname(__file__))
+
+IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg']
+LOAD_TEST_BUCKET = 'load-test'
+PERCENTILES = [50, 95, 99]
+DEFAULT_MIX = [{"name": "s3", "weight": 1.0, "payload_format": "json", "params": {}}]
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    """
+    Path style S3 stand-in : GetObject/HeadObject (with ETag and If-None-Match), PutObject and
+    ListObjectsV2 (single page) over the objects of LocalS3Server
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_error_xml(self, status, code):
+        body = f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><Error><Code>{code}</Code></Error>".encode('utf-8')
+        self.send_body(status, body, 'application/xml')
+
+    def get_bucket_and_key(self):
+        url = urllib.parse.urlparse(self.path)
+        bucket_name, _, key = urllib.parse.unquote(url.path).lstrip('/').partition('/')
+        return bucket_name, key, urllib.parse.parse_qs(url.query)
+
+    def do_GET(self):
+        bucket_name, key, query = self.get_bucket_and_key()
+        if 'list-type' in query:
+            prefix = query.get('prefix', [''])[0]
+            contents = ''.join(
+                f"<Contents><Key>{xml_escape(object_key)}</Key><Size>{size}</Size></Contents>"
+                for object_key, size in self.server.list_objects(bucket_name, prefix)
+            )
+            body = (
+                "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+                "<ListBucketResult xmlns=\"http://s3.amazonaws.com/doc/2006-03-01/\">"
+                f"<Name>{bucket_name}</Name><Prefix>{xml_escape(prefix)}</Prefix>"
+                f"<IsTruncated>false</IsTruncated>{contents}</ListBucketResult>"
+            ).encode('utf-8')
+            return self.send_body(200, body, 'application/xml')
+        obj = self.server.get_object(bucket_name, key)
+        if obj is None:
+            return self.send_error_xml(404, 'NoSuchKey')
+        body, etag, content_type = obj
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_body(304, b'', content_type, {'ETag': etag})
+        self.send_body(200, body, content_type, {'ETag': etag})
+
+    do_HEAD = do_GET
+
+    def do_PUT(self):
+        bucket_name, key, _ = self.get_bucket_and_key()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        etag = self.server.put_object(
+            bucket_name, key, body, self.headers.get('Content-Type', 'application/octet-stream')
+        )
+        self.send_body(200, b'', 'application/xml', {'ETag': etag})
+
+
+def xml_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class LocalS3Server(ThreadingHTTPServer):
+    """
+    S3 stand-in serving the files of root_dir as the objects of bucket_name. Objects put by clients
+    (e.g. async inference inputs and outputs) are kept in memory in any bucket
+    """
+    daemon_threads = True
+
+    def __init__(self, root_dir, bucket_name=LOAD_TEST_BUCKET, port=0):
+        super().__init__(('127.0.0.1', port), LocalS3Handler)
+        self.root_dir = os.path.abspath(root_dir)
+        self.bucket_name = bucket_name
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    @property
+    def endpoint_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def get_object(self, bucket_name, key):
+        """Returns (body, etag, content type) or None"""
+        with self.lock:
+            if (bucket_name, key) in self.objects:
+                return self.objects[(bucket_name, key)]
+        file_path = os.path.abspath(os.path.join(self.root_dir, key))
+        if bucket_name != self.bucket_name or not file_path.startswith(self.root_dir + os.sep) or not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        etag = self.put_object(bucket_name, key, body, 'application/octet-stream')
+        return body, etag, 'application/octet-stream'
+
+    def put_object(self, bucket_name, key, body, content_type):
+        etag = f"\"{hashlib.md5(body).hexdigest()}\""
+        with self.lock:
+            self.objects[(bucket_name, key)] = (body, etag, content_type)
+        return etag
+
+    def list_objects(self, bucket_name, prefix):
+        """(key, size) of the objects of a bucket under prefix in key order"""
+        with self.lock:
+            objects = {key: len(obj[0]) for (bucket, key), obj in self.objects.items() if bucket == bucket_name}
+        if bucket_name == self.bucket_name:
+            for image_key in list_images(self.root_dir, allow_empty=True):
+                objects.setdefault(image_key, os.path.getsize(os.path.join(self.root_dir, image_key)))
+        return sorted((key, size) for key, size in objects.items() if key.startswith(prefix))
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        # Picked up by every boto3 s3 client created afterwards, including the ones of worker processes
+        os.environ['AWS_ENDPOINT_URL_S3'] = self.endpoint_url
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'load-test')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'load-test')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        logger.info(f"Local S3 serving {self.root_dir} as s3://{self.bucket_name} on {self.endpoint_url}")
+        return self
+
+
+def list_images(images_dir, allow_empty=False):
+    """Relative paths of the images under images_dir, extensions are matched case insensitively"""
+    images = []
+    for root, _, files in os.walk(images_dir):
+        for file_name in files:
+            if file_name.rsplit('.', 1)[-1].lower() in IMAGE_EXTENSIONS:
+                images.append(os.path.relpath(os.path.join(root, file_name), images_dir))
+    assert allow_empty or len(images) > 0, f"No images found in {images_dir}"
+    return sorted(images)
+
+
+class RequestMix(object):
+    """
+    Builds requests from a weighted mix. Each entry of the mix has:
+        name : label of the entry in the report
+        weight : relative frequency of the entry
+        payload_format : json (image fetched from the local s3), base64 or raw, as in invoke_endpoint.py
+        params : request parameters, e.g. conf, output_format, tiled
+        accept : optional Accept header, e.g. application/x-msgpack
+    """
+    def __init__(self, mix, images_dir, seed=0):
+        self.mix = mix
+        self.weights = [entry.get('weight', 1.0) for entry in mix]
+        self.images_dir = images_dir
+        self.images = list_images(images_dir)
+        self.image_bytes = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def read_image(self, image_key):
+        if image_key not in self.image_bytes:
+            with open(os.path.join(self.images_dir, image_key), 'rb') as f:
+                self.image_bytes[image_key] = f.read()
+        return self.image_bytes[image_key]
+
+    def next_request(self):
+        """Returns (entry name, body, headers) of a random request"""
+        with self.lock:
+            entry = self.random.choices(self.mix, weights=self.weights)[0]
+            image_key = self.random.choice(self.images)
+        params = entry.get('params', {})
+        payload_format = entry.get('payload_format', 'json')
+        headers = {'Content-Type': 'application/json'}
+        if payload_format == 'json':
+            body = json.dumps(dict(params, image_path=image_key, bucket_name=LOAD_TEST_BUCKET)).encode('utf-8')
+        elif payload_format == 'base64':
+            image = base64.b64encode(self.read_image(image_key)).decode('utf-8')
+            body = json.dumps(dict(params, image=image)).encode('utf-8')
+        elif payload_format == 'raw':
+            body = self.read_image(image_key)
+            headers['Content-Type'] = 'application/x-image'
+            if params:
+                # Values are url encoded so that the commas of list values do not split them
+                headers['X-Amzn-SageMaker-Custom-Attributes'] = ','.join(
+                    f"{name}={urllib.parse.quote(json.dumps(value), safe='')}" for name, value in params.items()
+                )
+        else:
+            raise Exception(f"{payload_format} not supported. Supported formats : json, base64, raw")
+        if entry.get('accept') is not None:
+            headers['Accept'] = entry.get('accept')
+        return entry.get('name', payload_format), body, headers
+
+
+def parse_output(output):
+    """Returns the response dictionary of a json or msgpack response"""
+    if isinstance(output, (bytes, bytearray)):
+        if output[:1] in (b'{', b'['):
+            return json.loads(output)
+        import msgpack
+
+        return msgpack.unpackb(output, raw=False)
+    if isinstance(output, str):
+        return json.loads(output)
+    return output
+
+
+_worker_model_dir = None
+
+
+def init_worker(model_dir, num_workers, disable_result_cache=False):
+    """
+    Loads the model in a worker process, the same way MMS starts one of its workers.
+    With disable_result_cache every request runs the model even when images repeat
+    """
+    global _worker_model_dir
+    os.environ['SAGEMAKER_MODEL_SERVER_WORKERS'] = str(num_workers)
+    logger.remove()
+    logger.add(sys.stderr, level='WARNING')
+    sys.path.insert(0, curr_dir)
+    import model_handler
+    from async_server import RequestContext
+
+    _worker_model_dir = model_dir
+    model_handler.handle(None, RequestContext({}, model_dir=model_dir))
+    if disable_result_cache:
+        service, _ = model_handler._registry.get(model_dir)
+        service.result_cache = None
+
+
+def worker_ready(delay):
+    """Keeps the worker busy for delay seconds so that every worker of the pool gets started"""
+    time.sleep(delay)
+    return os.getpid()
+
+
+def worker_invoke(body, headers):
+    """Runs model_handler.handle for one request, returns (cached, handle milliseconds)"""
+    import model_handler
+    from async_server import RequestContext
+
+    context = RequestContext({name.lower(): value for name, value in headers.items()}, model_dir=_worker_model_dir)
+    start_time = time.perf_counter()
+    output = model_handler.handle([{'body': body}], context)[0]
+    handle_ms = (time.perf_counter() - start_time) * 1000
+    return bool(parse_output(output).get('cached')), handle_ms
+
+
+class InProcessTarget(object):
+    """model_handler.handle running in num_workers processes, one request at a time per worker"""
+    def __init__(self, model_dir, num_workers, disable_result_cache=False):
+        self.num_workers = num_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=init_worker,
+            initargs=(model_dir, num_workers, disable_result_cache),
+        )
+        start_time = time.perf_counter()
+        pids = set()
+        while len(pids) < num_workers:
+            futures = [self.executor.submit(worker_ready, 0.5) for _ in range(num_workers)]
+            pids.update(future.result() for future in futures)
+        self.pids = sorted(pids)
+        logger.info(f"{num_workers} workers ready in {time.perf_counter() - start_time:.1f}s, Pids={self.pids}")
+
+    def submit(self, body, headers):
+        return self.executor.submit(worker_invoke, body, headers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class HttpTarget(object):
+    """POST /invocations to a running server, each sender thread keeps its own keep-alive connection"""
+    def __init__(self, url, max_outstanding, server_pid=None):
+        parsed_url = urllib.parse.urlparse(url)
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port or 8080
+        self.path = (parsed_url.path.rstrip('/') or '') + '/invocations'
+        self.executor = ThreadPoolExecutor(max_workers=max_outstanding, thread_name_prefix='sender')
+        self.local = threading.local()
+        self.pids = get_process_tree(server_pid) if server_pid else []
+
+    def invoke(self, body, headers):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=120)
+        start_time = time.perf_counter()
+        try:
+            connection.request('POST', self.path, body=body, headers=headers)
+            response = connection.getresponse()
+            output = response.read()
+        except (http.client.HTTPException, ConnectionError):
+            connection.close()
+            self.local.connection = None
+            raise
+        handle_ms = (time.perf_counter() - start_time) * 1000
+        if response.status != 200:
+            raise Exception(f"Status {response.status} : {output[:200]}")
+        return bool(parse_output(output).get('cached')), handle_ms
+
+    def submit(self, body, headers):
+        return self.executor.submit(self.invoke, body, headers)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def get_process_tree(pid):
+    """pid and its descendants, read from /proc"""
+    pids = [pid]
+    for task in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                for child_pid in f.read().split():
+                    pids.extend(get_process_tree(int(child_pid)))
+        except OSError:
+            continue
+    return pids
+
+
+def read_process_stats(pid):
+    """(cpu seconds, rss bytes, pss bytes) of a process, None when not available (non linux)"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        memory = {}
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss'):
+                    memory[name] = int(value.split()[0]) * 1024
+        return cpu_seconds, memory.get('Rss'), memory.get('Pss')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class ResourceMonitor(object):
+    """Samples cpu and memory of the worker processes during a run"""
+    def __init__(self, pids, interval=0.5):
+        self.pids = pids
+        self.interval = interval
+        self.peak_rss = {pid: 0 for pid in pids}
+        self.peak_pss = {pid: 0 for pid in pids}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        cpu_seconds = {}
+        for pid in self.pids:
+            stats = read_process_stats(pid)
+            if stats is None:
+                continue
+            cpu_seconds[pid] = stats[0]
+            self.peak_rss[pid] = max(self.peak_rss[pid], stats[1] or 0)
+            self.peak_pss[pid] = max(self.peak_pss[pid], stats[2] or 0)
+        return cpu_seconds
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.start_cpu = self.sample()
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        elapsed = time.perf_counter() - self.start_time
+        end_cpu = self.sample()
+        if not end_cpu:
+            return {}
+        cpu_percent = sum(end_cpu[pid] - self.start_cpu.get(pid, 0) for pid in end_cpu) / elapsed * 100
+        return {
+            "cpu_percent": round(cpu_percent, 1),
+            "cpu_percent_per_worker": round(cpu_percent / len(end_cpu), 1),
+            "peak_rss_mb_per_worker": round(max(self.peak_rss.values()) / 2 ** 20, 1),
+            "peak_pss_mb_total": round(sum(self.peak_pss.values()) / 2 ** 20, 1),
+        }
+
+
+class LoadRecorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.handle_latencies = []
+        self.cached = 0
+        self.errors = 0
+        self.error_samples = []
+        self.by_entry = {}
+
+    def record(self, name, scheduled_time, future):
+        latency_ms = (time.perf_counter() - scheduled_time) * 1000
+        with self.lock:
+            try:
+                cached, handle_ms = future.result()
+            except Exception as e:
+                self.errors += 1
+                if len(self.error_samples) < 5:
+                    self.error_samples.append(str(e)[:200])
+                return
+            self.latencies.append(latency_ms)
+            self.handle_latencies.append(handle_ms)
+            self.cached += int(cached)
+            self.by_entry.setdefault(name, []).append(latency_ms)
+
+
+def get_percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    percentiles = {
+        f"p{percentile}": round(values[min(len(values) - 1, int(len(values) * percentile / 100))], 2)
+        for percentile in PERCENTILES
+    }
+    percentiles["mean"] = round(sum(values) / len(values), 2)
+    percentiles["max"] = round(values[-1], 2)
+    return percentiles
+
+
+def run_closed_loop(target, request_mix, recorder, concurrency, duration, max_requests):
+    """concurrency clients, each waits for its response before sending the next request"""
+    deadline = time.perf_counter() + duration
+    counter = iter(range(max_requests or sys.maxsize))
+    counter_lock = threading.Lock()
+
+    def client():
+        while time.perf_counter() < deadline:
+            with counter_lock:
+                if next(counter, None) is None:
+                    return
+            name, body, headers = request_mix.next_request()
+            start_time = time.perf_counter()
+            future = target.submit(body, headers)
+            future.exception()
+            recorder.record(name, start_time, future)
+
+    clients = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+
+def run_open_loop(target, request_mix, recorder, rate, duration, max_requests, seed=0):
+    """
+    Poisson arrivals at rate requests per second. Latency counts from the scheduled arrival time,
+    so a server that falls behind shows up as growing latency instead of a slower sender
+    """
+    arrivals = random.Random(seed)
+    start_time = time.perf_counter()
+    next_time = start_time
+    futures = []
+    while next_time - start_time < duration and (not max_requests or len(futures) < max_requests):
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        name, body, headers = request_mix.next_request()
+        future = target.submit(body, headers)
+        future.add_done_callback(lambda f, name=name, scheduled_time=next_time: recorder.record(name, scheduled_time, f))
+        futures.append(future)
+        next_time += arrivals.expovariate(rate)
+    for future in futures:
+        future.exception()
+
+
+def run_load(target, request_mix, mode, load, duration, max_requests):
+    """Runs one load level against target and returns its report"""
+    recorder = LoadRecorder()
+    monitor = ResourceMonitor(target.pids)
+    monitor.start()
+    start_time = time.perf_counter()
+    if mode == 'closed':
+        run_closed_loop(target, request_mix, recorder, load, duration, max_requests)
+    else:
+        run_open_loop(target, request_mix, recorder, load, duration, max_requests)
+    elapsed = time.perf_counter() - start_time
+    resources = monitor.stop()
+
+    completed = len(recorder.latencies)
+    report = {
+        "mode": mode,
+        "workers": getattr(target, 'num_workers', None),
+        "concurrency" if mode == 'closed' else "rate": load,
+        "requests": completed + recorder.errors,
+        "errors": recorder.errors,
+        "duration_seconds": round(elapsed, 2),
+        "throughput_rps": round(completed / elapsed, 2),
+        "cached_fraction": round(recorder.cached / completed, 3) if completed else 0,
+        "latency_ms": get_percentiles(recorder.latencies),
+        "handle_latency_ms": get_percentiles(recorder.handle_latencies),
+        "latency_ms_by_entry": {name: get_percentiles(values) for name, values in recorder.by_entry.items()},
+    }
+    report.update(resources)
+    if recorder.error_samples:
+        report["error_samples"] = recorder.error_samples
+    return report
+
+
+def print_report(reports):
+    columns = ['workers', 'load', 'requests', 'errors', 'rps', 'p50', 'p95', 'p99', 'cached', 'cpu%', 'rss_mb', 'pss_mb']
+    print(' '.join(f"{column:>9}" for column in columns))
+    for report in reports:
+        latency = report.get('latency_ms', {})
+        row = [
+            report.get('workers') or '-', report.get('concurrency', report.get('rate')), report['requests'],
+            report['errors'], report['throughput_rps'], latency.get('p50', '-'), latency.get('p95', '-'),
+            latency.get('p99', '-'), report['cached_fraction'], report.get('cpu_percent', '-'),
+            report.get('peak_rss_mb_per_worker', '-'), report.get('peak_pss_mb_total', '-'),
+        ]
+        print(' '.join(f"{str(value):>9}" for value in row))
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-dir', type=str, help='model directory with model.json, used in-process')
+    parser.add_argument('--target', type=str, default=None, help='server url, e.g. http://localhost:8080. In-process when not set')
+    parser.add_argument('--images-dir', type=str, required=True, help='directory of images the requests are built from')
+    parser.add_argument('--mix', type=str, default=None, help='json file with the request mix, see RequestMix')
+    parser.add_argument('--mode', type=str, default='closed', choices=['closed', 'open'])
+    parser.add_argument('--workers', type=str, default='1', help='comma separated worker counts, in-process only')
+    parser.add_argument('--concurrency', type=str, default='1', help='comma separated client counts, closed mode')
+    parser.add_argument('--rate', type=str, default='1', help='comma separated requests per second, open mode')
+    parser.add_argument('--duration', type=float, default=30, help='seconds per run')
+    parser.add_argument('--requests', type=int, default=None, help='stop a run after this many requests')
+    parser.add_argument('--disable-result-cache', action='store_true', help='run the model for every request, in-process only')
+    parser.add_argument('--warmup-requests', type=int, default=0, help='requests sent before each run, not reported')
+    parser.add_argument('--max-outstanding', type=int, default=256, help='http requests in flight, open mode')
+    parser.add_argument('--server-pid', type=int, default=None, help='pid of the server to report cpu/rss for, http only')
+    parser.add_argument('--s3-port', type=int, default=9090, help='port of the local S3 stand-in')
+    parser.add_argument('--instance-type', type=str, default=None, help='instance type recorded in the output')
+    parser.add_argument('--instance-count', type=int, default=1, help='instances serving --target, recorded in the output')
+    parser.add_argument('--output', type=str, default=None, help='json file the reports are written to')
+    args = parser.parse_args()
+
+    assert args.target is not None or args.model_dir is not None, "--model-dir is required in-process"
+    assert os.path.exists(args.images_dir), f"{args.images_dir} does not exist"
+    mix = json.load(open(args.mix)) if args.mix else DEFAULT_MIX
+    request_mix = RequestMix(mix, args.images_dir)
+    LocalS3Server(args.images_dir, port=args.s3_port).start()
+
+    loads = parse_list(args.concurrency, int) if args.mode == 'closed' else parse_list(args.rate, float)
+    worker_counts = parse_list(args.workers, int) if args.target is None else [None]
+    reports = []
+    for num_workers in worker_counts:
+        if args.target is None:
+            target = InProcessTarget(os.path.abspath(args.model_dir), num_workers, args.disable_result_cache)
+        else:
+            target = HttpTarget(args.target, args.max_outstanding, args.server_pid)
+        try:
+            for load in loads:
+                if args.warmup_requests:
+                    run_closed_loop(target, request_mix, LoadRecorder(), int(load), sys.maxsize, args.warmup_requests)
+                logger.info(f"Running {args.mode} loop, Workers={num_workers}, Load={load}")
+                report = run_load(target, request_mix, args.mode, load, args.duration, args.requests)
+                logger.info(f"Report={json.dumps(report)}")
+                reports.append(report)
+        finally:
+            target.close()
+
+    print_report(reports)
+    if args.output:
+        results = {
+            "target": args.target or "in-process",
+            "instance_type": args.instance_type,
+            "instance_count": args.instance_count if args.target else 1,
+            "cpu_count": os.cpu_count(),
+            "mix": mix,
+            "images": len(request_mix.images),
+            "runs": reports,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4)
+        logger.info(f"Results written to {args.output}")
@@ -1,14 +1,520 @@
 import os
+import sys
 import json
 import time
+import base64
+import gc
+import fcntl
+import hashlib
+import importlib
+import threading
+import uuid
+import urllib.parse
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-import torch 
-from loguru import logger
-from ultralytics import YOLO
-import boto3
+
+
+class LazyModule(object):
+    """
+    Imports a module on first attribute access. MMS imports the handler in every worker before
+    the first ping succeeds, so heavy dependencies are only imported once they are needed and
+    boto3 is never imported when all requests carry their images inline
+    """
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            module = importlib.import_module(self._module_name)
+            self._module = getattr(module, self._attribute) if self._attribute else module
+        return getattr(self._module, name)
+
+
+torch = LazyModule('torch')
+torchvision = LazyModule('torchvision')
+cv2 = LazyModule('cv2')
+np = LazyModule('numpy')
+ultralytics = LazyModule('ultralytics')
+boto3 = LazyModule('boto3')
+botocore_config = LazyModule('botocore.config')
+botocore_exceptions = LazyModule('botocore.exceptions')
+# loguru pulls in asyncio and friends, the logger is imported on the first log line
+logger = LazyModule('loguru', attribute='logger')
 
 curr_dir = os.path.abspath(os.path.dirname(__file__))
 
+# Defaults for the optional "handler_config" section of model.json
+DEFAULT_HANDLER_CONFIG = {
+    "s3_max_pool_connections": 10,
+    "image_cache_max_bytes": 64 * 1024 * 1024,
+    "result_cache_max_entries": 1024,
+    "result_cache_ttl_seconds": 300,
+    "result_cache_spill_dir": None,
+    "result_cache_spill_max_entries": 10000,
+    "fuse": True,
+    "torch_num_threads": None,
+    "warmup_iterations": 1,
+    "warmup_sizes": [[640, 640]],
+    "tiled": False,
+    "tile_size": 640,
+    "tile_overlap": 0.2,
+    "tile_batch_size": 16,
+    "tile_nms_iou": 0.5,
+    "max_tiles": 400,
+    "video_batch_size": 8,
+    "video_frame_stride": 1,
+    "video_max_frames": None,
+    "video_max_inline_frames": 1000,
+    "video_output_prefix": "video-results",
+    "include_timings": False,
+    "shared_weights": False,
+    "shared_weights_dir": "/dev/shm",
+}
+
+# Memory budget of the loaded models in a worker, 0 keeps every model loaded
+MODEL_CACHE_MEMORY_MB = int(os.environ.get('MODEL_CACHE_MEMORY_MB', 0))
+
+# Interval of the structured metrics log lines, 0 disables them
+METRICS_LOG_INTERVAL_SECONDS = float(os.environ.get('METRICS_LOG_INTERVAL_SECONDS', 60))
+
+_shared_lock = threading.Lock()
+_s3_client = None
+_image_cache = None
+
+# Inference parameters a request may override, merged over the "params" of model.json
+REQUEST_PARAMS = ['conf', 'iou', 'augment', 'imgsz', 'max_det', 'classes']
+
+# Extensions of frame images listed under a frames_prefix
+IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg']
+
+# Tiling options a request may override, defaults come from handler_config
+TILE_OPTIONS = ['tiled', 'tile_size', 'tile_overlap']
+
+# Content types for which the request body is the encoded image itself
+RAW_IMAGE_CONTENT_TYPES = ['application/x-image', 'image/jpeg', 'image/png']
+
+# Accept type for msgpack responses, compact boxes are then packed as little-endian float32 bytes
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+
+# Supported values of the "output_format" request field
+OUTPUT_FORMATS = ['json', 'compact']
+
+
+def get_request_header(context, header_name, request_index=0):
+    """
+    Reads a header of a request in the batch from the MMS context. Returns None when running
+    outside the model server (e.g. local testing with an empty context)
+    """
+    try:
+        return context.get_request_header(request_index, header_name)
+    except Exception:
+        return None
+
+
+def set_response_content_type(context, content_type, request_index=0):
+    try:
+        context.set_response_content_type(request_index, content_type)
+    except Exception:
+        pass
+
+
+def split_custom_attributes(custom_attributes):
+    """Splits custom attributes on the commas that are not inside brackets or quotes"""
+    attributes, current, depth, in_string = [], [], 0, False
+    for char in custom_attributes:
+        if char == '"':
+            in_string = not in_string
+        elif not in_string and char in '[{':
+            depth += 1
+        elif not in_string and char in ']}':
+            depth = max(0, depth - 1)
+        elif char == ',' and depth == 0 and not in_string:
+            attributes.append(''.join(current))
+            current = []
+            continue
+        current.append(char)
+    attributes.append(''.join(current))
+    return attributes
+
+
+def parse_custom_attributes(custom_attributes):
+    """
+    Parses the X-Amzn-SageMaker-Custom-Attributes header of the form "conf=0.25,iou=0.7,classes=%5B0%2C1%5D"
+    into a dictionary of inference parameters. Values are url decoded then json decoded, values that are
+    not json are kept as strings. Unencoded json lists and objects ("classes=[0,1]") are accepted as well
+    """
+    params = {}
+    if not custom_attributes:
+        return params
+    for attribute in split_custom_attributes(custom_attributes):
+        if '=' not in attribute:
+            continue
+        key, value = attribute.split('=', 1)
+        value = urllib.parse.unquote(value.strip())
+        try:
+            params[key.strip()] = json.loads(value)
+        except ValueError:
+            params[key.strip()] = value
+    return params
+
+
+def get_s3_client(handler_config):
+    """
+    Process wide s3 client shared by all models of the worker. botocore clients are thread safe
+    and reuse pooled connections, so the client is created once with the first handler_config
+    """
+    global _s3_client
+    with _shared_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                's3',
+                config=botocore_config.Config(
+                    max_pool_connections=handler_config.get('s3_max_pool_connections'),
+                    retries={'max_attempts': 3, 'mode': 'standard'},
+                    tcp_keepalive=True,
+                )
+            )
+        return _s3_client
+
+
+def get_image_cache(handler_config):
+    """Process wide image cache shared by all models of the worker"""
+    global _image_cache
+    with _shared_lock:
+        if _image_cache is None:
+            _image_cache = ImageCache(max_bytes=handler_config.get('image_cache_max_bytes'))
+        return _image_cache
+
+
+def resolve_model_dir(context):
+    """
+    Returns the model directory of the request. With MultiModel endpoints MMS routes every target
+    model to its own workers and model_dir is used as it is. When a single process serves several
+    models, the X-Amzn-SageMaker-Target-Model header selects the sub directory of model_dir named
+    after the target model archive
+    """
+    model_dir = context.system_properties.get("model_dir")
+    target_model = get_request_header(context, 'X-Amzn-SageMaker-Target-Model')
+    if target_model:
+        target_dir = os.path.join(model_dir, target_model.replace('.tar.gz', ''))
+        if os.path.isdir(target_dir):
+            return target_dir
+    return model_dir
+
+
+def get_tile_offsets(length, tile_size, tile_overlap):
+    """
+    Start offsets of tiles covering [0, length) with the given overlap ratio.
+    The last tile is aligned to the end so that every tile has the full tile_size
+    """
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - tile_overlap)))
+    offsets = list(range(0, length - tile_size, stride))
+    offsets.append(length - tile_size)
+    return offsets
+
+
+def torch_supports_mmap_load():
+    """
+    torch.load(mmap=True) and load_state_dict(assign=True) used by the inference artifact and the
+    shared weights need torch 2.1 or later, older images (e.g. pytorch-inference:1.9.1) do not have them
+    """
+    major, minor = (int(''.join(c for c in part if c.isdigit()) or 0) for part in torch.__version__.split('.')[:2])
+    return (major, minor) >= (2, 1)
+
+
+def get_torch_num_threads(handler_config):
+    """
+    Number of intra-op threads per worker. Unless set explicitly, the available cores are split
+    between the MMS workers so that workers do not oversubscribe the cpu. MMS starts one worker
+    per core when SAGEMAKER_MODEL_SERVER_WORKERS is not set. SAGEMAKER_SERVER_MODE=asyncio
+    (async_server.py) and handlers loaded outside of MMS run in a single process and use every core
+    """
+    if handler_config.get('torch_num_threads'):
+        return int(handler_config.get('torch_num_threads'))
+    cpu_count = os.cpu_count() or 1
+    if os.environ.get('SAGEMAKER_SERVER_MODE', 'mms') == 'asyncio':
+        return cpu_count
+    if 'SAGEMAKER_MODEL_SERVER_WORKERS' in os.environ:
+        num_workers = int(os.environ['SAGEMAKER_MODEL_SERVER_WORKERS'])
+    elif 'mms' in sys.modules:
+        num_workers = cpu_count
+    else:
+        num_workers = 1
+    return max(1, cpu_count // max(1, num_workers))
+
+
+class ImageCache(object):
+    """
+    Bounded LRU cache of encoded image bytes keyed by (bucket, key).
+    Every entry keeps the ETag of the object, cached bytes are only served after the
+    object has been revalidated against that ETag. Least recently used entries are
+    evicted once the total size of cached bytes exceeds max_bytes
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, bucket_name, key):
+        """Returns (etag, image_bytes) of the cached entry or None"""
+        with self._lock:
+            entry = self._entries.get((bucket_name, key))
+            if entry is not None:
+                self._entries.move_to_end((bucket_name, key))
+            return entry
+
+    def record(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, bucket_name, key, etag, image_bytes):
+        size = len(image_bytes)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old_entry = self._entries.pop((bucket_name, key), None)
+            if old_entry is not None:
+                self.current_bytes -= len(old_entry[1])
+            self._entries[(bucket_name, key)] = (etag, image_bytes)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted_bytes)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+            }
+
+
+class ResultCache(object):
+    """
+    Bounded LRU cache of formatted predictions with a time to live.
+    Entries evicted from memory are spilled as json files to spill_dir when it is configured
+    and are promoted back into memory on the next lookup. The spill directory keeps at most
+    spill_max_entries files, oldest files are removed first
+    """
+    def __init__(self, max_entries, ttl_seconds, spill_dir=None, spill_max_entries=10000):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.spill_dir = spill_dir
+        self.spill_max_entries = spill_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._spilled = OrderedDict()
+        self._lock = threading.Lock()
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _spill(self, key, expires_at, results):
+        spill_path = self._spill_path(key)
+        with open(spill_path, 'w') as f:
+            json.dump({"expires_at": expires_at, "results": results}, f)
+        self._spilled[key] = spill_path
+        while len(self._spilled) > self.spill_max_entries:
+            _, old_path = self._spilled.popitem(last=False)
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+    def _load_spilled(self, key):
+        spill_path = self._spilled.pop(key, None)
+        if spill_path is None or not os.path.exists(spill_path):
+            return None
+        with open(spill_path) as f:
+            entry = json.load(f)
+        os.remove(spill_path)
+        return entry["expires_at"], entry["results"]
+
+    def get(self, key):
+        """Returns the cached results of key or None when missing or expired"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None and self.spill_dir is not None:
+                entry = self._load_spilled(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-insert as the most recently used entry
+            self._entries[key] = entry
+            self._evict()
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, results):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl_seconds, results)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            evicted_key, (expires_at, evicted_results) = self._entries.popitem(last=False)
+            if self.spill_dir is not None and expires_at > time.time():
+                self._spill(evicted_key, expires_at, evicted_results)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "spilled_entries": len(self._spilled),
+            }
+
+
+class StageTimer(object):
+    """Accumulates the wall time of the stages of a request in milliseconds"""
+    def __init__(self):
+        self.timings = OrderedDict()
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start_time) * 1000)
+
+    def add(self, name, milliseconds):
+        self.timings[name] = self.timings.get(name, 0.0) + milliseconds
+
+    def total(self):
+        return (time.perf_counter() - self.start_time) * 1000
+
+
+class LatencyMetrics(object):
+    """
+    Process wide latency aggregates. The last reservoir_size samples of every stage are kept
+    for percentiles along with request, error and cache hit counters
+    """
+    def __init__(self, reservoir_size=2048):
+        self.reservoir_size = reservoir_size
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.last_log_time = time.monotonic()
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, timings, cached=False):
+        with self._lock:
+            self.requests += 1
+            if cached:
+                self.cache_hits += 1
+            for name, milliseconds in timings.items():
+                if name not in self._samples:
+                    self._samples[name] = deque(maxlen=self.reservoir_size)
+                self._samples[name].append(milliseconds)
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self):
+        with self._lock:
+            samples = {name: np.asarray(values) for name, values in self._samples.items()}
+            summary = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "cache_hits": self.cache_hits,
+                "stages": {},
+            }
+        for name, values in samples.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            summary["stages"][name] = {
+                "count": len(values),
+                "mean": round(float(values.mean()), 3),
+                "p50": round(float(p50), 3),
+                "p95": round(float(p95), 3),
+                "p99": round(float(p99), 3),
+            }
+        return summary
+
+    def should_log(self, interval):
+        """True at most once per interval seconds"""
+        with self._lock:
+            now = time.monotonic()
+            if interval <= 0 or now - self.last_log_time < interval:
+                return False
+            self.last_log_time = now
+            return True
+
+
+class S3MultipartWriter(object):
+    """
+    Streams text lines into an s3 object, holding at most part_size bytes in memory.
+    The multipart upload is only started once a full part is buffered, smaller outputs
+    are written with a single put_object on close
+    """
+    def __init__(self, s3_client, bucket_name, key, part_size=5 * 1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = None
+        self.parts = []
+        self._buffer = bytearray()
+
+    def write(self, line):
+        self._buffer.extend(line.encode('utf-8'))
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key
+            )['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = bytearray()
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3_client.put_object(Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer))
+            return
+        if self._buffer:
+            self._upload_part()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+            )
+
+
 class ModelHandler(object):
     """
     A sample Model handler implementation.
@@ -16,91 +522,843 @@ class ModelHandler(object):
     def __init__(self):
         self.initialized = False
         self.model = None
+        self.device = None
+        self.init_time = None
+        # The ultralytics predictor keeps per call state, so forward passes on the shared
+        # model are serialized while download, decode and formatting run concurrently
+        self.predict_lock = threading.Lock()
+        self.image_cache = None
+        self.result_cache = None
+        self.model_bytes = 0
 
-    def initialize(self, context):
-        self.initialized = True
+    @property
+    def s3_client(self):
+        """Process wide s3 client, created (and boto3 imported) on the first s3 access"""
+        return get_s3_client(self.handler_config)
 
+    def initialize(self, context):
         properties = context.system_properties
-        model_dir = properties.get("model_dir")
-        gpu_id = properties.get("gpu_id")
-        
+        self.load(model_dir=properties.get("model_dir"), gpu_id=properties.get("gpu_id"))
+
+    def load(self, model_dir, gpu_id=None):
+        start_time = time.perf_counter()
         logger.info(f"ModelDir={model_dir}")
         model_path = os.path.join(model_dir, 'model.json')
         logger.info(f"ModelPath={model_path}")
 
         self.model_dict=json.load(open(model_path))
         self.model_dict['weights'] = os.path.join(model_dir, self.model_dict.get('weights'))
-        self.model = YOLO(self.model_dict.get('weights'))
-        logger.info(f"Model Loaded")
+        self.handler_config = dict(DEFAULT_HANDLER_CONFIG, **self.model_dict.get('handler_config', {}))
+        logger.info(f"HandlerConfig={self.handler_config}")
+
+        # Device is resolved once per worker, MMS assigns gpu_id to each worker on gpu instances
+        if torch.cuda.is_available():
+            self.device = f"cuda:{gpu_id}" if gpu_id is not None else 'cuda'
+        else:
+            self.device = 'cpu'
+            torch.set_num_threads(get_torch_num_threads(self.handler_config))
+            if self.handler_config.get('shared_weights'):
+                # Workers share one copy of the weights, keep each worker to its own cores
+                try:
+                    torch.set_num_interop_threads(1)
+                except RuntimeError:
+                    pass
+        logger.info(f"Device={self.device}, TorchThreads={torch.get_num_threads()}")
+        self.model_dict['params']['device'] = self.device
+
+        if self.model_dict.get('artifact') is not None and not torch_supports_mmap_load():
+            # The training checkpoint is always shipped next to the artifact
+            logger.warning(f"torch {torch.__version__} can not load the inference artifact, loading the checkpoint")
+            self.model_dict.pop('artifact')
+        if self.handler_config.get('shared_weights'):
+            self.model = self.load_shared(model_dir)
+        elif self.model_dict.get('artifact') is not None:
+            self.model = self.load_artifact(model_dir)
+        else:
+            self.model = self.load_checkpoint()
+        self.model_bytes = sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in list(self.model.model.parameters()) + list(self.model.model.buffers())
+        )
+        logger.info(f"Model Loaded, ModelBytes={self.model_bytes}")
+        self.warmup()
+
+        self.image_cache = get_image_cache(self.handler_config)
+        # model_version is part of the result cache key, so results of an older model are never served
+        self.model_version = self.model_dict.get('model_version', os.path.basename(self.model_dict.get('weights')))
+        if self.handler_config.get('result_cache_max_entries') > 0:
+            self.result_cache = ResultCache(
+                max_entries=self.handler_config.get('result_cache_max_entries'),
+                ttl_seconds=self.handler_config.get('result_cache_ttl_seconds'),
+                spill_dir=self.handler_config.get('result_cache_spill_dir'),
+                spill_max_entries=self.handler_config.get('result_cache_spill_max_entries'),
+            )
+
+        self.init_time = time.perf_counter() - start_time
+        self.initialized = True
+        logger.info(f"Initialization Time : {self.init_time:.3f}s")
 
-    def download_image(self, s3_path, local_path, bucket_name):
+    def unload(self):
+        """Releases the model so that its memory can be reclaimed"""
+        self.model = None
+        self.initialized = False
+
+    def build_artifact_model(self, model_dir):
+        """Rebuilds the fused network of the inference artifact from its yaml, without weights"""
+        artifact = self.model_dict.get('artifact')
+        model = ultralytics.YOLO(os.path.join(model_dir, artifact.get('config')), task=artifact.get('task'))
+        model.model.fuse(verbose=False)
+        model.model.names = {int(class_id): name for class_id, name in artifact.get('names').items()}
+        model.model.eval()
+        self.model_dict['params'].setdefault('imgsz', artifact.get('imgsz'))
+        return model
+
+    def load_artifact(self, model_dir):
+        """
+        Loads the inference artifact written by train.export_inference_artifact. The network is
+        rebuilt from its yaml and fused, then the fused state_dict is memory mapped and assigned
+        to the parameters without copying. Half precision weights are copied into float
+        parameters on cpu, which does not support half precision convolutions
+        """
+        artifact = self.model_dict.get('artifact')
+        start_time = time.perf_counter()
+        model = self.build_artifact_model(model_dir)
+        state_dict = torch.load(
+            os.path.join(model_dir, artifact.get('weights')), map_location='cpu', mmap=True, weights_only=True
+        )
+        assign = not (artifact.get('half') and self.device == 'cpu')
+        model.model.load_state_dict(state_dict, assign=assign)
+        logger.info(f"Inference Artifact Loaded in {time.perf_counter() - start_time:.3f}s")
+        return model
+
+    def load_shared(self, model_dir):
+        """
+        Loads the model with weights shared by all MMS workers of the instance. The parameters are
+        memory mapped read-only from a single float state_dict file, so every worker maps the same
+        physical pages instead of holding its own copy:
+         - a float inference artifact is mapped in place, its pages are shared through the page cache
+         - otherwise the first worker writes the fused float weights to shared_weights_dir
+           (tmpfs by default) under a file lock and the other workers map that file
+        Only used on cpu, gpu workers keep their weights on the device. Needs torch >= 2.1 for
+        mmap/assign, older torch falls back to a private copy of the checkpoint per worker
+        """
+        artifact = self.model_dict.get('artifact')
+        if not torch_supports_mmap_load():
+            logger.warning(f"torch {torch.__version__} can not map shared weights, each worker loads its own copy")
+            return self.load_checkpoint()
+        if self.device != 'cpu' or (artifact is not None and not artifact.get('half')):
+            return self.load_artifact(model_dir) if artifact is not None else self.load_checkpoint()
+
+        start_time = time.perf_counter()
+        model = self.build_artifact_model(model_dir) if artifact is not None else self.load_checkpoint()
+        shared_weights_path = self.get_shared_weights_path(model_dir, model)
+        state_dict = torch.load(shared_weights_path, map_location='cpu', mmap=True, weights_only=True)
+        # The private copy of the weights is released once the shared tensors are assigned
+        model.model.load_state_dict(state_dict, assign=True)
+        gc.collect()
+        logger.info(f"Shared Weights Loaded from {shared_weights_path} in {time.perf_counter() - start_time:.3f}s")
+        return model
+
+    def load_checkpoint(self):
+        model = ultralytics.YOLO(self.model_dict.get('weights'))
+        if self.handler_config.get('fuse'):
+            model.fuse()
+        return model
+
+    def get_shared_weights_path(self, model_dir, model):
+        """
+        Returns the float state_dict file shared by the workers, writing it when this worker is the
+        first one. The file name depends on the source weights so a new model never maps stale weights
+        """
+        artifact = self.model_dict.get('artifact')
+        source_path = (
+            os.path.join(model_dir, artifact.get('weights')) if artifact is not None else self.model_dict.get('weights')
+        )
+        source_stat = os.stat(source_path)
+        source_key = f"{os.path.abspath(source_path)}:{source_stat.st_size}:{source_stat.st_mtime_ns}"
+        shared_weights_dir = self.handler_config.get('shared_weights_dir')
+        os.makedirs(shared_weights_dir, exist_ok=True)
+        shared_weights_path = os.path.join(
+            shared_weights_dir, hashlib.sha1(source_key.encode('utf-8')).hexdigest()[:16] + '.pt'
+        )
+
+        with open(shared_weights_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(shared_weights_path):
+                if artifact is not None:
+                    state_dict = torch.load(source_path, map_location='cpu', mmap=True, weights_only=True)
+                else:
+                    state_dict = model.model.state_dict()
+                state_dict = {name: tensor.float() if tensor.is_floating_point() else tensor
+                              for name, tensor in state_dict.items()}
+                temp_path = f"{shared_weights_path}.{os.getpid()}.tmp"
+                torch.save(state_dict, temp_path)
+                os.replace(temp_path, shared_weights_path)
+                logger.info(f"Shared Weights Written : {shared_weights_path}")
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return shared_weights_path
+
+    def warmup(self):
+        """
+        Runs prediction on blank images of the configured sizes so that predictor setup,
+        graph warm-up and allocator growth happen before the first real request
+        """
+        warmup_iterations = self.handler_config.get('warmup_iterations')
+        for height, width in self.handler_config.get('warmup_sizes'):
+            blank_image = np.zeros((height, width, 3), dtype=np.uint8)
+            for _ in range(warmup_iterations):
+                start_time = time.perf_counter()
+                self.model.predict(blank_image, **dict(self.model_dict.get('params'), verbose=False))
+                logger.info(f"Warmup {height}x{width} : {time.perf_counter() - start_time:.3f}s")
+
+    def download_image(self, s3_path, bucket_name):
+        """
+        Fetches the image into memory and returns its encoded bytes along with the s3 ETag.
+        Local paths are read directly, everything else goes through the image cache. A cached
+        object is revalidated with a conditional get_object (IfNoneMatch=ETag), so unchanged
+        objects cost a 304 response instead of a full transfer
+        """
         if os.path.exists(s3_path):
-            return s3_path
-        s3 = boto3.resource('s3')
-        my_bucket = s3.Bucket(bucket_name)
+            with open(s3_path, 'rb') as f:
+                return f.read(), None
+        cached_entry = self.image_cache.get(bucket_name, s3_path)
+        get_args = {'Bucket': bucket_name, 'Key': s3_path}
+        if cached_entry is not None:
+            get_args['IfNoneMatch'] = cached_entry[0]
         try:
-            my_bucket.download_file(s3_path, local_path)
-            logger.info(f"Image Downloaded to {local_path}") 
+            response = self.s3_client.get_object(**get_args)
+            image_bytes = response['Body'].read()
+            logger.info(f"Image Downloaded : {s3_path} ({len(image_bytes)} bytes)")
+        except botocore_exceptions.ClientError as e:
+            if cached_entry is not None and e.response['Error']['Code'] in ['304', 'NotModified']:
+                self.image_cache.record(hit=True)
+                logger.info(f"Image Cache Hit : {s3_path}, ImageCache={self.image_cache.stats()}")
+                return cached_entry[1], cached_entry[0]
+            logger.error(f"Error downloading {s3_path} from {bucket_name}")
+            raise Exception(e)
         except Exception as e:
-            logger.error(f"Error downloading {s3_path} to {local_path}")
+            logger.error(f"Error downloading {s3_path} from {bucket_name}")
             raise Exception(e)
-        return local_path
+        self.image_cache.record(hit=False)
+        self.image_cache.put(bucket_name, s3_path, response.get('ETag'), image_bytes)
+        return image_bytes, response.get('ETag')
+
+    def decode_image(self, image_bytes):
+        """
+        Decodes encoded image bytes into a BGR numpy array without touching the disk.
+        np.frombuffer wraps the response buffer as is, so no copy is made before decoding
+        """
+        image_buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+        image = cv2.imdecode(image_buffer, cv2.IMREAD_COLOR)
+        if image is None:
+            raise Exception(f"Unable to decode image of {len(image_bytes)} bytes")
+        return image
+
+    def format_output(self, model_output, output_format='json', top_k=None):
+        """
+        Converts the model output into the response results
+        params:
+            model_output : ultralytics prediction of a single image
+            output_format : json - list of {"coordinates", "class_id", "confidence"} per box
+                            compact - parallel arrays {"count", "boxes", "class_ids", "confidences"}
+                            where boxes is a flat [x, y, w, h, ...] list of normalized xywh
+            top_k : keep only the top_k most confident boxes when set
+        """
+        return self.format_detections(self.get_detections(model_output[0]), output_format, top_k)
+
+    def get_detections(self, result):
+        """Returns an (N, 6) array of [x, y, w, h, confidence, class_id] with normalized xywh"""
+        boxes = result.boxes
+        # Single device to host copy of boxes, scores and classes
+        return torch.cat([boxes.xywhn, boxes.conf[:, None], boxes.cls[:, None]], dim=1).cpu().numpy()
+
+    def format_detections(self, detections, output_format='json', top_k=None):
+        if top_k is not None and len(detections) > top_k:
+            detections = detections[np.argsort(-detections[:, 4], kind='stable')[:top_k]]
+
+        if output_format == 'compact':
+            return {
+                "count" : len(detections),
+                "boxes" : detections[:, :4].ravel().tolist(),
+                "class_ids" : detections[:, 5].astype(np.int64).tolist(),
+                "confidences" : detections[:, 4].tolist()
+            }
 
-    def format_output(self, model_output):
-        model_output = model_output[0].boxes 
-        bounding_boxes = model_output.xywhn.cpu().tolist()
-        conf_scores = model_output.conf.cpu().tolist()
-        class_ids = model_output.cls.cpu().tolist()
         result_list = []
-        for box, conf, class_id in zip(bounding_boxes, conf_scores, class_ids):
+        for x, y, w, h, conf, class_id in detections.tolist():
             tmp_dict = {
                 "coordinates" : {
-                    "x" : box[0], "y" : box[1], "w" : box[2], "h" : box[3]
+                    "x" : x, "y" : y, "w" : w, "h" : h
                 },
                 "class_id" : int(class_id),
                 "confidence" : conf 
             }
             result_list.append(tmp_dict)
         return result_list
-    
-    def handle(self, data, context):
-        if torch.cuda.is_available():
-            device='cuda'
-        else:
-            device='cpu'
-        logger.info(f"Running Inference")
-        image_dict = json.loads(data[0].get('body'))
-        image_path = image_dict.get('image_path')
+
+    def serialize_output(self, image_dict, context, request_index=0):
+        """
+        Returns the response of a request. Responses are json by default, msgpack when the request
+        accepts MSGPACK_CONTENT_TYPE, in which case compact boxes are sent as float32 bytes
+        """
+        accept = get_request_header(context, 'Accept', request_index) or ''
+        if MSGPACK_CONTENT_TYPE not in accept:
+            return image_dict
+        import msgpack
+
+        results = image_dict.get('results')
+        if isinstance(results, dict):
+            results = dict(results, boxes=np.asarray(results['boxes'], dtype='<f4').tobytes())
+            image_dict = dict(image_dict, results=results)
+        set_response_content_type(context, MSGPACK_CONTENT_TYPE, request_index)
+        return msgpack.packb(image_dict, use_bin_type=True)
+
+    def parse_request(self, request, context, request_index=0, timer=None):
+        """
+        Extracts the request dictionary and the encoded image bytes from a request of the batch.
+        Supported inputs:
+            - raw image body with Content-Type in RAW_IMAGE_CONTENT_TYPES, parameters are read
+              from the X-Amzn-SageMaker-Custom-Attributes header
+            - json body with a base64 encoded "image" field
+            - json body with "image_path" and "bucket_name", the image is fetched from s3
+        returns:
+            image_dict : request parameters which are echoed back in the response
+            image_bytes : encoded image bytes
+            content_key : identifier of the image content, the s3 ETag when available
+                          otherwise a hash of the image bytes
+        """
+        body = request.get('body') or request.get('data')
+        content_type = get_request_header(context, 'Content-Type', request_index) or ''
+        content_type = content_type.split(';')[0].strip().lower()
+        if content_type in RAW_IMAGE_CONTENT_TYPES:
+            custom_attributes = get_request_header(
+                context, 'X-Amzn-SageMaker-Custom-Attributes', request_index
+            )
+            image_dict = parse_custom_attributes(custom_attributes)
+            return image_dict, body, self.get_content_key(body)
+
+        image_dict = json.loads(body)
+        if image_dict.get('video_path') is not None or image_dict.get('frames_prefix') is not None:
+            # Frame sequences are decoded lazily by handle_video
+            return image_dict, None, None
+        if image_dict.get('image') is not None:
+            # Do not echo the encoded image back in the response
+            image_bytes = base64.b64decode(image_dict.pop('image'))
+            return image_dict, image_bytes, self.get_content_key(image_bytes)
+
+        timer = timer if timer is not None else StageTimer()
+        with timer.stage('download'):
+            image_bytes, etag = self.download_image(
+                s3_path=image_dict.get('image_path'),
+                bucket_name=image_dict.get('bucket_name')
+            )
+        content_key = f"etag:{etag}" if etag is not None else self.get_content_key(image_bytes)
+        return image_dict, image_bytes, content_key
+
+    def get_content_key(self, image_bytes):
+        return "blake2b:" + hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+    def get_result_cache_key(self, content_key, params, options):
+        """
+        Cache key of a prediction : image content, model version, options and every parameter a
+        request can override (REQUEST_PARAMS), so e.g. a classes filtered result is never served
+        to an unfiltered request
+        """
+        key_params = {name: params.get(name) for name in REQUEST_PARAMS}
+        return json.dumps([content_key, self.model_version, key_params, options], sort_keys=True)
+
+    def get_request_options(self, image_dict):
+        """Output and tiling options of a request, tiling defaults come from handler_config"""
+        options = {
+            "output_format": image_dict.get('output_format', 'json'),
+            "top_k": image_dict.get('top_k'),
+        }
+        assert options["output_format"] in OUTPUT_FORMATS, f"output_format must be one of {OUTPUT_FORMATS}"
+        for name in TILE_OPTIONS:
+            value = image_dict.get(name)
+            options[name] = value if value is not None else self.handler_config.get(name)
+        tile_size, tile_overlap = options['tile_size'], options['tile_overlap']
+        assert isinstance(tile_size, int) and not isinstance(tile_size, bool) and tile_size > 0, \
+            f"tile_size must be a positive integer, got {tile_size}"
+        assert isinstance(tile_overlap, (int, float)) and 0 <= tile_overlap < 1, \
+            f"tile_overlap must be in [0, 1), got {tile_overlap}"
+        return options
+
+    def get_inference_params(self, image_dict):
+        """
+        Returns the predict parameters of a request : the "params" of model.json overridden by
+        REQUEST_PARAMS present in the request. The shared model_dict is never modified
+        """
+        overrides = {
+            name: image_dict.get(name) for name in REQUEST_PARAMS if image_dict.get(name) is not None
+        }
+        return dict(self.model_dict.get('params'), **overrides)
+
+    def predict(self, image, params):
+        with self.predict_lock:
+            return self.model.predict(image, **params)
+
+    def predict_tiled(self, image, params, tile_size, tile_overlap):
+        """
+        Sliced inference for high resolution images. The image is split into overlapping
+        tile_size tiles (numpy views, no copies) which are predicted in batches of tile_batch_size.
+        Boxes are shifted back to image coordinates and merged across tiles with class aware NMS.
+        Images needing more than max_tiles tiles (handler_config) are rejected
+        returns:
+            detections : (N, 6) array of [x, y, w, h, confidence, class_id] with normalized xywh
+        """
+        height, width = image.shape[:2]
+        y_offsets = get_tile_offsets(height, tile_size, tile_overlap)
+        x_offsets = get_tile_offsets(width, tile_size, tile_overlap)
+        max_tiles = self.handler_config.get('max_tiles')
+        if max_tiles and len(y_offsets) * len(x_offsets) > max_tiles:
+            raise Exception(
+                f"{len(y_offsets) * len(x_offsets)} tiles of {tile_size} for a {width}x{height} image, "
+                f"more than max_tiles={max_tiles}, use a larger tile_size or a smaller tile_overlap"
+            )
+        tiles, offsets = [], []
+        for y in y_offsets:
+            for x in x_offsets:
+                tiles.append(image[y:y + tile_size, x:x + tile_size])
+                offsets.append([x, y, x, y])
+
+        tile_params = dict(params, imgsz=tile_size)
+        tile_batch_size = self.handler_config.get('tile_batch_size')
+        boxes, scores, class_ids = [], [], []
+        for start in range(0, len(tiles), tile_batch_size):
+            model_outputs = self.predict(tiles[start:start + tile_batch_size], tile_params)
+            for offset, result in zip(offsets[start:start + tile_batch_size], model_outputs):
+                result_boxes = result.boxes
+                boxes.append(result_boxes.xyxy + result_boxes.xyxy.new_tensor(offset))
+                scores.append(result_boxes.conf)
+                class_ids.append(result_boxes.cls)
+        boxes, scores, class_ids = torch.cat(boxes), torch.cat(scores), torch.cat(class_ids)
+
+        keep = torchvision.ops.batched_nms(
+            boxes, scores, class_ids.long(), self.handler_config.get('tile_nms_iou')
+        )
+        boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+        scale = boxes.new_tensor([width, height, width, height])
+        xywhn = torch.cat([(boxes[:, :2] + boxes[:, 2:]) / 2, boxes[:, 2:] - boxes[:, :2]], dim=1) / scale
+        logger.info(f"Tiled Inference : {len(tiles)} tiles of {tile_size}, {len(keep)} boxes after NMS")
+        return torch.cat([xywhn, scores[:, None], class_ids[:, None]], dim=1).cpu().numpy()
+
+    def iter_video_frames(self, video_path, bucket_name, frame_stride, max_frames):
+        """
+        Yields (frame_index, timestamp_ms, frame) of a video, decoding one frame at a time.
+        S3 videos are streamed by ffmpeg through a presigned url instead of being downloaded,
+        skipped frames are only grabbed and never decoded
+        """
+        if not os.path.exists(video_path):
+            video_path = self.s3_client.generate_presigned_url(
+                'get_object', Params={'Bucket': bucket_name, 'Key': video_path}, ExpiresIn=3600
+            )
+        capture = cv2.VideoCapture(video_path)
+        if not capture.isOpened():
+            raise Exception(f"Unable to open video {video_path.split('?')[0]}")
+        frame_index, yielded = 0, 0
+        try:
+            while max_frames is None or yielded < max_frames:
+                if not capture.grab():
+                    break
+                if frame_index % frame_stride == 0:
+                    ok, frame = capture.retrieve()
+                    if not ok:
+                        break
+                    yield frame_index, capture.get(cv2.CAP_PROP_POS_MSEC), frame
+                    yielded += 1
+                frame_index += 1
+        finally:
+            capture.release()
+
+    def iter_prefix_frames(self, frames_prefix, bucket_name, frame_stride, max_frames, batch_size):
+        """
+        Yields (frame_index, None, frame) of the images under an s3 prefix in key order.
+        Listing is paginated and each batch of batch_size images is fetched concurrently,
+        so memory stays bounded regardless of the number of frames
+        """
+        def fetch(key):
+            return self.decode_image(self.download_image(s3_path=key, bucket_name=bucket_name)[0])
+
+        def iter_keys():
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            image_index = 0
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=frames_prefix):
+                for s3_object in page.get('Contents', []):
+                    if s3_object['Key'].split('.')[-1].lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    if image_index % frame_stride == 0:
+                        yield image_index, s3_object['Key']
+                    image_index += 1
+
+        # A dedicated pool, the handler pool may be busy running this very request
+        with ThreadPoolExecutor(max_workers=batch_size, thread_name_prefix='frames') as fetch_executor:
+            yielded = 0
+            batch = []
+            for frame_index, key in iter_keys():
+                if max_frames is not None and yielded + len(batch) >= max_frames:
+                    break
+                batch.append((frame_index, key))
+                if len(batch) < batch_size:
+                    continue
+                yield from self._fetch_frames(batch, fetch, fetch_executor)
+                yielded += len(batch)
+                batch = []
+            if batch:
+                yield from self._fetch_frames(batch, fetch, fetch_executor)
+
+    def _fetch_frames(self, batch, fetch, fetch_executor):
+        frames = fetch_executor.map(fetch, [key for _, key in batch])
+        for (frame_index, _), frame in zip(batch, frames):
+            yield frame_index, None, frame
+
+    def predict_frames(self, frames, params, options, batch_size):
+        """Predicts frames batch_size at a time and yields the results of every frame"""
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) == batch_size:
+                yield from self._predict_frame_batch(batch, params, options)
+                batch = []
+        if batch:
+            yield from self._predict_frame_batch(batch, params, options)
+
+    def _predict_frame_batch(self, batch, params, options):
+        model_outputs = self.predict([frame for _, _, frame in batch], params)
+        for (frame_index, timestamp_ms, _), result in zip(batch, model_outputs):
+            frame_result = {
+                "frame" : frame_index,
+                "results" : self.format_detections(
+                    self.get_detections(result), output_format=options['output_format'], top_k=options['top_k']
+                )
+            }
+            if timestamp_ms is not None:
+                frame_result["timestamp_ms"] = timestamp_ms
+            yield frame_result
+
+    def handle_video(self, image_dict):
+        """
+        Inference over a video ("video_path") or an ordered sequence of frames ("frames_prefix").
+        Optional request fields : frame_stride, max_frames, batch_size and output_path. Per frame
+        results are returned in "results", or streamed as json lines to output_path in the bucket
+        when it is set so that the response size does not grow with the clip length. Without
+        output_path, results beyond video_max_inline_frames are streamed to a new object under
+        video_output_prefix in the request bucket, whose key is returned in "output_path"
+        """
+        params = self.get_inference_params(image_dict)
+        options = self.get_request_options(image_dict)
         bucket_name = image_dict.get('bucket_name')
-        conf = image_dict.get('conf')
+        frame_stride = image_dict.get('frame_stride') or self.handler_config.get('video_frame_stride')
+        max_frames = image_dict.get('max_frames') or self.handler_config.get('video_max_frames')
+        batch_size = image_dict.get('batch_size') or self.handler_config.get('video_batch_size')
 
-        local_path = os.path.join(curr_dir, os.path.basename(image_path))
-        local_path = self.download_image(s3_path=image_path, local_path=local_path, bucket_name=bucket_name)
+        if image_dict.get('video_path') is not None:
+            frames = self.iter_video_frames(image_dict.get('video_path'), bucket_name, frame_stride, max_frames)
+        else:
+            frames = self.iter_prefix_frames(
+                image_dict.get('frames_prefix'), bucket_name, frame_stride, max_frames, batch_size
+            )
 
-        self.model_dict['params']['conf'] = conf
-        self.model_dict['params']['device'] = device
-        model_output = self.model.predict(local_path, **self.model_dict.get('params'))
-        model_output = self.format_output(model_output)
-        image_dict['results'] = model_output
+        output_path = image_dict.get('output_path')
+        writer = S3MultipartWriter(self.s3_client, bucket_name, output_path) if output_path else None
+        max_inline_frames = self.handler_config.get('video_max_inline_frames')
+        frame_results = []
+        frames_processed = 0
+        try:
+            for frame_result in self.predict_frames(frames, params, options, batch_size):
+                frames_processed += 1
+                if writer is None and len(frame_results) >= max_inline_frames:
+                    # Too many frames for the response, the results move to s3 so memory stays bounded
+                    if bucket_name is None:
+                        raise Exception(f"More than {max_inline_frames} frames, set bucket_name and output_path")
+                    output_path = f"{self.handler_config.get('video_output_prefix').rstrip('/')}/{uuid.uuid4().hex}.jsonl"
+                    writer = S3MultipartWriter(self.s3_client, bucket_name, output_path)
+                    for buffered_result in frame_results:
+                        writer.write(json.dumps(buffered_result) + '\n')
+                    frame_results = []
+                    image_dict['output_path'] = output_path
+                if writer is not None:
+                    writer.write(json.dumps(frame_result) + '\n')
+                else:
+                    frame_results.append(frame_result)
+        except Exception:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.close()
+            logger.info(f"Frame Results Uploaded : s3://{bucket_name}/{output_path}")
 
-        os.remove(local_path)
+        logger.info(f"Video Inference : {frames_processed} frames")
+        image_dict['frames_processed'] = frames_processed
+        image_dict['results'] = frame_results
         return image_dict
+
+    def handle_request(self, request, context, request_index=0):
+        """
+        Runs inference for a single request and records its stage timings in the process metrics.
+        Timings are added to the response as "timings" when include_timings is set in the
+        request or in handler_config. Stages are in milliseconds, "parse" includes "download"
+        and "predict" includes the predict_preprocess/inference/postprocess split of ultralytics
+        """
+        timer = StageTimer()
+        try:
+            image_dict = self._handle_request(request, context, request_index, timer)
+        except Exception:
+            _metrics.record_error()
+            raise
+        timer.add('total', timer.total())
+        _metrics.record(timer.timings, cached=image_dict.get('cached', False))
+        if image_dict.get('include_timings', self.handler_config.get('include_timings')):
+            image_dict['timings'] = {name: round(value, 3) for name, value in timer.timings.items()}
+        return image_dict
+
+    def _handle_request(self, request, context, request_index, timer):
+        with timer.stage('parse'):
+            image_dict, image_bytes, content_key = self.parse_request(request, context, request_index, timer)
+        if image_bytes is None:
+            with timer.stage('video'):
+                return self.handle_video(image_dict)
+        params = self.get_inference_params(image_dict)
+        options = self.get_request_options(image_dict)
+
+        cache_key = None
+        if self.result_cache is not None:
+            with timer.stage('result_cache'):
+                cache_key = self.get_result_cache_key(content_key, params, options)
+                cached_results = self.result_cache.get(cache_key)
+            if cached_results is not None:
+                logger.info(f"Result Cache Hit, ResultCache={self.result_cache.stats()}")
+                image_dict['results'] = cached_results
+                image_dict['cached'] = True
+                return image_dict
+
+        with timer.stage('decode'):
+            image = self.decode_image(image_bytes)
+        if options['tiled']:
+            with timer.stage('predict'):
+                detections = self.predict_tiled(
+                    image, params, tile_size=options['tile_size'], tile_overlap=options['tile_overlap']
+                )
+            with timer.stage('format'):
+                model_output = self.format_detections(
+                    detections, output_format=options['output_format'], top_k=options['top_k']
+                )
+        else:
+            with timer.stage('predict'):
+                model_output = self.predict(image, params)
+            # Split of the predict time measured by ultralytics, in milliseconds
+            for name, milliseconds in (model_output[0].speed or {}).items():
+                if milliseconds is not None:
+                    timer.add(f"predict_{name}", milliseconds)
+            with timer.stage('format'):
+                model_output = self.format_output(
+                    model_output, output_format=options['output_format'], top_k=options['top_k']
+                )
+        if cache_key is not None:
+            self.result_cache.put(cache_key, model_output)
+        image_dict['results'] = model_output
+        image_dict['cached'] = False
+        return image_dict
+
+    def handle(self, data, context):
+        """
+        Runs inference for every request of the batch and returns the outputs in order.
+        MMS is started with a batch size of 1 (config.properties registers the model through
+        load_models=ALL), so under MMS every call has a single request and requests overlap by
+        running several workers. async_server.py calls handle concurrently from its own executor,
+        the requests then share the model and only the forward pass is serialized
+        """
+        logger.info(f"Running Inference")
+        return [
+            self.handle_request(request, context, request_index)
+            for request_index, request in enumerate(data)
+        ]
     
-_service = ModelHandler()
+class ModelRegistry(object):
+    """
+    Keeps several models loaded in a worker keyed by model directory.
+    Models are loaded lazily on first use and the least recently used models are evicted once
+    the memory of the loaded models exceeds memory_budget_bytes. Before loading, the weights file
+    size is used as an estimate so that room is made before the new model is allocated.
+    Requests hold a lease on their model, only models without a request in flight are evicted;
+    when every candidate is leased the budget is exceeded until a lease is released.
+    Only effective when one process serves several models (the /models API of async_server.py),
+    under MMS every target model gets its own workers
+    """
+    def __init__(self, memory_budget_bytes=0):
+        self.memory_budget_bytes = memory_budget_bytes
+        self.loads = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.evict_time = 0.0
+        self._handlers = OrderedDict()
+        self._leases = {}
+        self._load_locks = {}
+        self._pending_unloads = set()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, model_dir, gpu_id=None):
+        """Yields (handler, loaded) and keeps the handler loaded until the block exits"""
+        handler, loaded = self.get(model_dir, gpu_id=gpu_id, lease=True)
+        try:
+            yield handler, loaded
+        finally:
+            with self._lock:
+                self._leases[model_dir] -= 1
+                if self._leases[model_dir] == 0:
+                    del self._leases[model_dir]
+                    if model_dir in self._pending_unloads:
+                        self._pending_unloads.discard(model_dir)
+                        self._remove(model_dir)
+                    self._evict(reserve_bytes=0)
+
+    def get(self, model_dir, gpu_id=None, lease=False):
+        """
+        Returns (handler, loaded) where loaded tells whether the model was loaded by this call.
+        With lease=True the caller must release the lease, use lease() instead
+        """
+        with self._lock:
+            handler = self._handlers.get(model_dir)
+            if handler is not None:
+                self._handlers.move_to_end(model_dir)
+                self._pending_unloads.discard(model_dir)
+                if lease:
+                    self._leases[model_dir] = self._leases.get(model_dir, 0) + 1
+                return handler, False
+            load_lock = self._load_locks.setdefault(model_dir, threading.Lock())
+
+        with load_lock:
+            with self._lock:
+                handler = self._handlers.get(model_dir)
+                if handler is not None:
+                    if lease:
+                        self._leases[model_dir] = self._leases.get(model_dir, 0) + 1
+                    return handler, False
+                self._evict(reserve_bytes=self._estimate_model_bytes(model_dir))
+
+            start_time = time.perf_counter()
+            handler = ModelHandler()
+            handler.load(model_dir=model_dir, gpu_id=gpu_id)
+            load_time = time.perf_counter() - start_time
+
+            with self._lock:
+                self._handlers[model_dir] = handler
+                if lease:
+                    self._leases[model_dir] = self._leases.get(model_dir, 0) + 1
+                self.loads += 1
+                self.load_time += load_time
+                self._evict(reserve_bytes=0)
+            logger.info(f"Model Cache Load : {model_dir} in {load_time:.3f}s, ModelCache={self.stats()}")
+            return handler, True
+
+    def unload(self, model_dir):
+        """
+        Unloads a model right away, or once its last lease is released when requests are in flight.
+        Returns False when the model was not loaded
+        """
+        with self._lock:
+            if model_dir not in self._handlers:
+                return False
+            if model_dir in self._leases:
+                self._pending_unloads.add(model_dir)
+            else:
+                self._remove(model_dir)
+        logger.info(f"Model Cache Unload : {model_dir}, ModelCache={self.stats()}")
+        return True
+
+    def _remove(self, model_dir):
+        """Unloads a model and reclaims its memory, returns the handler. Needs _lock"""
+        handler = self._handlers.pop(model_dir)
+        handler.unload()
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return handler
+
+    def _estimate_model_bytes(self, model_dir):
+        try:
+            model_dict = json.load(open(os.path.join(model_dir, 'model.json')))
+            return os.path.getsize(os.path.join(model_dir, model_dict.get('weights')))
+        except Exception:
+            return 0
+
+    def _evict(self, reserve_bytes):
+        """Evicts least recently used models until the budget fits reserve_bytes more. Needs _lock"""
+        if self.memory_budget_bytes <= 0:
+            return
+        while self._handlers:
+            used_bytes = sum(handler.model_bytes for handler in self._handlers.values())
+            if used_bytes + reserve_bytes <= self.memory_budget_bytes:
+                return
+            if reserve_bytes == 0 and len(self._handlers) == 1:
+                # Never evict the only loaded model, even if it alone exceeds the budget
+                return
+            # Least recently used model without a request in flight
+            model_dir = next((name for name in self._handlers if name not in self._leases), None)
+            if model_dir is None:
+                return
+            start_time = time.perf_counter()
+            handler = self._remove(model_dir)
+            evict_time = time.perf_counter() - start_time
+            self.evictions += 1
+            self.evict_time += evict_time
+            logger.info(f"Model Cache Evict : {model_dir} ({handler.model_bytes} bytes) in {evict_time:.3f}s")
+
+    def stats(self):
+        return {
+            "models": list(self._handlers.keys()),
+            "model_bytes": sum(handler.model_bytes for handler in self._handlers.values()),
+            "memory_budget_bytes": self.memory_budget_bytes,
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "load_time": round(self.load_time, 3),
+            "evict_time": round(self.evict_time, 3),
+        }
+
+
+_registry = ModelRegistry(memory_budget_bytes=MODEL_CACHE_MEMORY_MB * 1024 * 1024)
+_metrics = LatencyMetrics()
+
+
+def get_metrics():
+    """Latency percentiles, counters and cache statistics of the worker"""
+    metrics = _metrics.summary()
+    metrics["model_cache"] = _registry.stats()
+    if _image_cache is not None:
+        metrics["image_cache"] = _image_cache.stats()
+    return metrics
+
+
+def unload_model(model_dir):
+    """Unloads the model of model_dir from the worker, used by the multi-model API of async_server.py"""
+    return _registry.unload(model_dir)
+
 
 def handle(data, context):
-    logger.info(f"Request Received\nData={data}\nContext={context}")
-    is_initialized = 'no'
-    if not _service.initialized:
-        _service.initialize(context)
-        is_initialized = 'yes'
+    if data is not None:
+        # Bodies may carry the encoded image, so only the size is logged
+        body_size = len(data[0].get('body') or data[0].get('data') or b'')
+        logger.info(f"Request Received\nBodySize={body_size}\nContext={context}")
+    with _registry.lease(
+        model_dir=resolve_model_dir(context),
+        gpu_id=context.system_properties.get("gpu_id")
+    ) as (service, loaded):
+        is_initialized = 'yes' if loaded else 'no'
 
-    if data is None:
-        return None
-    
-    out = _service.handle(data, context)
-    out['is_initalized'] = is_initialized
-    return [out]
+        if data is None:
+            return None
+
+        outputs = service.handle(data, context)
+    for out in outputs:
+        out['is_initalized'] = is_initialized
+    if _metrics.should_log(METRICS_LOG_INTERVAL_SECONDS):
+        logger.info(f"Metrics={json.dumps(get_metrics())}")
+    return [
+        service.serialize_output(out, context, request_index)
+        for request_index, out in enumerate(outputs)
+    ]
 
 if __name__ == '__main__':
     import json
@@ -0,0 +1,73 @@
+"""
+Import-time profile of the inference handler.
+Imports model_handler in a fresh interpreter with `python -X importtime`, reports the total import
+time and the slowest top level imports, and measures the cost of each heavy dependency that the
+handler defers until first use (the time a worker now saves before its first ping).
+
+usage:
+    cd inference
+    python profile_imports.py --top 15
+"""
+import os
+import sys
+import argparse
+import subprocess
+
+curr_dir = os.path.abspath(os.path.dirname(__file__))
+
+# Dependencies imported lazily by model_handler
+DEFERRED_MODULES = ['loguru', 'numpy', 'cv2', 'boto3', 'torch', 'torchvision', 'ultralytics']
+
+
+def parse_importtime(stderr):
+    """
+    Parses the `-X importtime` output into a list of (module, self_us, cumulative_us, depth).
+    Depth is the nesting level of the import, 0 for imports done by the profiled statement
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def profile_handler_import(top):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import model_handler'],
+        cwd=curr_dir, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(f"Importing model_handler failed\n{result.stderr[-2000:]}")
+    imports = parse_importtime(result.stderr)
+    total_us = next(cumulative_us for name, _, cumulative_us, _ in imports if name == 'model_handler')
+    print(f"import model_handler : {total_us / 1000:.1f} ms, {len(imports)} modules")
+    print("Slowest imports (cumulative):")
+    slowest = sorted(imports, key=lambda entry: entry[2], reverse=True)[:top]
+    for name, self_us, cumulative_us, depth in slowest:
+        print(f"  {cumulative_us / 1000:9.1f} ms  {'  ' * depth}{name}")
+
+
+def profile_deferred_imports():
+    print("Deferred imports (paid on first use, measured in a fresh interpreter):")
+    for module_name in DEFERRED_MODULES:
+        code = (
+            "import time; start = time.perf_counter(); "
+            f"import {module_name}; print((time.perf_counter() - start) * 1000)"
+        )
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"  {'n/a':>9}     {module_name} (not installed)")
+            continue
+        print(f"  {float(result.stdout.strip()):9.1f} ms  {module_name}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to report')
+    args = parser.parse_args()
+
+    profile_handler_import(top=args.top)
+    profile_deferred_imports()
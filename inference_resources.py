@@ -3,11 +3,15 @@ import os
 import argparse
 import boto3
 import time
+from botocore.exceptions import ClientError
 
 sm_client = boto3.client(service_name="sagemaker", region_name="ap-southeast-1")
 
+# Endpoint types served by instances, the ones Application Auto Scaling can scale
+AUTOSCALING_ENDPOINT_TYPES = ["real-time-endpoint", "multi-model-endpoint", "async-endpoint"]
 
-def create_model(model_name, ecr_image, model_uri, role, multi_model=True):
+
+def create_model(model_name, ecr_image, model_uri, role, multi_model=True, environment=None):
     """
     This will create a model object for the endpoint. The model endpoint basically contains following attributes
      - model_name : Name of the model object
@@ -17,6 +21,9 @@ def create_model(model_name, ecr_image, model_uri, role, multi_model=True):
     additional parameters :
         - role : iam role to be used
         - multi_model : Boolean to indicate whether to use multi-model or single model
+        - environment : environment variables of the container, e.g. SAGEMAKER_SERVER_MODE=asyncio and
+          MODEL_CACHE_MEMORY_MB (the model budget only applies when one process serves several models).
+          MultiModel containers also get SAGEMAKER_MULTI_MODEL=true
 
     To change the default environment variables for async endpoint for timeouts and request/response size
     edit the container :
@@ -43,6 +50,10 @@ def create_model(model_name, ecr_image, model_uri, role, multi_model=True):
             "ModelDataUrl": model_uri,
             "Mode": "MultiModel",
         }
+        # The model server loads the target models through the multi-model API instead of /opt/ml/model
+        environment = {"SAGEMAKER_MULTI_MODEL": "true", **(environment or {})}
+    if environment:
+        container["Environment"] = environment
 
     response = sm_client.create_model(
         ModelName=model_name,
@@ -52,6 +63,18 @@ def create_model(model_name, ecr_image, model_uri, role, multi_model=True):
     print("{} Model Created".format(model_name))
 
 
+def create_model_for_endpoint(endpoint_config, endpoint_type):
+    """Creates the model object of endpoint_config, multi-model endpoints use a MultiModel container"""
+    create_model(
+        model_name=endpoint_config.get("model_name"),
+        ecr_image=endpoint_config.get("container_uri"),
+        model_uri=endpoint_config.get("model_uri"),
+        role=endpoint_config.get("iam_role"),
+        multi_model=endpoint_type == "multi-model-endpoint",
+        environment=endpoint_config.get("environment"),
+    )
+
+
 def get_real_time_config(endpoint_config):
     """
     Creates Product configuration for real-time enpoint
@@ -65,7 +88,7 @@ def get_real_time_config(endpoint_config):
         "InitialInstanceCount": endpoint_config.get("instance_count"),
         "InitialVariantWeight": 1,
         "ModelName": endpoint_config.get("model_name"),
-        "VariantName": "Variant1",
+        "VariantName": endpoint_config.get("variant_name", "Variant1"),
     }
     return config
 
@@ -264,36 +287,345 @@ def create_endpoint(endpoint_name, config_name):
     print("Endpoint Creation Time : {}".format(time.time() - start))
 
 
-def delete_resources(endpoint_name, config_name, model_name, aws_region):
+def get_deployment_config(endpoint_config):
+    """
+    Creates the blue/green DeploymentConfig of update_endpoint from the optional "deployment_config"
+    of endpoint_config. The new fleet is provisioned next to the old one and traffic is shifted
+     - ALL_AT_ONCE : all traffic at once after the new fleet is healthy
+     - CANARY : canary_size_percent of the capacity first, the rest after wait_interval_seconds
+     - LINEAR : linear_step_percent of the capacity every wait_interval_seconds
+    The old fleet is kept for termination_wait_seconds. When rollback_alarms (CloudWatch alarm names)
+    fire during the deployment, SageMaker shifts the traffic back to the old fleet
+    Refer : https://docs.aws.amazon.com/sagemaker/latest/dg/deployment-guardrails-blue-green.html
+    """
+    deployment_config = endpoint_config.get("deployment_config") or {}
+    traffic_routing = deployment_config.get("traffic_routing", "ALL_AT_ONCE")
+    routing_config = {
+        "Type": traffic_routing,
+        "WaitIntervalInSeconds": deployment_config.get("wait_interval_seconds", 0),
+    }
+    if traffic_routing == "CANARY":
+        routing_config["CanarySize"] = {
+            "Type": "CAPACITY_PERCENT",
+            "Value": deployment_config.get("canary_size_percent", 10),
+        }
+    elif traffic_routing == "LINEAR":
+        routing_config["LinearStepSize"] = {
+            "Type": "CAPACITY_PERCENT",
+            "Value": deployment_config.get("linear_step_percent", 20),
+        }
+    config = {
+        "BlueGreenUpdatePolicy": {
+            "TrafficRoutingConfiguration": routing_config,
+            "TerminationWaitInSeconds": deployment_config.get("termination_wait_seconds", 0),
+            "MaximumExecutionTimeoutInSeconds": deployment_config.get("max_execution_timeout_seconds", 3600),
+        }
+    }
+    if deployment_config.get("rollback_alarms"):
+        config["AutoRollbackConfiguration"] = {
+            "Alarms": [{"AlarmName": alarm_name} for alarm_name in deployment_config.get("rollback_alarms")]
+        }
+    return config
+
+
+def wait_for_endpoint(endpoint_name, timeout_seconds=3600, initial_interval=5, max_interval=60):
+    """
+    Polls describe_endpoint until the endpoint leaves the Creating/Updating/RollingBack states.
+    The interval starts at initial_interval seconds and doubles up to max_interval
+    returns:
+        the last describe_endpoint response
+    """
+    start = time.time()
+    interval = initial_interval
+    while True:
+        resp = sm_client.describe_endpoint(EndpointName=endpoint_name)
+        status = resp["EndpointStatus"]
+        if status not in ["Creating", "Updating", "SystemUpdating", "RollingBack"]:
+            return resp
+        if time.time() - start > timeout_seconds:
+            print(f"Timed out waiting for {endpoint_name}, status : {status}")
+            return resp
+        print(f"Endpoint Status : {status}, checking again in {interval}s")
+        time.sleep(interval)
+        interval = min(max_interval, interval * 2)
+
+
+def update_endpoint(endpoint_config, endpoint_type):
     """
-    Function to delete endpoint related resources
-     - endpoint
-     - endpoint configuration
-     - model object
-     parameters:
-        endpoint_name - name of the endpoint
-        config_name - name of the endpoint configuration
-        model_name - name of the model object
-        aws_region - AWS region in which the endpoint is hosted
+    Blue/green rollout of a new model on an existing endpoint without downtime.
+     - A new model object and endpoint configuration are created next to the current ones, named
+       model_name/config_name with a version suffix
+     - update_endpoint switches the endpoint to the new configuration, the current fleet keeps
+       serving until the new one is healthy (traffic shifting follows deployment_config)
+     - If the update fails or times out, the endpoint is switched back to the previous configuration
+       and the new model and configuration are deleted, as they are when the update can not be started
+    The previous model and configuration are kept for manual rollback unless
+    deployment_config.delete_previous is set, the ones already deleted are skipped. With autoscaling_config, the variant is registered
+    with Application Auto Scaling again once the update is over
     """
-    sagemaker_client = boto3.client("sagemaker", region_name=aws_region)
+    endpoint_name = endpoint_config.get("endpoint_name")
+    deployment_config = endpoint_config.get("deployment_config") or {}
+    current_endpoint = sm_client.describe_endpoint(EndpointName=endpoint_name)
+    assert current_endpoint["EndpointStatus"] == "InService", f"{endpoint_name} is {current_endpoint['EndpointStatus']}, expected InService"
+    autoscaling_enabled = endpoint_config.get("autoscaling_config") and endpoint_type in AUTOSCALING_ENDPOINT_TYPES
+    if autoscaling_enabled:
+        target_value = validate_autoscaling_config(endpoint_config, endpoint_type)
+    previous_config_name = current_endpoint["EndpointConfigName"]
+    previous_models = get_config_models(previous_config_name)
+
+    version = time.strftime("%Y%m%d-%H%M%S")
+    new_config = dict(
+        endpoint_config,
+        model_name=f"{endpoint_config.get('model_name')}-{version}"[:63],
+        config_name=f"{endpoint_config.get('config_name')}-{version}"[:63],
+    )
+    current_instance_count = max(
+        [variant.get("CurrentInstanceCount", 0) for variant in current_endpoint.get("ProductionVariants", [])] + [0]
+    )
+    if endpoint_type in AUTOSCALING_ENDPOINT_TYPES and current_instance_count > new_config.get("instance_count", 0):
+        # Start the new fleet at the capacity autoscaling has reached instead of instance_count
+        new_config["instance_count"] = current_instance_count
+        print(f"New fleet starts with the current {current_instance_count} instances")
+    create_model_for_endpoint(new_config, endpoint_type)
     try:
-        sagemaker_client.delete_endpoint(EndpointName=endpoint_name)
-        print(f"Endpoint Deleted : {endpoint_name}")
-    except Exception as e:
-        print(e)
+        create_config(new_config, endpoint_type=endpoint_type)
+    except Exception:
+        delete_config_and_models(None, [new_config.get("model_name")])
+        raise
+
+    update_args = {"EndpointName": endpoint_name, "EndpointConfigName": new_config.get("config_name")}
+    if endpoint_type != "serverless-endpoint":
+        # Blue/green deployment guardrails are not supported for serverless endpoints
+        update_args["DeploymentConfig"] = get_deployment_config(endpoint_config)
+    if autoscaling_enabled:
+        # The variant is deregistered from autoscaling while the endpoint is updated and registered again after
+        remove_autoscaling(endpoint_config)
+    try:
+        start = time.time()
+        print(f"Updating {endpoint_name} : {previous_config_name} -> {new_config.get('config_name')}")
+        try:
+            sm_client.update_endpoint(**update_args)
+        except Exception:
+            print(f"Update of {endpoint_name} was not started, deleting {new_config.get('config_name')}")
+            delete_config_and_models(new_config.get("config_name"), [new_config.get("model_name")])
+            raise
+        resp = wait_for_endpoint(endpoint_name, timeout_seconds=deployment_config.get("wait_timeout_seconds", 3600))
+
+        if resp["EndpointStatus"] == "InService" and resp["EndpointConfigName"] == new_config.get("config_name"):
+            print(f"Endpoint Updated to {new_config.get('config_name')} in {time.time() - start:.0f}s")
+            if deployment_config.get("delete_previous"):
+                delete_config_and_models(previous_config_name, previous_models)
+            else:
+                print(f"Previous configuration kept for rollback : {previous_config_name}, models : {previous_models}")
+            return new_config
+
+        print(f"Endpoint Update Failed, status : {resp['EndpointStatus']}, reason : {resp.get('FailureReason')}")
+        if resp["EndpointStatus"] != "InService" or resp["EndpointConfigName"] != previous_config_name:
+            print(f"Rolling back {endpoint_name} to {previous_config_name}")
+            if resp["EndpointStatus"] in ["Updating", "SystemUpdating"]:
+                wait_for_endpoint(endpoint_name)
+            sm_client.update_endpoint(EndpointName=endpoint_name, EndpointConfigName=previous_config_name)
+            resp = wait_for_endpoint(endpoint_name)
+            print(f"Endpoint Status after rollback : {resp['EndpointStatus']}")
+        delete_config_and_models(new_config.get("config_name"), [new_config.get("model_name")])
+        raise Exception(f"Update of {endpoint_name} failed, serving {resp['EndpointConfigName']}")
+    finally:
+        if autoscaling_enabled:
+            configure_autoscaling(endpoint_config, endpoint_type, target_value=target_value)
+
+
+def get_target_invocations_per_instance(endpoint_config, endpoint_type):
+    """
+    Target of SageMakerVariantInvocationsPerInstance (invocations per instance per minute).
+    Uses target_invocations_per_instance of autoscaling_config when set, otherwise it is derived
+    from a measured per-instance throughput in load_test_results :
+     - inference/load_test.py results ("runs") : every run is measured on one host
+     - benchmark_endpoints.py results ("reports") : only the report of endpoint_type is used, its
+       throughput is measured on the instance_count instances of the benchmarked endpoint
+    Runs recorded on another instance type than the one of endpoint_config are left out. The highest
+    per-instance throughput of the runs without errors and with p99 latency within latency_slo_ms is
+    scaled by target_utilization, leaving headroom for traffic growing while new instances start
+    """
+    autoscaling_config = endpoint_config.get("autoscaling_config")
+    if autoscaling_config.get("target_invocations_per_instance"):
+        return float(autoscaling_config.get("target_invocations_per_instance"))
+    results_path = autoscaling_config.get("load_test_results")
+    assert results_path, "target_invocations_per_instance or load_test_results is required in autoscaling_config"
+    assert os.path.exists(results_path), f"load_test_results {results_path} does not exist"
+    results = json.load(open(results_path))
+    if "reports" in results:
+        runs = [report for report in results.get("reports") if report.get("endpoint_type") == endpoint_type]
+        assert len(runs) > 0, f"{results_path} has no report for {endpoint_type}"
+        assert all(run.get("instance_count") for run in runs), f"Reports of {results_path} do not record instance_count"
+    else:
+        runs = [
+            dict(run, instance_type=results.get("instance_type"), instance_count=results.get("instance_count", 1))
+            for run in results.get("runs", [])
+        ]
+    instance_type = endpoint_config.get("instance_type")
+    runs = [run for run in runs if run.get("instance_type") in [None, instance_type]]
+    assert len(runs) > 0, f"{results_path} has no run on {instance_type}"
+    latency_slo_ms = autoscaling_config.get("latency_slo_ms")
+    eligible_runs = [
+        run for run in runs
+        if run.get("errors", 0) == 0
+        and (latency_slo_ms is None or run.get("latency_ms", {}).get("p99", float("inf")) <= latency_slo_ms)
+    ]
+    assert len(eligible_runs) > 0, f"No run of {results_path} meets the latency slo of {latency_slo_ms}ms"
+    max_throughput_rps = max(run.get("throughput_rps") / run.get("instance_count") for run in eligible_runs)
+    target = max_throughput_rps * 60 * autoscaling_config.get("target_utilization", 0.7)
+    print(f"Measured Throughput : {max_throughput_rps:.2f} req/s per instance, Target : {target:.0f} invocations/instance/minute")
+    return round(target, 1)
+
+
+def validate_autoscaling_config(endpoint_config, endpoint_type):
+    """
+    Checks the autoscaling_config of endpoint_config before any resource is created or updated
+    returns:
+        target of SageMakerVariantInvocationsPerInstance, see get_target_invocations_per_instance
+    """
+    autoscaling_config = endpoint_config.get("autoscaling_config")
+    assert endpoint_type in AUTOSCALING_ENDPOINT_TYPES, f"Autoscaling is supported for {AUTOSCALING_ENDPOINT_TYPES}"
+    assert autoscaling_config, "autoscaling_config missing in endpoint_config"
+    assert autoscaling_config.get("max_capacity"), "max_capacity is required in autoscaling_config"
+    assert autoscaling_config.get("min_capacity", 1) <= autoscaling_config.get("max_capacity"), (
+        "min_capacity is greater than max_capacity in autoscaling_config"
+    )
+    return get_target_invocations_per_instance(endpoint_config, endpoint_type)
+
+
+def get_scalable_resource_id(endpoint_config):
+    return f"endpoint/{endpoint_config.get('endpoint_name')}/variant/{endpoint_config.get('variant_name', 'Variant1')}"
 
+
+def configure_autoscaling(endpoint_config, endpoint_type, target_value=None, autoscaling_client=None):
+    """
+    Registers the variant of the endpoint as a scalable target of Application Auto Scaling and
+    attaches a target tracking policy on SageMakerVariantInvocationsPerInstance, configured from
+    the "autoscaling_config" of endpoint_config :
+     - min_capacity / max_capacity : bounds of the instance count
+     - target_invocations_per_instance or load_test_results : see get_target_invocations_per_instance
+     - scale_in_cooldown / scale_out_cooldown : seconds between scaling activities
+    target_value is the one returned by validate_autoscaling_config, it is computed when None
+    """
+    autoscaling_config = endpoint_config.get("autoscaling_config")
+    autoscaling_client = autoscaling_client or boto3.client(
+        "application-autoscaling", region_name=endpoint_config.get("region")
+    )
+    resource_id = get_scalable_resource_id(endpoint_config)
+    if target_value is None:
+        target_value = validate_autoscaling_config(endpoint_config, endpoint_type)
+
+    autoscaling_client.register_scalable_target(
+        ServiceNamespace="sagemaker",
+        ResourceId=resource_id,
+        ScalableDimension="sagemaker:variant:DesiredInstanceCount",
+        MinCapacity=autoscaling_config.get("min_capacity", 1),
+        MaxCapacity=autoscaling_config.get("max_capacity"),
+    )
+    autoscaling_client.put_scaling_policy(
+        PolicyName=f"{endpoint_config.get('endpoint_name')}-invocations-target-tracking",
+        ServiceNamespace="sagemaker",
+        ResourceId=resource_id,
+        ScalableDimension="sagemaker:variant:DesiredInstanceCount",
+        PolicyType="TargetTrackingScaling",
+        TargetTrackingScalingPolicyConfiguration={
+            "TargetValue": target_value,
+            "PredefinedMetricSpecification": {"PredefinedMetricType": "SageMakerVariantInvocationsPerInstance"},
+            "ScaleInCooldown": autoscaling_config.get("scale_in_cooldown", 300),
+            "ScaleOutCooldown": autoscaling_config.get("scale_out_cooldown", 60),
+        },
+    )
+    print(
+        f"Autoscaling Configured for {resource_id} : {autoscaling_config.get('min_capacity', 1)}-"
+        f"{autoscaling_config.get('max_capacity')} instances, {target_value} invocations/instance/minute"
+    )
+
+
+def remove_autoscaling(endpoint_config, autoscaling_client=None):
+    """Deregisters the variant from Application Auto Scaling, its scaling policies are deleted with it"""
+    autoscaling_client = autoscaling_client or boto3.client(
+        "application-autoscaling", region_name=endpoint_config.get("region")
+    )
     try:
-        sagemaker_client.delete_endpoint_config(EndpointConfigName=config_name)
-        print(f"Endpoint Configuration Deleted : {config_name}")
+        autoscaling_client.deregister_scalable_target(
+            ServiceNamespace="sagemaker",
+            ResourceId=get_scalable_resource_id(endpoint_config),
+            ScalableDimension="sagemaker:variant:DesiredInstanceCount",
+        )
+        print(f"Autoscaling Removed for {get_scalable_resource_id(endpoint_config)}")
     except Exception as e:
         print(e)
 
+
+def is_not_found(error):
+    """SageMaker reports a missing endpoint, endpoint configuration or model as a "Could not find" ValidationException"""
+    return isinstance(error, ClientError) and "Could not find" in error.response.get("Error", {}).get("Message", "")
+
+
+def resource_exists(describe, **describe_args):
     try:
-        sagemaker_client.delete_model(ModelName=model_name)
-        print(f"Endpoint Configuration Deleted : {model_name}")
-    except Exception as e:
-        print(e)
+        describe(**describe_args)
+        return True
+    except ClientError as e:
+        if is_not_found(e):
+            return False
+        raise
+
+
+def get_config_models(config_name):
+    """Model names of the production variants of an endpoint configuration, empty when it is already deleted"""
+    try:
+        production_variants = sm_client.describe_endpoint_config(EndpointConfigName=config_name)["ProductionVariants"]
+    except ClientError as e:
+        if not is_not_found(e):
+            raise
+        print(f"Endpoint Configuration not found : {config_name}")
+        return []
+    return [variant["ModelName"] for variant in production_variants]
+
+
+def delete_config_and_models(config_name, model_names):
+    """
+    Deletes an endpoint configuration and models, the ones that are already deleted are skipped.
+    config_name can be None to only delete models
+    """
+    if config_name is not None and resource_exists(sm_client.describe_endpoint_config, EndpointConfigName=config_name):
+        try:
+            sm_client.delete_endpoint_config(EndpointConfigName=config_name)
+            print(f"Endpoint Configuration Deleted : {config_name}")
+        except Exception as e:
+            print(e)
+    for model_name in model_names:
+        if not resource_exists(sm_client.describe_model, ModelName=model_name):
+            continue
+        try:
+            sm_client.delete_model(ModelName=model_name)
+            print(f"Model Deleted : {model_name}")
+        except Exception as e:
+            print(e)
+
+
+def delete_endpoint(endpoint_config):
+    """
+    Deletes the endpoint with the endpoint configuration and models it is serving. update_endpoint
+    creates versioned names, so they are read from describe_endpoint instead of endpoint_config.
+    When the endpoint does not exist, the config_name and model_name of endpoint_config are deleted.
+    Configurations kept for rollback by update_endpoint are not deleted
+    """
+    endpoint_name = endpoint_config.get("endpoint_name")
+    try:
+        config_name = sm_client.describe_endpoint(EndpointName=endpoint_name)["EndpointConfigName"]
+    except ClientError as e:
+        if not is_not_found(e):
+            raise
+        print(f"Endpoint not found : {endpoint_name}")
+        delete_config_and_models(endpoint_config.get("config_name"), [endpoint_config.get("model_name")])
+        return
+    model_names = get_config_models(config_name)
+    sm_client.delete_endpoint(EndpointName=endpoint_name)
+    print(f"Endpoint Deleted : {endpoint_name}")
+    delete_config_and_models(config_name, model_names)
 
 
 if __name__ == "__main__":
@@ -302,7 +634,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "--action",
         type=str,
-        help="Supported Actions : create_endpoint, delete_endpoint",
+        help="Supported Actions : create_endpoint, update_endpoint, configure_autoscaling, delete_endpoint",
     )
     parser.add_argument(
         "--endpoint-type",
@@ -318,7 +650,9 @@ if __name__ == "__main__":
     assert action in [
         "delete_endpoint",
         "create_endpoint",
-    ], f"Supported Actions are : create_endpoint and delete_endpoint"
+        "update_endpoint",
+        "configure_autoscaling",
+    ], f"Supported Actions are : create_endpoint, update_endpoint, configure_autoscaling and delete_endpoint"
 
     assert endpoint_type in [
         "real-time-endpoint",
@@ -333,34 +667,26 @@ if __name__ == "__main__":
     endpoint_config = endpoint_master_config.get(endpoint_type)
 
     if action == "create_endpoint":
-        if endpoint_type in ["real-time-endpoint", "serverless-endpoint", "async-endpoint"]:
-            ## This will create Model Object for real-time and serverless endpoints
-            create_model(
-                model_name=endpoint_config.get("model_name"),
-                ecr_image=endpoint_config.get("container_uri"),
-                model_uri=endpoint_config.get("model_uri"),
-                role=endpoint_config.get("iam_role"),
-                multi_model=False,
-            )
-        else:
-            ## This will create Model Object for multi-model endpoints
-            create_model(
-                model_name=endpoint_config.get("model_name"),
-                ecr_image=endpoint_config.get("container_uri"),
-                model_uri=endpoint_config.get("model_uri"),
-                role=endpoint_config.get("iam_role"),
-                multi_model=True,
-            )
+        autoscaling_enabled = endpoint_config.get("autoscaling_config") and endpoint_type in AUTOSCALING_ENDPOINT_TYPES
+        if autoscaling_enabled:
+            target_value = validate_autoscaling_config(endpoint_config, endpoint_type)
+        ## Model Object with a SingleModel container, MultiModel for multi-model endpoints
+        create_model_for_endpoint(endpoint_config, endpoint_type)
         create_config(endpoint_config, endpoint_type=endpoint_type)
         create_endpoint(
             endpoint_name=endpoint_config.get("endpoint_name"),
             config_name=endpoint_config.get("config_name"),
         )
+        if autoscaling_enabled:
+            configure_autoscaling(endpoint_config, endpoint_type, target_value=target_value)
+
+    if action == "update_endpoint":
+        update_endpoint(endpoint_config, endpoint_type=endpoint_type)
+
+    if action == "configure_autoscaling":
+        configure_autoscaling(endpoint_config, endpoint_type)
 
     if action == "delete_endpoint":
-        delete_resources(
-            endpoint_name=endpoint_config.get("endpoint_name"),
-            config_name=endpoint_config.get("config_name"),
-            model_name=endpoint_config.get("model_name"),
-            aws_region=endpoint_config.get("region"),
-        )
+        if endpoint_config.get("autoscaling_config") and endpoint_type in AUTOSCALING_ENDPOINT_TYPES:
+            remove_autoscaling(endpoint_config)
+        delete_endpoint(endpoint_config)
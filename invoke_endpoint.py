@@ -1,21 +1,123 @@
 import json
 import os
 import argparse
+import base64
+import random
+import threading
+import uuid
 import boto3
 import sagemaker
 import urllib, time
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+
+# Error codes of the runtime API worth retrying with a lower concurrency
+RETRYABLE_ERROR_CODES = [
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailable",
+    "InternalFailure",
+    "InternalServerError",
+]
+
+DEFAULT_ASYNC_SUBMIT_CONFIG = {
+    "max_concurrency": 32,
+    "max_rps": None,
+    "max_attempts": 5,
+    "backoff_base_seconds": 0.2,
+    "backoff_max_seconds": 20,
+    "poll_interval_seconds": 5,
+    "timeout_seconds": 3600,
+    "notification_queue_url": None,
+    "max_head_polls": 50,
+    "progress_interval_seconds": 10,
+}
+
+DEFAULT_BULK_CONFIG = {
+    "initial_concurrency": 8,
+    "min_concurrency": 1,
+    "max_concurrency": 64,
+    "max_rps": None,
+    "max_attempts": 5,
+    "backoff_base_seconds": 0.2,
+    "backoff_max_seconds": 20,
+    "progress_interval_seconds": 10,
+}
+
+
+def get_payload(inference_config):
+    """
+    Builds the request body for the endpoint based on payload_format in inference_config
+     - json (default) : payload_path json is sent as it is, the endpoint fetches the image from s3
+     - base64 : image_file is sent base64 encoded in the "image" field of a json body
+     - raw : image_file bytes are sent as the body with application/x-image content type
+    The inline formats skip the s3 download inside the endpoint.
+    returns:
+        body, content_type, custom_attributes
+    """
+    payload_format = inference_config.get("payload_format", "json")
+    if payload_format == "json":
+        payload = json.load(open(inference_config.get("payload_path")))
+        return json.dumps(payload), "application/json", None
+    return build_image_payload(
+        payload_format, inference_config.get("image_file"), {"conf": inference_config.get("conf")}
+    )
+
+
+def build_image_payload(payload_format, image_file, params):
+    """
+    Request body of an image sent inline, params are added to the json body (base64) or sent as
+    custom attributes (raw). Custom attribute values are json encoded then url encoded, so that list
+    values such as classes=[0,1] keep their commas. params with a None value are skipped
+    returns:
+        body, content_type, custom_attributes
+    """
+    params = {name: value for name, value in params.items() if value is not None}
+    with open(image_file, "rb") as f:
+        image_bytes = f.read()
+    if payload_format == "base64":
+        payload = dict(params, image=base64.b64encode(image_bytes).decode("utf-8"))
+        return json.dumps(payload), "application/json", None
+    elif payload_format == "raw":
+        custom_attributes = ",".join(
+            f"{name}={urllib.parse.quote(json.dumps(value), safe='')}" for name, value in params.items()
+        )
+        return image_bytes, "application/x-image", custom_attributes or None
+    raise Exception(f"{payload_format} not supported. Supported formats : json, base64, raw")
+
+
+def get_invoke_args(inference_config):
+    """Keyword arguments for sagemaker_runtime.invoke_endpoint built from get_payload"""
+    body, content_type, custom_attributes = get_payload(inference_config)
+    invoke_args = {
+        "EndpointName": inference_config.get("endpoint_name"),
+        "ContentType": content_type,
+        "Body": body,
+    }
+    if custom_attributes is not None:
+        invoke_args["CustomAttributes"] = custom_attributes
+    if inference_config.get("accept") is not None:
+        invoke_args["Accept"] = inference_config.get("accept")
+    return invoke_args
+
+
+def parse_response(response):
+    """Decodes the endpoint response, msgpack responses are returned when requested with accept"""
+    body = response["Body"].read()
+    if response.get("ContentType") == "application/x-msgpack":
+        import msgpack
+
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body.decode("utf-8"))
+
 
 def invoke_real_time_endpoint(inference_config):
     sagemaker_runtime = boto3.client(
         "sagemaker-runtime", region_name=inference_config.get("region")
     )
-    endpoint_name = inference_config.get("endpoint_name")
-    payload = json.load(open(inference_config.get("payload_path")))
-    response = sagemaker_runtime.invoke_endpoint(
-        EndpointName=endpoint_name, Body=json.dumps(payload)
-    )
-    result = json.loads(response["Body"].read().decode("utf-8"))
+    response = sagemaker_runtime.invoke_endpoint(**get_invoke_args(inference_config))
+    result = parse_response(response)
     print(result)
 
 
@@ -23,31 +125,250 @@ def invoke_multi_model_endpoint(inference_config):
     sagemaker_runtime = boto3.client(
         "sagemaker-runtime", region_name=inference_config.get("region")
     )
-    endpoint_name = inference_config.get("endpoint_name")
-    payload = json.load(open(inference_config.get("payload_path")))
     response = sagemaker_runtime.invoke_endpoint(
-        EndpointName=endpoint_name,
-        ContentType="application/json",
         TargetModel=inference_config.get("target_model"),
-        Body=json.dumps(payload),
+        **get_invoke_args(inference_config),
     )
-    result = json.loads(response["Body"].read().decode("utf-8"))
+    result = parse_response(response)
     print(result)
     
 def invoke_serverless_endpoint(inference_config):
     sagemaker_runtime = boto3.client(
         "sagemaker-runtime", region_name=inference_config.get("region")
     )
-    endpoint_name = inference_config.get("endpoint_name")
-    payload = json.load(open(inference_config.get("payload_path")))
-    response = sagemaker_runtime.invoke_endpoint(
-        EndpointName=endpoint_name,
-        ContentType="application/json",
-        Body=json.dumps(payload),
-    )
-    result = json.loads(response["Body"].read().decode("utf-8"))
+    response = sagemaker_runtime.invoke_endpoint(**get_invoke_args(inference_config))
+    result = parse_response(response)
     print(result)
 
+def get_runtime_client(inference_config, max_pool_connections=10):
+    """
+    sagemaker-runtime client with a connection pool sized for concurrent invocations. botocore
+    retries are disabled since bulk invocations retry with their own backoff and concurrency
+    control. endpoint_url points the client at a local stand-in of the runtime API
+    """
+    return boto3.client(
+        "sagemaker-runtime",
+        region_name=inference_config.get("region"),
+        endpoint_url=inference_config.get("endpoint_url"),
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={"max_attempts": 1, "mode": "standard"},
+            tcp_keepalive=True,
+        ),
+    )
+
+
+class AdaptiveConcurrency(object):
+    """
+    Limit on the invocations in flight, adjusted with additive increase / multiplicative decrease.
+    Every success raises the limit by 1/limit (about +1 per round trip of the whole window), a
+    throttle or 5xx halves it, at most once per cooldown so a burst of errors counts once.
+    A retried invocation keeps its slot through the backoff (decrease() without release()), so
+    retries never wait behind invocations that can not start
+    """
+    def __init__(self, initial, minimum, maximum, decrease_factor=0.5, cooldown_seconds=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.cooldown_seconds = cooldown_seconds
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease > self.cooldown_seconds:
+            self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            self.last_decrease = now
+
+    def decrease(self):
+        """Shrinks the limit after a throttle while the slot is kept for a retry"""
+        with self.condition:
+            self._decrease()
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease()
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class RateLimiter(object):
+    """Token bucket limiting invocations to rate per second, None disables the limit"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate or 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+
+def is_retryable(error):
+    """Throttling, 5xx and connection errors are retried, model and validation errors are not"""
+    if isinstance(error, ClientError):
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+        return error.response["Error"]["Code"] in RETRYABLE_ERROR_CODES or status == 429 or status >= 500
+    return isinstance(error, BotoCoreError)
+
+
+def sleep_with_backoff(retry_config, attempt):
+    """Exponential backoff with full jitter before retry number attempt"""
+    backoff_seconds = min(
+        retry_config.get("backoff_max_seconds"),
+        retry_config.get("backoff_base_seconds") * 2 ** (attempt - 1),
+    )
+    time.sleep(random.uniform(0, backoff_seconds))
+
+
+def read_manifest(manifest_path):
+    """
+    Yields (record id, record) for each line of a jsonl manifest. A record is either the json
+    body sent as it is, or {"image_file": ..., "params": {...}} sent inline with payload_format.
+    Records without an "id" are numbered by line
+    """
+    with open(manifest_path) as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record.pop("id", line_number), record
+
+
+def get_record_invoke_args(inference_config, record):
+    """invoke_endpoint arguments of a manifest record"""
+    if record.get("image_file") is not None:
+        body, content_type, custom_attributes = build_image_payload(
+            inference_config.get("payload_format", "base64"),
+            record.get("image_file"),
+            record.get("params", {}),
+        )
+    else:
+        body, content_type, custom_attributes = json.dumps(record), "application/json", None
+    invoke_args = {
+        "EndpointName": inference_config.get("endpoint_name"),
+        "ContentType": content_type,
+        "Body": body,
+    }
+    if custom_attributes is not None:
+        invoke_args["CustomAttributes"] = custom_attributes
+    if inference_config.get("target_model"):
+        invoke_args["TargetModel"] = inference_config.get("target_model")
+    if inference_config.get("accept") is not None:
+        invoke_args["Accept"] = inference_config.get("accept")
+    return invoke_args
+
+
+class BulkInvoker(object):
+    """
+    Invokes an endpoint for every record of a manifest over one pooled client. In-flight
+    invocations follow AdaptiveConcurrency, the send rate is capped by RateLimiter, retryable
+    errors are retried with exponential backoff and jitter, and every result is appended to the
+    output jsonl as soon as it completes
+    """
+    def __init__(self, inference_config):
+        self.inference_config = inference_config
+        self.bulk_config = dict(DEFAULT_BULK_CONFIG, **inference_config.get("bulk_config", {}))
+        max_concurrency = self.bulk_config.get("max_concurrency")
+        self.client = get_runtime_client(inference_config, max_pool_connections=max_concurrency)
+        self.concurrency = AdaptiveConcurrency(
+            initial=self.bulk_config.get("initial_concurrency"),
+            minimum=self.bulk_config.get("min_concurrency"),
+            maximum=max_concurrency,
+        )
+        self.rate_limiter = RateLimiter(self.bulk_config.get("max_rps"))
+        self.output_lock = threading.Lock()
+        self.stats = {"succeeded": 0, "failed": 0, "retries": 0}
+
+    def invoke(self, record_id, record):
+        """Invokes one record with retries, the concurrency slot taken by run() is held until it returns"""
+        try:
+            invoke_args = get_record_invoke_args(self.inference_config, record)
+        except Exception as e:
+            self.concurrency.release()
+            return {"id": record_id, "status": "error", "attempts": 0, "error": str(e)}
+        max_attempts = self.bulk_config.get("max_attempts")
+        for attempt in range(1, max_attempts + 1):
+            self.rate_limiter.acquire()
+            start_time = time.perf_counter()
+            try:
+                response = self.client.invoke_endpoint(**invoke_args)
+                result = parse_response(response)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if not retryable or attempt == max_attempts:
+                    self.concurrency.release(throttled=retryable)
+                    return {"id": record_id, "status": "error", "attempts": attempt, "error": str(e)}
+                self.concurrency.decrease()
+                with self.output_lock:
+                    self.stats["retries"] += 1
+                sleep_with_backoff(self.bulk_config, attempt)
+                continue
+            self.concurrency.release()
+            latency_ms = round((time.perf_counter() - start_time) * 1000, 2)
+            return {"id": record_id, "status": "ok", "attempts": attempt, "latency_ms": latency_ms, "result": result}
+
+    def write_result(self, output_file, result):
+        with self.output_lock:
+            self.stats["succeeded" if result["status"] == "ok" else "failed"] += 1
+            output_file.write(json.dumps(result) + "\n")
+
+    def log_progress(self, total, start_time):
+        elapsed = time.perf_counter() - start_time
+        done = self.stats["succeeded"] + self.stats["failed"]
+        print(
+            f"Progress : {done}/{total}, {done / max(elapsed, 1e-9):.1f} req/s, "
+            f"Concurrency={self.concurrency.limit:.1f}, Stats={self.stats}"
+        )
+
+    def run(self, manifest_path, output_path):
+        total = sum(1 for line in open(manifest_path) if line.strip())
+        print(f"Invoking {self.inference_config.get('endpoint_name')} for {total} records")
+        start_time = time.perf_counter()
+        last_progress = start_time
+        executor = ThreadPoolExecutor(max_workers=self.bulk_config.get("max_concurrency"))
+        with open(output_path, "w") as output_file:
+            def on_done(future):
+                self.write_result(output_file, future.result())
+
+            for record_id, record in read_manifest(manifest_path):
+                # Blocks while the window is full, so records are read only as fast as they are sent
+                self.concurrency.acquire()
+                executor.submit(self.invoke, record_id, record).add_done_callback(on_done)
+                if time.perf_counter() - last_progress > self.bulk_config.get("progress_interval_seconds"):
+                    self.log_progress(total, start_time)
+                    last_progress = time.perf_counter()
+            executor.shutdown(wait=True)
+        self.log_progress(total, start_time)
+        print(f"Results written to {output_path}")
+        return self.stats
+
+
+def invoke_bulk(inference_config, manifest_path, output_path):
+    return BulkInvoker(inference_config).run(manifest_path, output_path)
+
+
 def upload_file_on_s3(bucket_name, upload_dir, input_location):
     sm_session = sagemaker.session.Session()
     return sm_session.upload_data(
@@ -89,6 +410,321 @@ def invoke_async_endpoint(inference_config):
     print(f"Output: {output}")
 
 
+def parse_s3_uri(s3_uri):
+    """Returns (bucket, key) of s3://bucket/key"""
+    s3_url = urllib.parse.urlparse(s3_uri)
+    return s3_url.netloc, s3_url.path[1:]
+
+
+class AsyncSubmitter(object):
+    """
+    Submits every record of a manifest to an async endpoint and collects the outputs.
+    Request bodies are uploaded to s3 and queued with invoke_endpoint_async concurrently. Outstanding
+    requests are tracked together instead of polling each output : either the success/error
+    notifications of the endpoint are read from an SQS queue subscribed to its SNS topics
+    (notification_queue_url), or once per poll_interval_seconds the output and failure prefixes are
+    listed and matched against the outstanding requests. Once at most max_head_polls requests are
+    outstanding, their expected output and failure objects are checked with HEAD requests instead,
+    since a listing reads every output the endpoint ever wrote under the prefix. Outputs are fetched
+    and appended to the output jsonl as they land
+    """
+    def __init__(self, inference_config):
+        self.inference_config = inference_config
+        self.submit_config = dict(DEFAULT_ASYNC_SUBMIT_CONFIG, **inference_config.get("submit_config", {}))
+        max_concurrency = self.submit_config.get("max_concurrency")
+        self.runtime_client = get_runtime_client(inference_config, max_pool_connections=max_concurrency)
+        self.s3_client = boto3.client(
+            "s3",
+            region_name=inference_config.get("region"),
+            config=Config(
+                max_pool_connections=max_concurrency,
+                retries={"max_attempts": 5, "mode": "standard"},
+                tcp_keepalive=True,
+            ),
+        )
+        self.queue_url = self.submit_config.get("notification_queue_url")
+        if self.queue_url:
+            self.sqs_client = boto3.client("sqs", region_name=inference_config.get("region"))
+        self.rate_limiter = RateLimiter(self.submit_config.get("max_rps"))
+        # Inference ids are prefixed with the run id, notifications of other runs sharing the queue
+        # (or left over from earlier runs) are not taken for the records of this one
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()
+        # output location -> (record id, failure location, submit time), inference id -> output location
+        self.outstanding = {}
+        self.inference_ids = {}
+        # inference id -> (output location, failure reason) of notifications of this run received before
+        # submit() registered their request, completed once the request is registered
+        self.early_notifications = {}
+        self.stats = {"submitted": 0, "succeeded": 0, "failed": 0, "submit_failed": 0}
+
+    def with_retries(self, function, **kwargs):
+        max_attempts = self.submit_config.get("max_attempts")
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return function(**kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt == max_attempts:
+                    raise
+                sleep_with_backoff(self.submit_config, attempt)
+
+    def get_inference_id(self, record_id):
+        return f"{self.run_id}-{record_id}"
+
+    def submit(self, record_id, record):
+        """Uploads the request body of a record and queues it on the endpoint"""
+        invoke_args = get_record_invoke_args(self.inference_config, record)
+        bucket_name = self.inference_config.get("bucket_name")
+        input_key = f"{self.inference_config.get('upload_dir')}/{self.run_id}/{record_id}"
+        self.rate_limiter.acquire()
+        self.with_retries(
+            self.s3_client.put_object,
+            Bucket=bucket_name,
+            Key=input_key,
+            Body=invoke_args["Body"],
+            ContentType=invoke_args["ContentType"],
+        )
+        async_args = {
+            "EndpointName": invoke_args["EndpointName"],
+            "InputLocation": f"s3://{bucket_name}/{input_key}",
+            "ContentType": invoke_args["ContentType"],
+            "InferenceId": self.get_inference_id(record_id),
+        }
+        for name in ["CustomAttributes", "Accept"]:
+            if name in invoke_args:
+                async_args[name] = invoke_args[name]
+        response = self.with_retries(self.runtime_client.invoke_endpoint_async, **async_args)
+        output_location = response["OutputLocation"]
+        with self.lock:
+            self.outstanding[output_location] = (record_id, response.get("FailureLocation"), time.perf_counter())
+            self.inference_ids[self.get_inference_id(record_id)] = output_location
+            self.stats["submitted"] += 1
+
+    def read_location(self, s3_uri):
+        bucket_name, key = parse_s3_uri(s3_uri)
+        return self.with_retries(self.s3_client.get_object, Bucket=bucket_name, Key=key)
+
+    def complete(self, output_file, output_location, failure_location=None, failure_reason=None):
+        """Fetches the output (or failure) of a finished request and writes its result line"""
+        with self.lock:
+            if output_location not in self.outstanding:
+                return
+            record_id, _, submit_time = self.outstanding.pop(output_location)
+            self.inference_ids.pop(self.get_inference_id(record_id), None)
+        # Completion is observed once per poll, so latency is rounded up to the poll interval
+        latency_ms = round((time.perf_counter() - submit_time) * 1000, 2)
+        result = {"id": record_id, "output_location": output_location, "latency_ms": latency_ms}
+        try:
+            if failure_location is None and failure_reason is None:
+                result.update(status="ok", result=parse_response(self.read_location(output_location)))
+            else:
+                if failure_location is not None:
+                    failure_reason = self.read_location(failure_location)["Body"].read().decode("utf-8")
+                result.update(status="error", error=failure_reason)
+        except Exception as e:
+            result.update(status="error", error=str(e))
+        with self.lock:
+            self.stats["succeeded" if result["status"] == "ok" else "failed"] += 1
+            output_file.write(json.dumps(result) + "\n")
+
+    def location_exists(self, s3_uri):
+        bucket_name, key = parse_s3_uri(s3_uri)
+        try:
+            self.with_retries(self.s3_client.head_object, Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["404", "NoSuchKey", "NotFound"]:
+                return False
+            raise
+        return True
+
+    def list_locations(self, s3_uris):
+        """The s3_uris that exist, each of their parent prefixes is listed once"""
+        by_prefix = {}
+        for s3_uri in s3_uris:
+            by_prefix.setdefault(s3_uri.rsplit("/", 1)[0] + "/", set()).add(s3_uri)
+        found = set()
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for prefix, prefix_uris in by_prefix.items():
+            bucket_name, key_prefix = parse_s3_uri(prefix)
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=key_prefix):
+                for s3_object in page.get("Contents", []):
+                    s3_uri = f"s3://{bucket_name}/{s3_object['Key']}"
+                    if s3_uri in prefix_uris:
+                        found.add(s3_uri)
+        return found
+
+    def poll_outputs(self, output_file, fetch_executor):
+        """
+        Completes the outstanding requests whose output or failure object exists. The output and
+        failure prefixes are listed once while more than max_head_polls requests are outstanding,
+        the objects of the last ones are checked with HEAD requests
+        """
+        with self.lock:
+            locations = [
+                (output_location, failure_location)
+                for output_location, (_, failure_location, _) in self.outstanding.items()
+            ]
+
+        if len(locations) > self.submit_config.get("max_head_polls"):
+            try:
+                found = self.list_locations(
+                    [output_location for output_location, _ in locations]
+                    + [failure_location for _, failure_location in locations if failure_location]
+                )
+            except Exception as e:
+                # Listed again on the next poll
+                print(f"Listing outputs failed : {e}")
+                return 0
+            completed = []
+            for output_location, failure_location in locations:
+                if output_location in found:
+                    completed.append((output_location, None))
+                elif failure_location in found:
+                    completed.append((output_location, failure_location))
+            list(fetch_executor.map(lambda args: self.complete(output_file, *args), completed))
+            return len(completed)
+
+        def check(location):
+            output_location, failure_location = location
+            try:
+                if self.location_exists(output_location):
+                    self.complete(output_file, output_location)
+                    return 1
+                if failure_location and self.location_exists(failure_location):
+                    self.complete(output_file, output_location, failure_location)
+                    return 1
+            except Exception as e:
+                # Checked again on the next poll
+                print(f"Polling {output_location} failed : {e}")
+            return 0
+
+        return sum(fetch_executor.map(check, locations))
+
+    def poll_notifications(self, output_file, fetch_executor):
+        """
+        Reads success/error notifications from the SQS queue in batches of 10 and completes their
+        requests. A notification completes a request only when its inference id is one of this run
+        and its outputLocation is the one returned for the request. A notification may arrive before
+        submit() registered its inference id, it is then kept in early_notifications and completed on
+        a later poll. Notifications of other runs are left on the queue
+        """
+        completed = []
+        with self.lock:
+            for inference_id in [key for key in self.early_notifications if key in self.inference_ids]:
+                notified_location, failure_reason = self.early_notifications.pop(inference_id)
+                if notified_location == self.inference_ids[inference_id]:
+                    completed.append((notified_location, None, failure_reason))
+        while True:
+            response = self.sqs_client.receive_message(
+                QueueUrl=self.queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=min(20, int(self.submit_config.get("poll_interval_seconds"))),
+            )
+            messages = response.get("Messages", [])
+            handled = []
+            for message in messages:
+                notification = json.loads(message["Body"])
+                if "Message" in notification:
+                    # Delivered through SNS without raw message delivery
+                    notification = json.loads(notification["Message"])
+                inference_id = str(notification.get("inferenceId"))
+                notified_location = notification.get("responseParameters", {}).get("outputLocation")
+                if not inference_id.startswith(f"{self.run_id}-"):
+                    continue
+                handled.append(message)
+                failure_reason = None
+                if notification.get("invocationStatus") != "Completed":
+                    failure_reason = notification.get("failureReason", "Failed")
+                with self.lock:
+                    output_location = self.inference_ids.get(inference_id)
+                    if output_location is None:
+                        self.early_notifications[inference_id] = (notified_location, failure_reason)
+                        continue
+                if notified_location != output_location:
+                    print(f"Ignoring notification of {inference_id} for {notified_location}, expected {output_location}")
+                    continue
+                completed.append((output_location, None, failure_reason))
+            if handled:
+                self.sqs_client.delete_message_batch(
+                    QueueUrl=self.queue_url,
+                    Entries=[
+                        {"Id": str(index), "ReceiptHandle": message["ReceiptHandle"]}
+                        for index, message in enumerate(handled)
+                    ],
+                )
+            if len(messages) < 10:
+                break
+        list(fetch_executor.map(lambda args: self.complete(output_file, *args), completed))
+        return len(completed)
+
+    def log_progress(self, total, start_time):
+        elapsed = time.perf_counter() - start_time
+        done = self.stats["succeeded"] + self.stats["failed"]
+        print(
+            f"Progress : {self.stats['submitted']}/{total} submitted, {done} completed, "
+            f"{len(self.outstanding)} outstanding, {done / max(elapsed, 1e-9):.1f} req/s, Stats={self.stats}"
+        )
+
+    def run(self, manifest_path, output_path):
+        total = sum(1 for line in open(manifest_path) if line.strip())
+        print(f"Submitting {total} records to {self.inference_config.get('endpoint_name')}")
+        max_concurrency = self.submit_config.get("max_concurrency")
+        submit_executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        fetch_executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # Bounds the records read ahead of the submissions
+        pending = threading.BoundedSemaphore(2 * max_concurrency)
+        start_time = time.perf_counter()
+
+        with open(output_path, "w") as output_file:
+            def submit_record(record_id, record):
+                try:
+                    self.submit(record_id, record)
+                except Exception as e:
+                    with self.lock:
+                        self.stats["submit_failed"] += 1
+                        output_file.write(json.dumps({"id": record_id, "status": "error", "error": str(e)}) + "\n")
+                finally:
+                    pending.release()
+
+            def submit_all():
+                for record_id, record in read_manifest(manifest_path):
+                    pending.acquire()
+                    submit_executor.submit(submit_record, record_id, record)
+                submit_executor.shutdown(wait=True)
+
+            submitter = threading.Thread(target=submit_all, daemon=True)
+            submitter.start()
+            deadline = None
+            last_progress = start_time
+            while submitter.is_alive() or self.outstanding:
+                if not submitter.is_alive() and deadline is None:
+                    deadline = time.perf_counter() + self.submit_config.get("timeout_seconds")
+                if deadline is not None and time.perf_counter() > deadline:
+                    break
+                if self.queue_url:
+                    self.poll_notifications(output_file, fetch_executor)
+                else:
+                    time.sleep(self.submit_config.get("poll_interval_seconds"))
+                    self.poll_outputs(output_file, fetch_executor)
+                output_file.flush()
+                if time.perf_counter() - last_progress > self.submit_config.get("progress_interval_seconds"):
+                    self.log_progress(total, start_time)
+                    last_progress = time.perf_counter()
+
+            for output_location, (record_id, _, _) in list(self.outstanding.items()):
+                output_file.write(json.dumps(
+                    {"id": record_id, "status": "timeout", "output_location": output_location}
+                ) + "\n")
+        fetch_executor.shutdown(wait=True)
+        self.log_progress(total, start_time)
+        print(f"Results written to {output_path}")
+        return self.stats
+
+
+def invoke_async_bulk(inference_config, manifest_path, output_path):
+    return AsyncSubmitter(inference_config).run(manifest_path, output_path)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--cfg", type=str, help="inference configuration file path")
@@ -97,6 +733,15 @@ if __name__ == "__main__":
         type=str,
         help="Supported Endpoint Types : real-time-endpoint, multi-model-endpoint,serverless-endpoint, async-endpoint",
     )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help="jsonl file of payloads, invokes the endpoint for every line concurrently",
+    )
+    parser.add_argument(
+        "--output", type=str, default="bulk_results.jsonl", help="jsonl file of bulk results"
+    )
     args = parser.parse_args()
 
     config_path = args.cfg
@@ -112,7 +757,11 @@ if __name__ == "__main__":
 
     inference_config = json.load(open(config_path)).get(endpoint_type)
 
-    if endpoint_type == "real-time-endpoint":
+    if args.manifest is not None and endpoint_type == "async-endpoint":
+        invoke_async_bulk(inference_config, args.manifest, args.output)
+    elif args.manifest is not None:
+        invoke_bulk(inference_config, args.manifest, args.output)
+    elif endpoint_type == "real-time-endpoint":
         invoke_real_time_endpoint(inference_config)
     elif endpoint_type == "multi-model-endpoint":
         invoke_multi_model_endpoint(inference_config)
@@ -5,53 +5,88 @@ import time
 import warnings
 
 import boto3
+from botocore.config import Config
 from loguru import logger
 
+from labelled_index import LabelledIndex
+from pre_annotate import (
+    TEMPLATE_ATTRIBUTE_NAME,
+    check_batch_transform_requirements,
+    get_adjustment_lambda_arns,
+    pre_annotate,
+    render_template,
+)
+from s3_utils import S3MultipartWriter, iter_prefix_keys
+
 warnings.filterwarnings("ignore")
 
 
 def generate_manifest_file(
-    bucket_name, dataset_path, manifest_upload_dir, manifest_file_name
+    bucket_name,
+    dataset_path,
+    manifest_upload_dir,
+    manifest_file_name,
+    listing_workers=32,
+    labelled_index=None,
 ):
     """
-    Generates a manifest file containing the location of images used in the labelling job
+    Generates a manifest file containing the location of images used in the labelling job.
+    The sub-prefixes of dataset_path are listed concurrently and the manifest lines are streamed
+    into a multipart upload, so nothing is written locally and memory stays bounded
     params:
         bucket_name : s3 bucket name
-        dataset_path : relative s3 path of the image dataset
+        dataset_path : relative s3 path of the image dataset, listed recursively
         manifest_upload_dir : s3 directory to upload the manifest file
         manifest_file_name : name of the manifest file
+        listing_workers : concurrent list requests
+        labelled_index : optional LabelledIndex, images already labelled are left out of the manifest
+    returns:
+        listing stats : objects, matched, prefixes, requests, seconds, images written and skipped
     """
-    image_extensions = ["png", "jpg", "jpeg"]
-    local_manifest_file_path = os.path.join(os.getcwd(), manifest_file_name)
-    s3 = boto3.resource("s3")
-    dataset_bucket = s3.Bucket(bucket_name)
-    with open(local_manifest_file_path, "w") as outfile:
-        for object_summary in dataset_bucket.objects.filter(Prefix=dataset_path):
-            object_key = object_summary.key
-            file_extension = object_key.split(".")[-1]
-            if file_extension in image_extensions:
-                file_name = object_key.split("/")[-1]
-                file_path = os.path.join(f"s3://{bucket_name}", dataset_path, file_name)
-                data_dict = {"source-ref": file_path}
-                outfile.write(json.dumps(data_dict) + "\n")
+    s3_client = boto3.client(
+        "s3", config=Config(max_pool_connections=listing_workers)
+    )
+    manifest_key = os.path.join(manifest_upload_dir, manifest_file_name)
     logger.info(
-        f"Manifest File Creation Done. Uploading Manifest file to : {manifest_upload_dir}"
+        f"Listing s3://{bucket_name}/{dataset_path} into s3://{bucket_name}/{manifest_key}"
     )
+    stats = {}
+    written, skipped = 0, 0
     try:
-        dataset_bucket.upload_file(
-            local_manifest_file_path,
-            os.path.join(manifest_upload_dir, manifest_file_name),
-        )
+        with S3MultipartWriter(s3_client, bucket_name, manifest_key) as writer:
+            for object_key in iter_prefix_keys(
+                s3_client,
+                bucket_name,
+                dataset_path,
+                max_workers=listing_workers,
+                stats=stats,
+            ):
+                source_ref = f"s3://{bucket_name}/{object_key}"
+                if labelled_index is not None and source_ref in labelled_index:
+                    skipped += 1
+                    continue
+                data_dict = {"source-ref": source_ref}
+                writer.write(json.dumps(data_dict) + "\n")
+                written += 1
     except Exception as e:
         raise Exception(
-            f"Failed to Upload {local_manifest_file_path} to {manifest_upload_dir}\nError : {e}"
+            f"Failed to generate s3://{bucket_name}/{manifest_key}\nError : {e}"
         )
-    logger.info(f"Upload Successful")
-    os.remove(local_manifest_file_path)
+    stats.update({"written": written, "skipped": skipped})
+    logger.info(
+        f"Manifest File Uploaded : {written} images ({skipped} already labelled) of {stats['matched']} images, "
+        f"{stats['objects']} objects under {stats['prefixes']} prefixes listed in {stats['seconds']}s "
+        f"({stats['objects'] / max(stats['seconds'], 1e-3):.0f} objects/s, {stats['requests']} list requests)"
+    )
+    return stats
 
 
 def generate_label_file(
-    bucket_name, label_list, label_file_name, label_file_upload_dir
+    bucket_name,
+    label_list,
+    label_file_name,
+    label_file_upload_dir,
+    audit_label_attribute_name=None,
 ):
     """
     Generate a json file containing information of labels to be annotated and upload on S3
@@ -60,8 +95,12 @@ def generate_label_file(
         label_list : list of labels to be annotated
         label_file_name : name of label file
         label_file_upload_dir : s3 directory to upload label file
+        audit_label_attribute_name : manifest attribute of existing boxes shown to workers for adjustment
     """
     label_dict = {"labels": [{"label": label} for label in label_list]}
+    if audit_label_attribute_name is not None:
+        label_dict["document-version"] = "2018-11-28"
+        label_dict["auditLabelAttributeName"] = audit_label_attribute_name
     local_label_file_path = os.path.join(os.getcwd(), label_file_name)
     with open(local_label_file_path, "w") as f:
         json.dump(label_dict, f)
@@ -168,14 +207,63 @@ def create_ground_truth_request(
     return ground_truth_request
 
 
+def load_labelled_index(bucket_name, label_config):
+    """
+    Loads the index of already labelled images and adds the output manifests of the jobs
+    completed since it was saved
+    """
+    s3_client = boto3.client(
+        "s3", config=Config(max_pool_connections=label_config.get("listing_workers", 32))
+    )
+    labelled_index = LabelledIndex(
+        s3_client, bucket_name, label_config.get("labelled_index_path")
+    ).load()
+    labelled_index.update(
+        label_config.get("output_dir"),
+        listing_workers=label_config.get("listing_workers", 32),
+    )
+    if labelled_index.modified:
+        labelled_index.save()
+    return labelled_index
+
+
 def main(aws_config, label_config):
+    pre_annotation_config = label_config.get("pre_annotation_config", {})
+    if pre_annotation_config.get("enabled"):
+        check_batch_transform_requirements()
+
+    # Step 0 : Load the index of images labelled by previous jobs, so that only new images are labelled
+    labelled_index = None
+    if label_config.get("labelled_index_path"):
+        labelled_index = load_labelled_index(aws_config.get("bucket_name"), label_config)
+
     # Step 1 : Generate and upload a manifest file of the input dataset in s3 bucket
-    generate_manifest_file(
+    manifest_stats = generate_manifest_file(
         bucket_name=aws_config.get("bucket_name"),
         dataset_path=label_config.get("dataset_path"),
         manifest_upload_dir=label_config.get("manifest_upload_dir"),
         manifest_file_name=label_config.get("manifest_file_name"),
+        listing_workers=label_config.get("listing_workers", 32),
+        labelled_index=labelled_index,
     )
+    if manifest_stats["written"] == 0:
+        logger.info("Every image of the dataset is already labelled, no labelling job created")
+        return
+    manifest_key = os.path.join(
+        label_config["manifest_upload_dir"], label_config["manifest_file_name"]
+    )
+
+    # Step 1.1 : Pre-annotate the images with the deployed model, labelers then adjust the predicted boxes
+    audit_label_attribute_name = None
+    pre_human_arn, acs_arn = aws_config.get("pre_human_arn"), aws_config.get("acs_arn")
+    template_file_uri = label_config.get("template_file_uri")
+    if pre_annotation_config.get("enabled"):
+        manifest_key = pre_annotate(aws_config, label_config)
+        audit_label_attribute_name = pre_annotation_config.get(
+            "attribute_name", TEMPLATE_ATTRIBUTE_NAME
+        )
+        pre_human_arn, acs_arn = get_adjustment_lambda_arns(aws_config)
+        template_file_uri = render_template(template_file_uri, audit_label_attribute_name)
 
     # Step 2 : Generate a json file containing class_names information
     generate_label_file(
@@ -183,12 +271,13 @@ def main(aws_config, label_config):
         label_list=label_config.get("label_list"),
         label_file_name=label_config.get("label_file_name"),
         label_file_upload_dir=label_config.get("label_file_upload_dir"),
+        audit_label_attribute_name=audit_label_attribute_name,
     )
 
     # Step 3 : Create a human task config containing information about labelling for a worker
     human_task_config = create_human_task_config(
-        acs_arn=aws_config.get("acs_arn"),
-        pre_human_arn=aws_config.get("pre_human_arn"),
+        acs_arn=acs_arn,
+        pre_human_arn=pre_human_arn,
         MaxConcurrentTaskCount=label_config.get("max_concurrent_task_count"),
         NumberOfHumanWorkersPerDataObject=label_config.get("number_of_human_workers"),
         TaskAvailabilityLifetimeInSeconds=label_config.get(
@@ -198,17 +287,13 @@ def main(aws_config, label_config):
         TaskDescription=label_config.get("task_description"),
         TaskKeywords=label_config.get("task_keywords"),
         TaskTitle=label_config.get("task_title"),
-        template_file_uri=label_config.get("template_file_uri"),
+        template_file_uri=template_file_uri,
         work_team_arn=aws_config.get("private_work_team_arn"),
     )
 
     # Step 4 : Create a request body to create a labelling job
     bucket_name = aws_config.get("bucket_name")
-    manifest_file_uri = os.path.join(
-        f"s3://{bucket_name}",
-        label_config["manifest_upload_dir"],
-        label_config["manifest_file_name"],
-    )
+    manifest_file_uri = os.path.join(f"s3://{bucket_name}", manifest_key)
     output_path_uri = os.path.join(f"s3://{bucket_name}", label_config["output_dir"])
     label_file_uri = os.path.join(
         f"s3://{bucket_name}",
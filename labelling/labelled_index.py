@@ -0,0 +1,123 @@
+import gzip
+import json
+import tempfile
+import time
+
+from loguru import logger
+
+from s3_utils import iter_prefix_keys
+
+OUTPUT_MANIFEST_SUFFIX = "manifests/output/output.manifest"
+
+
+class LabelledIndex(object):
+    """
+    Index of the images that already have annotations, keyed by their source-ref.
+    It is built from the output.manifest files of previous labelling jobs and stored on s3 as a
+    gzipped text file : a json header line with the ETag of every output manifest already read,
+    followed by the sorted source-refs, one per line (sorted keys share long prefixes, so gzip
+    keeps the file small). update() only reads the output manifests that are new or changed since
+    the index was saved.
+    """
+
+    def __init__(self, s3_client, bucket_name, index_key, label_attribute_name="category"):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.index_key = index_key
+        self.label_attribute_name = label_attribute_name
+        self.sources = {}
+        self.source_refs = set()
+        self.modified = False
+
+    def load(self):
+        try:
+            body = self.s3_client.get_object(Bucket=self.bucket_name, Key=self.index_key)["Body"]
+        except self.s3_client.exceptions.NoSuchKey:
+            logger.info(f"No labelled index at s3://{self.bucket_name}/{self.index_key}, starting empty")
+            return self
+        with gzip.open(body, "rt") as f:
+            self.sources = json.loads(f.readline()).get("sources", {})
+            self.source_refs = {line.rstrip("\n") for line in f if line.strip()}
+        logger.info(
+            f"Loaded labelled index : {len(self.source_refs)} images from {len(self.sources)} output manifests"
+        )
+        return self
+
+    def save(self):
+        with tempfile.TemporaryFile() as f:
+            with gzip.open(f, "wt") as gz:
+                gz.write(json.dumps({"version": 1, "sources": self.sources}) + "\n")
+                for source_ref in sorted(self.source_refs):
+                    gz.write(source_ref + "\n")
+            size = f.tell()
+            f.seek(0)
+            self.s3_client.upload_fileobj(f, self.bucket_name, self.index_key)
+        self.modified = False
+        logger.info(
+            f"Saved labelled index to s3://{self.bucket_name}/{self.index_key} : "
+            f"{len(self.source_refs)} images, {size / 1024:.1f} KB"
+        )
+
+    def __contains__(self, source_ref):
+        return source_ref in self.source_refs
+
+    def __len__(self):
+        return len(self.source_refs)
+
+    def is_labelled(self, image_data):
+        """True when a line of an output manifest carries a label, failed objects have none"""
+        return (
+            self.label_attribute_name in image_data
+            and "failure-reason" not in image_data.get(f"{self.label_attribute_name}-metadata", {})
+        )
+
+    def add_manifest(self, manifest_key):
+        """Adds the labelled source-refs of one output manifest, returns the number of new images"""
+        body = self.s3_client.get_object(Bucket=self.bucket_name, Key=manifest_key)["Body"]
+        added = 0
+        for line in body.iter_lines():
+            if not line.strip():
+                continue
+            image_data = json.loads(line)
+            source_ref = image_data.get("source-ref")
+            if source_ref and source_ref not in self.source_refs and self.is_labelled(image_data):
+                self.source_refs.add(source_ref)
+                added += 1
+        return added
+
+    def update(self, output_dir, listing_workers=32):
+        """
+        Reads the output manifests under output_dir that are not in the index yet or whose ETag
+        changed, the ETags come from the listing. Images are only ever added, an image labelled once stays labelled
+        returns:
+            number of images added to the index
+        """
+        start_time = time.perf_counter()
+        manifest_etags = {
+            key: etag
+            for key, etag in iter_prefix_keys(
+                self.s3_client,
+                self.bucket_name,
+                output_dir,
+                extensions=["manifest"],
+                max_workers=listing_workers,
+                with_etags=True,
+            )
+            if key.endswith(OUTPUT_MANIFEST_SUFFIX)
+        }
+        added = 0
+        manifests_read = 0
+        for manifest_key, etag in sorted(manifest_etags.items()):
+            if self.sources.get(manifest_key) == etag:
+                continue
+            manifest_added = self.add_manifest(manifest_key)
+            logger.info(f"Indexed {manifest_key} : {manifest_added} new labelled images")
+            self.sources[manifest_key] = etag
+            added += manifest_added
+            manifests_read += 1
+            self.modified = True
+        logger.info(
+            f"Labelled index updated in {time.perf_counter() - start_time:.1f}s : {manifests_read} of "
+            f"{len(manifest_etags)} output manifests read, {added} images added, {len(self.source_refs)} in total"
+        )
+        return added
@@ -0,0 +1,366 @@
+"""
+Model assisted pre-annotation of a labelling job.
+The images of the job manifest are predicted offline by inference/batch_transform.py with the model
+deployed behind pre_annotation_config.endpoint_name (or a local model_dir), and the predictions are
+written back as a Ground Truth bounding box manifest under pre_annotation_config.attribute_name, so
+that labelers adjust the predicted boxes instead of drawing them.
+
+Images can be ordered by model uncertainty and the job limited to the max_images most uncertain ones.
+The uncertainty of a box is 1 - |2 * confidence - 1| (1 for a 0.5 confidence, 0 for 0 or 1) and the
+uncertainty of an image is the highest of its boxes. Images without detections score 0.
+
+batch_transform runs with the same interpreter, so the packages of inference/requirements.txt
+(ultralytics, torch, opencv) must be installed next to the labelling requirements.
+
+usage:
+    cd labelling
+    pip install -r ../inference/requirements.txt
+    python pre_annotate.py --cfg configs/labelling_config.json
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.parse
+
+import boto3
+import numpy as np
+from loguru import logger
+
+from s3_utils import S3MultipartWriter
+
+curr_dir = os.path.abspath(os.path.dirname(__file__))
+BATCH_TRANSFORM_SCRIPT = os.path.join(curr_dir, "..", "inference", "batch_transform.py")
+# Packages of inference/requirements.txt imported by batch_transform
+BATCH_TRANSFORM_MODULES = ["torch", "ultralytics", "cv2"]
+# Manifest attribute of the predicted boxes read by configs/instructions.template
+TEMPLATE_ATTRIBUTE_NAME = "preannotation"
+
+
+def parse_s3_uri(s3_uri):
+    """Returns (bucket, key) of s3://bucket/key"""
+    s3_url = urllib.parse.urlparse(s3_uri)
+    return s3_url.netloc, s3_url.path[1:]
+
+
+def check_batch_transform_requirements():
+    """Raises when the packages batch_transform needs are not installed for this interpreter"""
+    missing = [name for name in BATCH_TRANSFORM_MODULES if importlib.util.find_spec(name) is None]
+    if missing:
+        raise Exception(
+            f"Pre-annotation runs inference/batch_transform.py with {sys.executable}, which is missing "
+            f"{', '.join(missing)}. Install them with : pip install -r inference/requirements.txt"
+        )
+
+
+def get_endpoint_model_data_url(sagemaker_client, endpoint_name):
+    """
+    Model artifact (model.tar.gz) of the first production variant of the endpoint. Multi-model
+    endpoints serve a prefix of artifacts instead of one model, set model_dir for them
+    """
+    endpoint_config_name = sagemaker_client.describe_endpoint(EndpointName=endpoint_name)[
+        "EndpointConfigName"
+    ]
+    model_name = sagemaker_client.describe_endpoint_config(
+        EndpointConfigName=endpoint_config_name
+    )["ProductionVariants"][0]["ModelName"]
+    model_info = sagemaker_client.describe_model(ModelName=model_name)
+    container = model_info.get("PrimaryContainer") or model_info["Containers"][0]
+    if container.get("Mode") == "MultiModel" or not container["ModelDataUrl"].endswith(".tar.gz"):
+        raise Exception(
+            f"Endpoint {endpoint_name} is a multi-model endpoint ({container['ModelDataUrl']}), "
+            f"set pre_annotation_config.model_dir to the model to pre-annotate with"
+        )
+    logger.info(f"Endpoint {endpoint_name} serves {model_name} : {container['ModelDataUrl']}")
+    return container["ModelDataUrl"]
+
+
+def download_model(s3_client, model_data_url, model_dir):
+    """Downloads and extracts a model.tar.gz into model_dir"""
+    bucket_name, key = parse_s3_uri(model_data_url)
+    with tempfile.NamedTemporaryFile(suffix=".tar.gz") as f:
+        s3_client.download_fileobj(bucket_name, key, f)
+        f.flush()
+        with tarfile.open(f.name) as tar:
+            if hasattr(tarfile, "data_filter"):
+                tar.extractall(model_dir, filter="data")
+            else:
+                tar.extractall(model_dir)
+    logger.info(f"Model extracted to {model_dir} : {os.listdir(model_dir)}")
+    return model_dir
+
+
+def run_batch_transform(model_dir, manifest_uri, predictions_uri, pre_annotation_config):
+    """Predicts the source-refs of the manifest with inference/batch_transform.py in a subprocess"""
+    command = [
+        sys.executable,
+        BATCH_TRANSFORM_SCRIPT,
+        "--model-dir", model_dir,
+        "--manifest", manifest_uri,
+        "--output", predictions_uri,
+        "--output-type", "jsonl",
+        "--output-format", "compact",
+    ]
+    for name in ["conf", "batch_size", "shard_size", "workers"]:
+        if pre_annotation_config.get(name) is not None:
+            command += [f"--{name.replace('_', '-')}", str(pre_annotation_config.get(name))]
+    logger.info(f"Running {' '.join(command)}")
+    subprocess.run(command, cwd=os.path.dirname(BATCH_TRANSFORM_SCRIPT), check=True)
+
+
+def iter_prediction_shards(s3_client, predictions_uri):
+    """Yields the rows of every part-*.jsonl shard written by batch_transform, one list per shard"""
+    if predictions_uri.startswith("s3://"):
+        bucket_name, prefix = parse_s3_uri(predictions_uri)
+        prefix = prefix.rstrip("/") + "/"
+        paginator = s3_client.get_paginator("list_objects_v2")
+        shard_keys = sorted(
+            s3_object["Key"]
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+            for s3_object in page.get("Contents", [])
+            if os.path.basename(s3_object["Key"]).startswith("part-")
+            and s3_object["Key"].endswith(".jsonl")
+        )
+        for shard_key in shard_keys:
+            body = s3_client.get_object(Bucket=bucket_name, Key=shard_key)["Body"]
+            yield [json.loads(line) for line in body.iter_lines() if line.strip()]
+    else:
+        for shard_name in sorted(os.listdir(predictions_uri)):
+            if shard_name.startswith("part-") and shard_name.endswith(".jsonl"):
+                with open(os.path.join(predictions_uri, shard_name)) as f:
+                    yield [json.loads(line) for line in f if line.strip()]
+
+
+def to_ground_truth_boxes(boxes, image_sizes):
+    """
+    Converts normalized yolo boxes to Ground Truth boxes, the inverse of prepare_dataset.format_annotation
+    params:
+        boxes : (N, 4) array of [center_x, center_y, w, h] normalized
+        image_sizes : (N, 2) array of [img_w, img_h] of the image of each box
+    returns:
+        (N, 4) int array of [left, top, width, height] in pixels, clipped to the image
+    """
+    box_wh = boxes[:, 2:4] * image_sizes
+    top_left = boxes[:, 0:2] * image_sizes - box_wh / 2
+    bottom_right = np.minimum(top_left + box_wh, image_sizes)
+    top_left = np.maximum(top_left, 0)
+    return np.rint(np.concatenate([top_left, bottom_right - top_left], axis=1)).astype(np.int64)
+
+
+def get_box_uncertainty(confidences):
+    """1 for a 0.5 confidence, 0 for a confidence of 0 or 1"""
+    return 1 - np.abs(2 * confidences - 1)
+
+
+def convert_shard(rows, bucket_name, attribute_name, class_map, creation_date, job_name):
+    """
+    Converts the batch_transform rows of a shard into Ground Truth manifest lines. The boxes of every
+    image of the shard are converted and scored in one pass
+    returns:
+        list of (uncertainty, manifest line dict), rows with an error are skipped
+    """
+    rows = [row for row in rows if "results" in row]
+    if not rows:
+        return []
+    counts = np.array([row["results"]["count"] for row in rows], dtype=np.int64)
+    boxes = np.array(
+        [value for row in rows for value in row["results"]["boxes"]], dtype=np.float64
+    ).reshape(-1, 4)
+    class_ids = np.array(
+        [class_id for row in rows for class_id in row["results"]["class_ids"]], dtype=np.int64
+    )
+    confidences = np.array(
+        [confidence for row in rows for confidence in row["results"]["confidences"]], dtype=np.float64
+    )
+    image_sizes = np.array(
+        [[row["image_size"]["width"], row["image_size"]["height"]] for row in rows], dtype=np.float64
+    )
+    image_index = np.repeat(np.arange(len(rows)), counts)
+
+    # Classes the labelling job does not know are dropped
+    keep = np.isin(class_ids, [int(class_id) for class_id in class_map])
+    image_index, boxes, class_ids, confidences = (
+        image_index[keep], boxes[keep], class_ids[keep], confidences[keep]
+    )
+    gt_boxes = to_ground_truth_boxes(boxes, image_sizes[image_index])
+    box_uncertainty = get_box_uncertainty(confidences)
+    image_uncertainty = np.zeros(len(rows))
+    np.maximum.at(image_uncertainty, image_index, box_uncertainty)
+
+    splits = np.cumsum(np.bincount(image_index, minlength=len(rows)))[:-1]
+    lines = []
+    for row, uncertainty, image_boxes, image_class_ids, image_confidences in zip(
+        rows,
+        image_uncertainty.tolist(),
+        np.split(gt_boxes, splits),
+        np.split(class_ids, splits),
+        np.split(confidences, splits),
+    ):
+        image_size = row["image_size"]
+        line = {
+            "source-ref": f"s3://{bucket_name}/{row['image_key']}",
+            attribute_name: {
+                "image_size": [image_size],
+                "annotations": [
+                    {"class_id": class_id, "left": left, "top": top, "width": width, "height": height}
+                    for class_id, (left, top, width, height) in zip(
+                        image_class_ids.tolist(), image_boxes.tolist()
+                    )
+                ],
+            },
+            f"{attribute_name}-metadata": {
+                "objects": [{"confidence": round(confidence, 4)} for confidence in image_confidences.tolist()],
+                "class-map": class_map,
+                "type": "groundtruth/object-detection",
+                "human-annotated": "no",
+                "creation-date": creation_date,
+                "job-name": job_name,
+                "uncertainty": round(uncertainty, 4),
+            },
+        }
+        lines.append((uncertainty, line))
+    return lines
+
+
+def write_pre_annotated_manifest(
+    s3_client, predictions_uri, bucket_name, manifest_key, class_map, pre_annotation_config
+):
+    """
+    Writes the Ground Truth manifest of the predictions. Lines are streamed in shard order, or held
+    in memory and sorted by decreasing uncertainty when order_by_uncertainty is set
+    returns:
+        stats : images, boxes, written and mean uncertainty of the written images
+    """
+    attribute_name = pre_annotation_config.get("attribute_name", TEMPLATE_ATTRIBUTE_NAME)
+    order_by_uncertainty = pre_annotation_config.get("order_by_uncertainty", False)
+    max_images = pre_annotation_config.get("max_images")
+    min_uncertainty = pre_annotation_config.get("min_uncertainty")
+    creation_date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")
+    job_name = f"pre-annotation/{pre_annotation_config.get('endpoint_name') or 'local-model'}"
+
+    stats = {"images": 0, "boxes": 0, "written": 0, "uncertainty": 0.0}
+
+    def iter_lines():
+        for rows in iter_prediction_shards(s3_client, predictions_uri):
+            for uncertainty, line in convert_shard(
+                rows, bucket_name, attribute_name, class_map, creation_date, job_name
+            ):
+                stats["images"] += 1
+                if min_uncertainty is not None and uncertainty < min_uncertainty:
+                    continue
+                yield uncertainty, line
+
+    lines = iter_lines()
+    if order_by_uncertainty:
+        lines = sorted(lines, key=lambda entry: entry[0], reverse=True)
+    with S3MultipartWriter(s3_client, bucket_name, manifest_key) as writer:
+        for uncertainty, line in lines:
+            if max_images is not None and stats["written"] >= max_images:
+                continue
+            writer.write(json.dumps(line) + "\n")
+            stats["written"] += 1
+            stats["boxes"] += len(line[attribute_name]["annotations"])
+            stats["uncertainty"] += uncertainty
+    stats["uncertainty"] = round(stats["uncertainty"] / max(1, stats["written"]), 4)
+    return stats
+
+
+def get_adjustment_lambda_arns(aws_config):
+    """
+    Pre-annotated jobs are bounding box adjustment jobs : (pre_human_arn, acs_arn) of the
+    AdjustmentBoundingBox lambdas, from pre_human_adjustment_arn/acs_adjustment_arn of aws_config or
+    derived from the BoundingBox ones of the same region
+    """
+    arns = []
+    for name in ["pre_human", "acs"]:
+        arn = aws_config.get(f"{name}_adjustment_arn") or aws_config.get(f"{name}_arn")
+        if not arn.endswith("AdjustmentBoundingBox"):
+            arn = arn.replace("BoundingBox", "AdjustmentBoundingBox")
+        arns.append(arn)
+    return tuple(arns)
+
+
+def render_template(template_file_uri, attribute_name):
+    """
+    The worker template reads the predicted boxes from manifestLine.preannotation. For another
+    attribute_name, a copy of the template reading manifestLine.<attribute_name> is uploaded next to it
+    returns:
+        s3 uri of the template to use
+    """
+    if attribute_name == TEMPLATE_ATTRIBUTE_NAME:
+        return template_file_uri
+    s3_client = boto3.client("s3")
+    bucket_name, key = parse_s3_uri(template_file_uri)
+    template = s3_client.get_object(Bucket=bucket_name, Key=key)["Body"].read().decode("utf-8")
+    template = template.replace(
+        f"manifestLine.{TEMPLATE_ATTRIBUTE_NAME}", f"manifestLine.{attribute_name}"
+    )
+    rendered_key = f"{os.path.splitext(key)[0]}-{attribute_name}.template"
+    s3_client.put_object(Bucket=bucket_name, Key=rendered_key, Body=template.encode("utf-8"))
+    logger.info(f"Template for {attribute_name} uploaded to s3://{bucket_name}/{rendered_key}")
+    return f"s3://{bucket_name}/{rendered_key}"
+
+
+def get_pre_annotated_manifest_name(manifest_file_name):
+    return f"{os.path.splitext(manifest_file_name)[0]}-preannotated.manifest"
+
+
+def pre_annotate(aws_config, label_config):
+    """
+    Predicts the images of the job manifest and uploads the pre-annotated manifest next to it
+    returns:
+        s3 key of the pre-annotated manifest
+    """
+    check_batch_transform_requirements()
+    bucket_name = aws_config.get("bucket_name")
+    pre_annotation_config = label_config.get("pre_annotation_config")
+    s3_client = boto3.client("s3")
+    manifest_uri = os.path.join(
+        f"s3://{bucket_name}", label_config["manifest_upload_dir"], label_config["manifest_file_name"]
+    )
+    predictions_uri = os.path.join(
+        f"s3://{bucket_name}", pre_annotation_config["predictions_path"], label_config["job_name"]
+    )
+
+    start_time = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_dir = pre_annotation_config.get("model_dir")
+        if model_dir is None:
+            model_data_url = get_endpoint_model_data_url(
+                boto3.client("sagemaker"), pre_annotation_config.get("endpoint_name")
+            )
+            model_dir = download_model(s3_client, model_data_url, os.path.join(tmp_dir, "model"))
+        run_batch_transform(os.path.abspath(model_dir), manifest_uri, predictions_uri, pre_annotation_config)
+    logger.info(f"Predictions written to {predictions_uri} in {time.perf_counter() - start_time:.1f}s")
+
+    class_map = pre_annotation_config.get("class_map") or {
+        str(class_id): label for class_id, label in enumerate(label_config.get("label_list"))
+    }
+    manifest_key = os.path.join(
+        label_config["manifest_upload_dir"],
+        get_pre_annotated_manifest_name(label_config["manifest_file_name"]),
+    )
+    stats = write_pre_annotated_manifest(
+        s3_client, predictions_uri, bucket_name, manifest_key, class_map, pre_annotation_config
+    )
+    logger.info(
+        f"Pre-annotated manifest uploaded to s3://{bucket_name}/{manifest_key} : {stats['written']} of "
+        f"{stats['images']} images, {stats['boxes']} boxes, mean uncertainty {stats['uncertainty']}"
+    )
+    return manifest_key
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cfg", type=str, help="path of configuration file")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.cfg), f"Configuration file {args.cfg} does not exist"
+    config = json.load(open(args.cfg))
+    pre_annotate(config.get("aws_config"), config.get("label_config"))
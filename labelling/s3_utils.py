@@ -0,0 +1,203 @@
+import string
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from loguru import logger
+
+IMAGE_EXTENSIONS = ["png", "jpg", "jpeg"]
+# First characters after a prefix at which a level with more than one page is split into key ranges
+SPLIT_CHARACTERS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+
+def has_extension(key, extensions):
+    """Case insensitive extension check, IMG_001.JPG matches jpg"""
+    return key.rsplit(".", 1)[-1].lower() in extensions
+
+
+def _list_page(s3_client, bucket_name, prefix, continuation_token, start_after=None):
+    """
+    Lists one page of a single level of prefix, from continuation_token or after the key start_after
+    returns:
+        ((key, etag) of the objects, sub-prefixes, next continuation token or None)
+    """
+    list_args = {
+        "Bucket": bucket_name,
+        "Prefix": prefix,
+        "Delimiter": "/",
+        "MaxKeys": 1000,
+    }
+    if continuation_token:
+        list_args["ContinuationToken"] = continuation_token
+    elif start_after:
+        list_args["StartAfter"] = start_after
+    response = s3_client.list_objects_v2(**list_args)
+    objects = [(s3_object["Key"], s3_object.get("ETag")) for s3_object in response.get("Contents", [])]
+    sub_prefixes = [
+        common_prefix["Prefix"] for common_prefix in response.get("CommonPrefixes", [])
+    ]
+    return objects, sub_prefixes, response.get("NextContinuationToken")
+
+
+def _split_key_range(prefix, start_after):
+    """
+    Splits the keys of a single level of prefix that sort after start_after into ranges
+    (lower, upper] on the first character after prefix, the last range has no upper bound
+    """
+    bounds = [prefix + character for character in SPLIT_CHARACTERS if prefix + character > start_after]
+    return list(zip([start_after] + bounds, bounds + [None]))
+
+
+def iter_prefix_keys(
+    s3_client,
+    bucket_name,
+    prefix,
+    extensions=IMAGE_EXTENSIONS,
+    max_workers=32,
+    stats=None,
+    log_every=10,
+    with_etags=False,
+):
+    """
+    Yields the keys under prefix whose extension is in extensions.
+    Every level of the prefix is listed with a "/" delimiter and each sub-prefix found is queued
+    to be listed concurrently, one page per request. A level with more than one page is split
+    into key ranges listed concurrently with StartAfter, so flat prefixes are not listed one page
+    at a time. At most max_workers requests are in flight and their pages are processed as they
+    arrive, keys are not yielded in a global order. Closing the generator, or an error, cancels the
+    queued requests without waiting for the rest of the listing.
+    params:
+        s3_client : boto3 s3 client, its connection pool should allow max_workers connections
+        bucket_name : s3 bucket name
+        prefix : prefix to list, listed recursively
+        extensions : lower case extensions to keep, None keeps every key
+        max_workers : concurrent list requests
+        stats : optional dict updated with objects, matched, prefixes, requests and seconds
+        log_every : seconds between progress logs
+        with_etags : yield (key, etag) from the listing instead of the key, no HeadObject needed
+    """
+    stats = stats if stats is not None else {}
+    stats.update({"objects": 0, "matched": 0, "prefixes": 1, "requests": 0})
+    start_time = last_log_time = time.perf_counter()
+    # (prefix, continuation token, start_after, upper) of the pages left to request, start_after and
+    # upper bound the key range of a split level
+    queue = deque([(prefix, None, None, None)])
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while queue or pending:
+            while queue and len(pending) < max_workers:
+                task = queue.popleft()
+                page_prefix, continuation_token, start_after, _ = task
+                future = executor.submit(
+                    _list_page, s3_client, bucket_name, page_prefix, continuation_token, start_after
+                )
+                pending[future] = task
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                page_prefix, _, start_after, upper = pending.pop(future)
+                objects, sub_prefixes, continuation_token = future.result()
+                stats["requests"] += 1
+                page_last = max([key for key, _ in objects[-1:]] + sub_prefixes[-1:], default="")
+                if start_after is not None:
+                    # A sub-prefix holding start_after is listed again after it
+                    sub_prefixes = [sub_prefix for sub_prefix in sub_prefixes if sub_prefix > start_after]
+                if upper is not None and page_last > upper:
+                    objects = [(key, etag) for key, etag in objects if key <= upper]
+                    sub_prefixes = [sub_prefix for sub_prefix in sub_prefixes if sub_prefix <= upper]
+                    continuation_token = None
+                if continuation_token and start_after is None:
+                    queue.extend(
+                        (page_prefix, None, lower, range_upper)
+                        for lower, range_upper in _split_key_range(page_prefix, page_last)
+                    )
+                elif continuation_token:
+                    queue.append((page_prefix, continuation_token, start_after, upper))
+                queue.extend((sub_prefix, None, None, None) for sub_prefix in sub_prefixes)
+                stats["prefixes"] += len(sub_prefixes)
+                stats["objects"] += len(objects)
+                for key, etag in objects:
+                    if extensions is None or has_extension(key, extensions):
+                        stats["matched"] += 1
+                        yield (key, etag) if with_etags else key
+            if time.perf_counter() - last_log_time >= log_every:
+                last_log_time = time.perf_counter()
+                elapsed = last_log_time - start_time
+                logger.info(
+                    f"Listed {stats['objects']} objects ({stats['matched']} matched) under "
+                    f"{stats['prefixes']} prefixes, {stats['objects'] / elapsed:.0f} objects/s"
+                )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    stats["seconds"] = round(time.perf_counter() - start_time, 2)
+
+
+class S3MultipartWriter(object):
+    """
+    Streams text lines into an s3 object, holding at most part_size bytes in memory.
+    The multipart upload is only started once a full part is buffered, smaller outputs
+    are written with a single put_object on close (same as inference/model_handler.py)
+    """
+
+    def __init__(self, s3_client, bucket_name, key, part_size=8 * 1024 * 1024):
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+        self._buffer = bytearray()
+
+    def write(self, line):
+        self._buffer.extend(line.encode("utf-8"))
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self.bytes_written += len(self._buffer)
+        self._buffer = bytearray()
+
+    def close(self):
+        if self.upload_id is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name, Key=self.key, Body=bytes(self._buffer)
+            )
+            self.bytes_written += len(self._buffer)
+            return
+        if self._buffer:
+            self._upload_part()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": self.parts},
+        )
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+repo_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# The scripts of the repo import their siblings by module name
+for path in [repo_dir, os.path.join(repo_dir, "labelling"), os.path.join(repo_dir, "inference")]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "test")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "test")
@@ -0,0 +1,67 @@
+import asyncio
+import json
+
+import pytest
+
+import async_server
+
+
+@pytest.fixture
+def server(monkeypatch):
+    calls = []
+
+    def handle(data, context):
+        model_dir = context.system_properties["model_dir"]
+        calls.append(("handle", model_dir))
+        if model_dir == "/opt/ml/models/huge/model":
+            raise MemoryError("out of memory")
+        if data is None:
+            return None
+        return [{"model_dir": model_dir, "body": data[0]["body"].decode("utf-8")}]
+
+    monkeypatch.setattr(async_server, "MULTI_MODEL", True)
+    monkeypatch.setattr(async_server.model_handler, "handle", handle)
+    monkeypatch.setattr(async_server.model_handler, "unload_model", lambda model_dir: calls.append(("unload", model_dir)))
+    server = async_server.InferenceServer(max_concurrency=2)
+    server.calls = calls
+    yield server
+    server.executor.shutdown(wait=True)
+
+
+def request(server, method, path, body=b""):
+    parsed = async_server.parse_models_path(path)
+    assert parsed is not None
+    status, output, _ = asyncio.run(server.handle_models_request(method, *parsed, {}, body))
+    return status, output
+
+
+def load_body(model_name):
+    return json.dumps({"model_name": model_name, "url": f"/opt/ml/models/{model_name}/model"}).encode("utf-8")
+
+
+def test_parse_models_path():
+    assert async_server.parse_models_path("/models") == (None, None)
+    assert async_server.parse_models_path("/models/a%2Fb") == ("a/b", None)
+    assert async_server.parse_models_path("/models/m1/invoke") == ("m1", "invoke")
+    assert async_server.parse_models_path("/invocations") is None
+
+
+def test_multi_model_lifecycle(server):
+    assert request(server, "POST", "/models", load_body("m1"))[0] == 200
+    assert request(server, "POST", "/models", load_body("m1"))[0] == 409
+    assert request(server, "GET", "/models") == (
+        200, {"models": [{"modelName": "m1", "modelUrl": "/opt/ml/models/m1/model"}]}
+    )
+    assert request(server, "POST", "/models/m1/invoke", b"payload") == (
+        200, {"model_dir": "/opt/ml/models/m1/model", "body": "payload"}
+    )
+    assert request(server, "DELETE", "/models/m1")[0] == 200
+    assert ("unload", "/opt/ml/models/m1/model") in server.calls
+    assert request(server, "POST", "/models/m1/invoke", b"payload")[0] == 404
+    assert request(server, "GET", "/models/m1")[0] == 404
+
+
+def test_multi_model_load_errors(server):
+    assert request(server, "POST", "/models", b"{}")[0] == 400
+    assert request(server, "POST", "/models", load_body("huge"))[0] == 507
+    assert request(server, "GET", "/models") == (200, {"models": []})
@@ -0,0 +1,28 @@
+import argparse
+import json
+
+import batch_transform
+
+
+def make_args(**kwargs):
+    return argparse.Namespace(**dict({"manifest": None, "input": "s3://images-bucket/images/"}, **kwargs))
+
+
+def test_keys_are_saved_with_the_input(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_transform, "list_image_keys", lambda s3_client, bucket_name, prefix: ["images/a.jpg"])
+    output_store = batch_transform.OutputStore(str(tmp_path))
+    assert batch_transform.load_or_list_keys(output_store, None, make_args()) == ("images-bucket", ["images/a.jpg"])
+    assert (tmp_path / batch_transform.KEYS_FILE).read_text() == "images/a.jpg"
+    assert json.loads((tmp_path / batch_transform.INPUT_FILE).read_text())["bucket"] == "images-bucket"
+
+    monkeypatch.setattr(batch_transform, "list_image_keys", None)
+    assert batch_transform.load_or_list_keys(output_store, None, make_args()) == ("images-bucket", ["images/a.jpg"])
+
+
+def test_resumes_keys_without_input_file(tmp_path):
+    # Key lists of earlier runs only have the keys, one per line
+    (tmp_path / batch_transform.KEYS_FILE).write_text("images/a.jpg\nimages/b.jpg")
+    output_store = batch_transform.OutputStore(str(tmp_path))
+    assert batch_transform.load_or_list_keys(output_store, None, make_args()) == (
+        "images-bucket", ["images/a.jpg", "images/b.jpg"]
+    )
@@ -0,0 +1,247 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import inference_resources
+
+
+class RecordingClient(object):
+    """Records the calls of a boto3 client, every call returns an empty response"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append((name, kwargs))
+            return {}
+
+        return call
+
+    def names(self):
+        return [name for name, _ in self.calls]
+
+
+def make_endpoint_config(**autoscaling_config):
+    return {
+        "region": "ap-southeast-1",
+        "endpoint_name": "ep",
+        "model_name": "model",
+        "config_name": "config",
+        "instance_type": "ml.m5.xlarge",
+        "instance_count": 1,
+        "autoscaling_config": dict({"min_capacity": 1, "max_capacity": 4}, **autoscaling_config),
+    }
+
+
+def write_results(tmp_path, results):
+    results_path = tmp_path / "results.json"
+    results_path.write_text(json.dumps(results))
+    return str(results_path)
+
+
+def test_target_from_config():
+    endpoint_config = make_endpoint_config(target_invocations_per_instance=600)
+    assert inference_resources.get_target_invocations_per_instance(endpoint_config, "real-time-endpoint") == 600.0
+
+
+def test_target_requires_results():
+    endpoint_config = make_endpoint_config(target_invocations_per_instance=None, load_test_results=None)
+    with pytest.raises(AssertionError, match="load_test_results is required"):
+        inference_resources.validate_autoscaling_config(endpoint_config, "real-time-endpoint")
+    endpoint_config["autoscaling_config"]["load_test_results"] = "missing/load_test_results.json"
+    with pytest.raises(AssertionError, match="does not exist"):
+        inference_resources.validate_autoscaling_config(endpoint_config, "real-time-endpoint")
+
+
+def test_target_from_load_test_runs(tmp_path):
+    results_path = write_results(tmp_path, {
+        "instance_type": "ml.m5.xlarge",
+        "runs": [
+            {"throughput_rps": 10.0, "errors": 0, "latency_ms": {"p99": 200}},
+            {"throughput_rps": 20.0, "errors": 0, "latency_ms": {"p99": 900}},
+            {"throughput_rps": 30.0, "errors": 3, "latency_ms": {"p99": 100}},
+        ],
+    })
+    endpoint_config = make_endpoint_config(load_test_results=results_path, latency_slo_ms=500, target_utilization=0.5)
+    # 10 req/s within the slo and without errors, 600 invocations per minute at 50% utilization
+    assert inference_resources.get_target_invocations_per_instance(endpoint_config, "real-time-endpoint") == 300.0
+
+
+def test_target_from_benchmark_reports(tmp_path):
+    results_path = write_results(tmp_path, {
+        "reports": [
+            {"endpoint_type": "real-time-endpoint", "instance_type": "ml.m5.xlarge", "instance_count": 2,
+             "throughput_rps": 40.0, "errors": 0, "latency_ms": {"p99": 100}},
+            {"endpoint_type": "async-endpoint", "instance_type": "ml.m5.xlarge", "instance_count": 1,
+             "throughput_rps": 100.0, "errors": 0, "latency_ms": {"p99": 100}},
+        ],
+    })
+    endpoint_config = make_endpoint_config(load_test_results=results_path, target_utilization=1.0)
+    # Only the real-time report counts, 40 req/s over 2 instances
+    assert inference_resources.get_target_invocations_per_instance(endpoint_config, "real-time-endpoint") == 1200.0
+    endpoint_config["instance_type"] = "ml.c5.xlarge"
+    with pytest.raises(AssertionError, match="no run on ml.c5.xlarge"):
+        inference_resources.get_target_invocations_per_instance(endpoint_config, "real-time-endpoint")
+    with pytest.raises(AssertionError, match="no report for multi-model-endpoint"):
+        inference_resources.get_target_invocations_per_instance(endpoint_config, "multi-model-endpoint")
+
+
+def test_configure_autoscaling():
+    endpoint_config = make_endpoint_config(target_invocations_per_instance=600, scale_in_cooldown=120)
+    autoscaling_client = RecordingClient()
+    inference_resources.configure_autoscaling(
+        endpoint_config, "real-time-endpoint", autoscaling_client=autoscaling_client
+    )
+    assert autoscaling_client.names() == ["register_scalable_target", "put_scaling_policy"]
+    register_args = autoscaling_client.calls[0][1]
+    assert register_args["ResourceId"] == "endpoint/ep/variant/Variant1"
+    assert (register_args["MinCapacity"], register_args["MaxCapacity"]) == (1, 4)
+    policy_args = autoscaling_client.calls[1][1]
+    assert policy_args["ResourceId"] == "endpoint/ep/variant/Variant1"
+    tracking_config = policy_args["TargetTrackingScalingPolicyConfiguration"]
+    assert tracking_config["TargetValue"] == 600.0
+    assert tracking_config["PredefinedMetricSpecification"]["PredefinedMetricType"] == "SageMakerVariantInvocationsPerInstance"
+    assert (tracking_config["ScaleInCooldown"], tracking_config["ScaleOutCooldown"]) == (120, 60)
+
+
+def test_configure_autoscaling_validates_before_registering():
+    endpoint_config = make_endpoint_config(max_capacity=None, target_invocations_per_instance=600)
+    autoscaling_client = RecordingClient()
+    with pytest.raises(AssertionError, match="max_capacity"):
+        inference_resources.configure_autoscaling(
+            endpoint_config, "real-time-endpoint", autoscaling_client=autoscaling_client
+        )
+    assert autoscaling_client.calls == []
+
+
+def test_update_endpoint_validates_before_creating(monkeypatch):
+    sm_client = RecordingClient()
+    sm_client.describe_endpoint = lambda EndpointName: {"EndpointStatus": "InService", "EndpointConfigName": "config"}
+    monkeypatch.setattr(inference_resources, "sm_client", sm_client)
+    endpoint_config = make_endpoint_config(target_invocations_per_instance=None, load_test_results=None)
+    with pytest.raises(AssertionError, match="load_test_results is required"):
+        inference_resources.update_endpoint(endpoint_config, "real-time-endpoint")
+    assert sm_client.calls == []
+
+
+class FakeSageMaker(RecordingClient):
+    """
+    Endpoints, endpoint configurations and models of a sagemaker client. A missing resource raises
+    the "Could not find" ValidationException of SageMaker, update_endpoint completes immediately
+    """
+
+    def __init__(self, endpoints=None, configs=None, models=None, fail_update=False):
+        super().__init__()
+        self.endpoints = dict(endpoints or {})
+        self.configs = dict(configs or {})
+        self.models = set(models or [])
+        self.fail_update = fail_update
+
+    def not_found(self, operation_name, name):
+        return ClientError(
+            {"Error": {"Code": "ValidationException", "Message": f"Could not find {name}."}}, operation_name
+        )
+
+    def describe_endpoint(self, EndpointName):
+        if EndpointName not in self.endpoints:
+            raise self.not_found("DescribeEndpoint", EndpointName)
+        return {"EndpointStatus": "InService", "EndpointConfigName": self.endpoints[EndpointName]}
+
+    def describe_endpoint_config(self, EndpointConfigName):
+        if EndpointConfigName not in self.configs:
+            raise self.not_found("DescribeEndpointConfig", EndpointConfigName)
+        return {"ProductionVariants": [{"ModelName": model_name} for model_name in self.configs[EndpointConfigName]]}
+
+    def describe_model(self, ModelName):
+        if ModelName not in self.models:
+            raise self.not_found("DescribeModel", ModelName)
+        return {"ModelName": ModelName}
+
+    def create_model(self, **kwargs):
+        self.calls.append(("create_model", kwargs))
+        self.models.add(kwargs["ModelName"])
+
+    def create_endpoint_config(self, **kwargs):
+        self.calls.append(("create_endpoint_config", kwargs))
+        self.configs[kwargs["EndpointConfigName"]] = [variant["ModelName"] for variant in kwargs["ProductionVariants"]]
+
+    def update_endpoint(self, **kwargs):
+        self.calls.append(("update_endpoint", kwargs))
+        if self.fail_update:
+            raise ClientError({"Error": {"Code": "ResourceLimitExceeded", "Message": "limit"}}, "UpdateEndpoint")
+        self.endpoints[kwargs["EndpointName"]] = kwargs["EndpointConfigName"]
+
+    def delete_endpoint(self, EndpointName):
+        self.calls.append(("delete_endpoint", EndpointName))
+        del self.endpoints[EndpointName]
+
+    def delete_endpoint_config(self, EndpointConfigName):
+        self.calls.append(("delete_endpoint_config", EndpointConfigName))
+        del self.configs[EndpointConfigName]
+
+    def delete_model(self, ModelName):
+        self.calls.append(("delete_model", ModelName))
+        self.models.remove(ModelName)
+
+    def deleted(self):
+        return [(name, args) for name, args in self.calls if name.startswith("delete")]
+
+
+def make_update_config(**deployment_config):
+    return dict(
+        make_endpoint_config(),
+        autoscaling_config=None,
+        iam_role="role",
+        container_uri="image",
+        model_uri="s3://bucket/model.tar.gz",
+        deployment_config=deployment_config,
+    )
+
+
+def test_update_endpoint_deletes_previous(monkeypatch):
+    sm_client = FakeSageMaker(
+        endpoints={"ep": "config-v1"}, configs={"config-v1": ["model-v1", "model-gone"]}, models=["model-v1"]
+    )
+    monkeypatch.setattr(inference_resources, "sm_client", sm_client)
+    new_config = inference_resources.update_endpoint(make_update_config(delete_previous=True), "real-time-endpoint")
+    assert sm_client.endpoints["ep"] == new_config["config_name"]
+    assert set(sm_client.configs) == {new_config["config_name"]}
+    assert sm_client.models == {new_config["model_name"]}
+    # model-gone was already deleted, it is not deleted again
+    assert sm_client.deleted() == [("delete_endpoint_config", "config-v1"), ("delete_model", "model-v1")]
+
+
+def test_update_endpoint_cleans_up_when_not_started(monkeypatch):
+    sm_client = FakeSageMaker(
+        endpoints={"ep": "config-v1"}, configs={"config-v1": ["model-v1"]}, models=["model-v1"], fail_update=True
+    )
+    monkeypatch.setattr(inference_resources, "sm_client", sm_client)
+    with pytest.raises(ClientError):
+        inference_resources.update_endpoint(make_update_config(), "real-time-endpoint")
+    assert sm_client.endpoints == {"ep": "config-v1"}
+    assert sm_client.configs == {"config-v1": ["model-v1"]}
+    assert sm_client.models == {"model-v1"}
+
+
+def test_delete_endpoint_deletes_served_resources(monkeypatch):
+    sm_client = FakeSageMaker(
+        endpoints={"ep": "config-v2"},
+        configs={"config-v2": ["model-v2"], "config": ["model"]},
+        models=["model-v2", "model"],
+    )
+    monkeypatch.setattr(inference_resources, "sm_client", sm_client)
+    inference_resources.delete_endpoint(make_endpoint_config())
+    assert sm_client.deleted() == [
+        ("delete_endpoint", "ep"),
+        ("delete_endpoint_config", "config-v2"),
+        ("delete_model", "model-v2"),
+    ]
+
+
+def test_delete_endpoint_without_endpoint(monkeypatch):
+    sm_client = FakeSageMaker(configs={"config": ["model"]}, models=[])
+    monkeypatch.setattr(inference_resources, "sm_client", sm_client)
+    inference_resources.delete_endpoint(make_endpoint_config())
+    assert sm_client.deleted() == [("delete_endpoint_config", "config")]
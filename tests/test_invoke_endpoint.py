@@ -0,0 +1,295 @@
+import io
+import json
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+import invoke_endpoint
+from invoke_endpoint import AdaptiveConcurrency, BulkInvoker, RateLimiter
+
+
+def throttling_error():
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}, "ResponseMetadata": {"HTTPStatusCode": 400}},
+        "InvokeEndpoint",
+    )
+
+
+class FakeRuntime(object):
+    """invoke_endpoint of sagemaker-runtime, throttles the calls for which throttle(body, attempt of the body) is True"""
+
+    def __init__(self, throttle=lambda body, attempt: False, latency=0):
+        self.throttle = throttle
+        self.latency = latency
+        self.calls = 0
+        self.attempts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def invoke_endpoint(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+            self.attempts[kwargs["Body"]] = attempt = self.attempts.get(kwargs["Body"], 0) + 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if self.throttle(kwargs["Body"], attempt):
+                raise throttling_error()
+            return {"Body": io.BytesIO(kwargs["Body"].encode("utf-8")), "ContentType": "application/json"}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def test_adaptive_concurrency_increase_and_decrease():
+    concurrency = AdaptiveConcurrency(initial=4, minimum=1, maximum=5, cooldown_seconds=60)
+    for _ in range(4):
+        concurrency.acquire()
+    assert concurrency.in_flight == 4
+    concurrency.release()
+    assert concurrency.limit == pytest.approx(4.25)
+    concurrency.release(throttled=True)
+    assert concurrency.limit == pytest.approx(2.125)
+    # A second throttle within the cooldown is the same burst
+    concurrency.decrease()
+    assert concurrency.limit == pytest.approx(2.125)
+    assert concurrency.in_flight == 2
+
+
+def test_adaptive_concurrency_bounds():
+    concurrency = AdaptiveConcurrency(initial=2, minimum=1, maximum=2, cooldown_seconds=0)
+    for _ in range(10):
+        concurrency.acquire()
+        concurrency.release()
+    assert concurrency.limit == 2
+    for _ in range(10):
+        concurrency.decrease()
+    assert concurrency.limit == 1
+
+
+def test_adaptive_concurrency_blocks_at_the_limit():
+    concurrency = AdaptiveConcurrency(initial=1, minimum=1, maximum=1)
+    concurrency.acquire()
+    acquired = threading.Event()
+    waiter = threading.Thread(target=lambda: (concurrency.acquire(), acquired.set()))
+    waiter.start()
+    assert not acquired.wait(0.1)
+    concurrency.release()
+    assert acquired.wait(1)
+    waiter.join()
+
+
+def test_rate_limiter():
+    rate_limiter = RateLimiter(50, burst=1)
+    start_time = time.monotonic()
+    for _ in range(11):
+        rate_limiter.acquire()
+    # The first token is the burst, 10 more at 50/s take 0.2s
+    assert time.monotonic() - start_time == pytest.approx(0.2, abs=0.08)
+
+
+def test_rate_limiter_disabled():
+    rate_limiter = RateLimiter(None)
+    start_time = time.monotonic()
+    for _ in range(1000):
+        rate_limiter.acquire()
+    assert time.monotonic() - start_time < 0.1
+
+
+def write_manifest(tmp_path, count):
+    manifest_path = tmp_path / "payloads.jsonl"
+    manifest_path.write_text("".join(json.dumps({"image_path": f"s3://bucket/{index}.jpg"}) + "\n" for index in range(count)))
+    return str(manifest_path)
+
+
+def make_invoker(runtime, **bulk_config):
+    inference_config = {
+        "region": "ap-southeast-1",
+        "endpoint_name": "ep",
+        "bulk_config": dict({"backoff_base_seconds": 0.001, "backoff_max_seconds": 0.002}, **bulk_config),
+    }
+    invoker = BulkInvoker(inference_config)
+    invoker.client = runtime
+    return invoker
+
+
+def run_with_timeout(invoker, manifest_path, output_path, timeout=20):
+    stats = {}
+    runner = threading.Thread(target=lambda: stats.update(invoker.run(manifest_path, output_path)), daemon=True)
+    runner.start()
+    runner.join(timeout)
+    assert not runner.is_alive(), f"run did not finish, stats : {invoker.stats}"
+    return stats
+
+
+def test_bulk_invoker(tmp_path):
+    runtime = FakeRuntime(latency=0.001)
+    invoker = make_invoker(runtime, initial_concurrency=2, max_concurrency=4)
+    output_path = str(tmp_path / "results.jsonl")
+    stats = run_with_timeout(invoker, write_manifest(tmp_path, 50), output_path)
+    assert stats == {"succeeded": 50, "failed": 0, "retries": 0}
+    results = [json.loads(line) for line in open(output_path)]
+    assert sorted(result["id"] for result in results) == list(range(50))
+    assert results[0]["result"]["image_path"].startswith("s3://bucket/")
+    assert runtime.max_in_flight <= 4
+
+
+def test_bulk_invoker_retries_throttles(tmp_path):
+    # Every tenth record is throttled twice before it succeeds
+    runtime = FakeRuntime(throttle=lambda body, attempt: body.endswith('0.jpg"}') and attempt <= 2)
+    invoker = make_invoker(runtime, initial_concurrency=4, max_concurrency=4)
+    stats = run_with_timeout(invoker, write_manifest(tmp_path, 100), str(tmp_path / "results.jsonl"))
+    assert stats == {"succeeded": 100, "failed": 0, "retries": 20}
+
+
+def test_bulk_invoker_always_throttled_completes(tmp_path):
+    runtime = FakeRuntime(throttle=lambda body, attempt: True)
+    invoker = make_invoker(runtime, initial_concurrency=4, max_concurrency=4, max_attempts=3)
+    stats = run_with_timeout(invoker, write_manifest(tmp_path, 200), str(tmp_path / "results.jsonl"))
+    assert stats == {"succeeded": 0, "failed": 200, "retries": 400}
+    assert runtime.calls == 600
+    assert invoker.concurrency.in_flight == 0
+
+
+class FakeAsyncS3(object):
+    """put/get/head/list of the objects of an s3 client, keyed by (bucket, key)"""
+
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+
+    def not_found(self, operation_name):
+        return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation_name)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.encode("utf-8")
+
+    def get_object(self, Bucket, Key):
+        self.requests.append("get_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "missing"}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)]), "ContentType": "application/json"}
+
+    def head_object(self, Bucket, Key):
+        self.requests.append("head_object")
+        if (Bucket, Key) not in self.objects:
+            raise self.not_found("HeadObject")
+        return {}
+
+    def get_paginator(self, operation_name):
+        fake = self
+
+        class Paginator(object):
+            def paginate(self, Bucket, Prefix):
+                fake.requests.append("list_objects_v2")
+                keys = sorted(key for bucket, key in fake.objects if bucket == Bucket and key.startswith(Prefix))
+                for start in range(0, len(keys), 1000):
+                    yield {"Contents": [{"Key": key} for key in keys[start:start + 1000]]}
+
+        return Paginator()
+
+
+class FakeAsyncRuntime(object):
+    def __init__(self):
+        self.count = 0
+
+    def invoke_endpoint_async(self, **kwargs):
+        self.count += 1
+        return {
+            "OutputLocation": f"s3://bucket/output/{self.count}.out",
+            "FailureLocation": f"s3://bucket/failure/{self.count}-error.out",
+            "InferenceId": kwargs["InferenceId"],
+        }
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.messages = []
+        self.deleted = []
+
+    def receive_message(self, **kwargs):
+        messages, self.messages = self.messages[:10], self.messages[10:]
+        return {"Messages": messages}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.deleted.extend(entry["ReceiptHandle"] for entry in Entries)
+
+
+def make_submitter(**submit_config):
+    inference_config = {
+        "region": "ap-southeast-1",
+        "endpoint_name": "ep",
+        "bucket_name": "bucket",
+        "upload_dir": "inputs",
+        "submit_config": dict({"poll_interval_seconds": 0}, **submit_config),
+    }
+    submitter = invoke_endpoint.AsyncSubmitter(inference_config)
+    submitter.s3_client = FakeAsyncS3()
+    submitter.runtime_client = FakeAsyncRuntime()
+    return submitter
+
+
+def notification(inference_id, output_location, status="Completed"):
+    return {"Body": json.dumps({
+        "invocationStatus": status,
+        "inferenceId": inference_id,
+        "failureReason": "ModelError",
+        "responseParameters": {"outputLocation": output_location},
+    }), "ReceiptHandle": f"{inference_id}:{output_location}"}
+
+
+def test_notifications_of_other_runs_are_ignored():
+    from concurrent.futures import ThreadPoolExecutor
+
+    submitter = make_submitter(notification_queue_url="queue")
+    submitter.sqs_client = queue = FakeQueue()
+    for record_id in range(3):
+        submitter.submit(record_id, {"image_path": f"s3://bucket/{record_id}.jpg"})
+    submitter.s3_client.put_object(Bucket="bucket", Key="output/2.out", Body=b'{"count": 1}')
+    stale = notification("5", "s3://bucket/output/old.out")
+    other_run = notification("20200101-000000-deadbeef-1", "s3://bucket/output/2.out")
+    wrong_location = notification(submitter.get_inference_id(0), "s3://bucket/output/old.out")
+    own = notification(submitter.get_inference_id(1), "s3://bucket/output/2.out")
+    early = notification(submitter.get_inference_id(7), "s3://bucket/output/7.out")
+    queue.messages = [stale, other_run, wrong_location, own, early]
+
+    output_file = io.StringIO()
+    assert submitter.poll_notifications(output_file, ThreadPoolExecutor(2)) == 1
+    assert [json.loads(line)["id"] for line in output_file.getvalue().splitlines()] == [1]
+    assert sorted(submitter.outstanding) == ["s3://bucket/output/1.out", "s3://bucket/output/3.out"]
+    # Messages of other runs stay on the queue for them
+    assert queue.deleted == [wrong_location["ReceiptHandle"], own["ReceiptHandle"], early["ReceiptHandle"]]
+    assert list(submitter.early_notifications) == [submitter.get_inference_id(7)]
+
+
+def test_poll_outputs_lists_then_heads_the_tail():
+    from concurrent.futures import ThreadPoolExecutor
+
+    submitter = make_submitter(max_head_polls=3)
+    s3_client = submitter.s3_client
+    for record_id in range(10):
+        submitter.submit(record_id, {"image_path": f"s3://bucket/{record_id}.jpg"})
+    for index in range(1, 7):
+        s3_client.put_object(Bucket="bucket", Key=f"output/{index}.out", Body=b'{"count": 0}')
+    s3_client.put_object(Bucket="bucket", Key="failure/7-error.out", Body=b"ModelError")
+    s3_client.put_object(Bucket="bucket", Key="output/from-another-run.out", Body=b"{}")
+
+    output_file = io.StringIO()
+    s3_client.requests = []
+    assert submitter.poll_outputs(output_file, ThreadPoolExecutor(4)) == 7
+    # One listing of the output prefix and one of the failure prefix, no HEAD request
+    assert sorted(set(s3_client.requests)) == ["get_object", "list_objects_v2"]
+    assert s3_client.requests.count("list_objects_v2") == 2
+
+    s3_client.put_object(Bucket="bucket", Key="output/8.out", Body=b'{"count": 0}')
+    s3_client.requests = []
+    assert submitter.poll_outputs(output_file, ThreadPoolExecutor(4)) == 1
+    assert "list_objects_v2" not in s3_client.requests
+    results = {json.loads(line)["id"]: json.loads(line) for line in output_file.getvalue().splitlines()}
+    assert sorted(results) == list(range(8))
+    assert results[6]["status"] == "error" and results[6]["error"] == "ModelError"
+    assert results[0]["result"] == {"count": 0}
@@ -0,0 +1,49 @@
+import io
+import json
+
+from labelled_index import OUTPUT_MANIFEST_SUFFIX, LabelledIndex
+from test_s3_utils import FakeS3
+
+
+class Body(io.BytesIO):
+    def iter_lines(self):
+        return iter(self.read().splitlines())
+
+
+class FakeManifestS3(FakeS3):
+    """FakeS3 serving the output manifests, HeadObject is not expected"""
+
+    def __init__(self, manifests):
+        super().__init__(manifests.keys())
+        self.manifests = manifests
+        self.read_keys = []
+
+    def get_object(self, Bucket, Key):
+        self.read_keys.append(Key)
+        return {"Body": Body("\n".join(json.dumps(line) for line in self.manifests[Key]).encode("utf-8"))}
+
+    def head_object(self, Bucket, Key):
+        raise AssertionError("the ETag of the listing is used")
+
+
+def test_update_reads_new_manifests_only():
+    first_key = f"output/job-1/{OUTPUT_MANIFEST_SUFFIX}"
+    second_key = f"output/job-2/{OUTPUT_MANIFEST_SUFFIX}"
+    s3_client = FakeManifestS3({
+        first_key: [
+            {"source-ref": "s3://bucket/a.jpg", "category": {}, "category-metadata": {}},
+            {"source-ref": "s3://bucket/b.jpg", "category-metadata": {"failure-reason": "timeout"}},
+        ],
+        "output/job-1/manifests/intermediate/1/output.manifest": [],
+    })
+    index = LabelledIndex(s3_client, "bucket", "index.gz")
+    assert index.update("output/") == 1
+    assert "s3://bucket/a.jpg" in index and "s3://bucket/b.jpg" not in index
+    assert index.sources == {first_key: f'"{first_key}"'}
+
+    s3_client.manifests[second_key] = [{"source-ref": "s3://bucket/c.jpg", "category": {}}]
+    s3_client.keys = sorted(s3_client.manifests)
+    s3_client.read_keys = []
+    assert index.update("output/") == 1
+    assert s3_client.read_keys == [second_key]
+    assert len(index) == 2
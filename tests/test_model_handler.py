@@ -0,0 +1,276 @@
+import types
+
+import pytest
+
+import invoke_endpoint
+import model_handler
+
+
+@pytest.fixture
+def eight_cores(monkeypatch):
+    monkeypatch.setattr(model_handler.os, "cpu_count", lambda: 8)
+    for name in ["SAGEMAKER_SERVER_MODE", "SAGEMAKER_MODEL_SERVER_WORKERS"]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.delitem(model_handler.sys.modules, "mms", raising=False)
+    return monkeypatch
+
+
+def test_torch_num_threads_explicit(eight_cores):
+    assert model_handler.get_torch_num_threads({"torch_num_threads": 3}) == 3
+
+
+def test_torch_num_threads_split_between_mms_workers(eight_cores):
+    eight_cores.setitem(model_handler.sys.modules, "mms", types.ModuleType("mms"))
+    # One MMS worker per core by default
+    assert model_handler.get_torch_num_threads({}) == 1
+    eight_cores.setenv("SAGEMAKER_MODEL_SERVER_WORKERS", "2")
+    assert model_handler.get_torch_num_threads({}) == 4
+
+
+def test_torch_num_threads_single_process(eight_cores):
+    assert model_handler.get_torch_num_threads({}) == 8
+    eight_cores.setitem(model_handler.sys.modules, "mms", types.ModuleType("mms"))
+    eight_cores.setenv("SAGEMAKER_SERVER_MODE", "asyncio")
+    assert model_handler.get_torch_num_threads({}) == 8
+
+
+def test_custom_attributes_round_trip(tmp_path):
+    image_file = tmp_path / "image.jpg"
+    image_file.write_bytes(b"image")
+    params = {"conf": 0.25, "iou": 0.7, "classes": [0, 1], "output_format": "coco,xywh", "skip": None}
+    body, content_type, custom_attributes = invoke_endpoint.build_image_payload("raw", str(image_file), params)
+    assert body == b"image"
+    assert content_type == "application/x-image"
+    assert model_handler.parse_custom_attributes(custom_attributes) == {
+        "conf": 0.25, "iou": 0.7, "classes": [0, 1], "output_format": "coco,xywh"
+    }
+
+
+def test_custom_attributes_unencoded():
+    assert model_handler.parse_custom_attributes('conf=0.25,iou=0.7,classes=[0,1]') == {
+        "conf": 0.25, "iou": 0.7, "classes": [0, 1]
+    }
+    assert model_handler.parse_custom_attributes('label="a,b", flag , mode=fast') == {
+        "label": "a,b", "mode": "fast"
+    }
+    assert model_handler.parse_custom_attributes(None) == {}
+
+
+class FakeModelHandler(object):
+    sizes = {}
+
+    def __init__(self):
+        self.model_bytes = 0
+        self.unloaded = False
+
+    def load(self, model_dir, gpu_id=None):
+        self.model_bytes = self.sizes[model_dir]
+
+    def unload(self):
+        self.unloaded = True
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(model_handler, "ModelHandler", FakeModelHandler)
+    FakeModelHandler.sizes = {"a": 40, "b": 40, "c": 40}
+    return model_handler.ModelRegistry(memory_budget_bytes=100)
+
+
+def test_registry_evicts_least_recently_used(registry):
+    handler_a, loaded = registry.get("a")
+    assert loaded
+    registry.get("b")
+    # a was used last, so b is evicted to make room for c
+    assert registry.get("a") == (handler_a, False)
+    registry.get("c")
+    assert registry.stats()["models"] == ["a", "c"]
+    assert registry.stats()["evictions"] == 1
+    _, loaded = registry.get("b")
+    assert loaded
+    assert handler_a.unloaded
+
+
+def test_registry_keeps_leased_models(registry):
+    with registry.lease("a") as (handler_a, _):
+        with registry.lease("b") as (handler_b, _):
+            with registry.lease("c") as (handler_c, _):
+                # Every model has a request in flight, so the budget is exceeded
+                assert registry.stats()["model_bytes"] == 120
+            # Releasing the lease of c brings the models back under the budget
+            assert handler_c.unloaded
+            assert registry.stats()["models"] == ["a", "b"]
+        # b is the only model without a request in flight
+        registry.get("c")
+        assert handler_b.unloaded
+        assert registry.stats()["models"] == ["a", "c"]
+    assert not handler_a.unloaded
+
+
+def test_registry_unload_waits_for_leases(registry):
+    assert not registry.unload("a")
+    with registry.lease("a") as (handler_a, _):
+        assert registry.unload("a")
+        assert not handler_a.unloaded
+    assert handler_a.unloaded
+    assert registry.stats()["models"] == []
+    registry.get("b")
+    assert registry.unload("b")
+    assert registry.stats()["models"] == []
+    assert registry.stats()["evictions"] == 0
+
+
+@pytest.fixture
+def handler():
+    handler = model_handler.ModelHandler()
+    handler.handler_config = dict(model_handler.DEFAULT_HANDLER_CONFIG)
+    return handler
+
+
+def test_tile_offsets():
+    assert model_handler.get_tile_offsets(500, 640, 0.2) == [0]
+    assert model_handler.get_tile_offsets(1000, 640, 0.2) == [0, 360]
+    assert model_handler.get_tile_offsets(1500, 500, 0) == [0, 500, 1000]
+    # Tiles cover the whole length and keep the full tile size
+    offsets = model_handler.get_tile_offsets(2000, 640, 0.5)
+    assert offsets == [0, 320, 640, 960, 1280, 1360]
+    assert all(offset + 640 <= 2000 for offset in offsets)
+
+
+@pytest.mark.parametrize("tile_size, tile_overlap", [(0, 0.2), (-640, 0.2), (640.5, 0.2), (640, 1), (640, -0.1), (640, 1.5)])
+def test_tile_options_rejected(handler, tile_size, tile_overlap):
+    with pytest.raises(AssertionError):
+        handler.get_request_options({"tile_size": tile_size, "tile_overlap": tile_overlap})
+
+
+def test_tile_options_defaults(handler):
+    options = handler.get_request_options({"tiled": True, "tile_overlap": 0})
+    assert (options["tiled"], options["tile_size"], options["tile_overlap"]) == (True, 640, 0)
+
+
+def test_max_tiles(handler, monkeypatch):
+    np = pytest.importorskip("numpy")
+    handler.handler_config["max_tiles"] = 4
+    monkeypatch.setattr(handler, "predict", lambda image, params: pytest.fail("predict called"))
+    image = np.zeros((1000, 1500, 3), dtype=np.uint8)
+    with pytest.raises(Exception, match="6 tiles of 640 for a 1500x1000 image"):
+        handler.predict_tiled(image, {}, tile_size=640, tile_overlap=0.2)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(model_handler.time, "time", lambda: clock.now)
+    return clock
+
+
+def test_result_cache_lru_and_ttl(clock):
+    cache = model_handler.ResultCache(max_entries=2, ttl_seconds=10)
+    cache.put("a", [1])
+    cache.put("b", [2])
+    assert cache.get("a") == [1]
+    cache.put("c", [3])
+    # b was the least recently used entry
+    assert cache.get("b") is None
+    assert cache.get("c") == [3]
+    clock.now += 11
+    assert cache.get("a") is None
+    assert cache.stats() == {"hits": 2, "misses": 2, "entries": 1, "spilled_entries": 0}
+
+
+def test_result_cache_spill(clock, tmp_path):
+    spill_dir = tmp_path / "spill"
+    cache = model_handler.ResultCache(max_entries=1, ttl_seconds=10, spill_dir=str(spill_dir), spill_max_entries=2)
+    for key in ["a", "b", "c", "d"]:
+        cache.put(key, [key])
+    # a was spilled first and removed once more than spill_max_entries files were kept
+    assert len(list(spill_dir.iterdir())) == 2
+    assert cache.get("a") is None
+    # Spilled entries are promoted back into memory, which spills the in memory entry
+    assert cache.get("b") == ["b"]
+    assert cache.stats()["spilled_entries"] == 2
+    assert cache.get("d") == ["d"]
+    clock.now += 11
+    assert cache.get("c") is None
+
+
+def test_image_cache_eviction():
+    cache = model_handler.ImageCache(max_bytes=10)
+    cache.put("bucket", "a", "etag-a", b"aaaa")
+    cache.put("bucket", "b", "etag-b", b"bbbb")
+    assert cache.get("bucket", "a") == ("etag-a", b"aaaa")
+    cache.put("bucket", "c", "etag-c", b"cccc")
+    # b was the least recently used entry
+    assert cache.get("bucket", "b") is None
+    cache.put("bucket", "a", "etag-a2", b"aa")
+    cache.put("bucket", "big", "etag-big", b"x" * 11)
+    assert cache.get("bucket", "big") is None
+    assert cache.stats() == {"hits": 0, "misses": 0, "evictions": 1, "entries": 2, "bytes": 6}
+
+
+class FakeBody(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeImageS3(object):
+    def __init__(self):
+        self.objects = {}
+        self.requests = []
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        from botocore.exceptions import ClientError
+
+        self.requests.append((Key, IfNoneMatch))
+        etag, data = self.objects[Key]
+        if IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject")
+        return {"ETag": etag, "Body": FakeBody(data)}
+
+
+def test_download_image_revalidates_etag(handler, monkeypatch):
+    s3_client = FakeImageS3()
+    monkeypatch.setattr(model_handler, "get_s3_client", lambda handler_config: s3_client)
+    handler.image_cache = model_handler.ImageCache(max_bytes=1024)
+    s3_client.objects["image.jpg"] = ('"v1"', b"first")
+    assert handler.download_image("image.jpg", "bucket") == (b"first", '"v1"')
+    assert handler.download_image("image.jpg", "bucket") == (b"first", '"v1"')
+    s3_client.objects["image.jpg"] = ('"v2"', b"second")
+    assert handler.download_image("image.jpg", "bucket") == (b"second", '"v2"')
+    assert s3_client.requests == [("image.jpg", None), ("image.jpg", '"v1"'), ("image.jpg", '"v1"')]
+    assert handler.image_cache.stats()["hits"] == 1
+    assert handler.image_cache.stats()["misses"] == 2
+
+
+def test_format_detections(handler):
+    np = pytest.importorskip("numpy")
+    detections = np.array([
+        [0.1, 0.2, 0.3, 0.4, 0.5, 1],
+        [0.5, 0.5, 0.1, 0.1, 0.9, 0],
+    ])
+    assert handler.format_detections(detections, top_k=1) == [
+        {"coordinates": {"x": 0.5, "y": 0.5, "w": 0.1, "h": 0.1}, "class_id": 0, "confidence": 0.9}
+    ]
+    compact = handler.format_detections(detections, output_format="compact")
+    assert compact == {
+        "count": 2,
+        "boxes": [0.1, 0.2, 0.3, 0.4, 0.5, 0.5, 0.1, 0.1],
+        "class_ids": [1, 0],
+        "confidences": [0.5, 0.9],
+    }
+    assert handler.format_detections(np.zeros((0, 6)), output_format="compact")["count"] == 0
+
+
+def test_serialize_output_msgpack(handler):
+    msgpack = pytest.importorskip("msgpack")
+    np = pytest.importorskip("numpy")
+    context = types.SimpleNamespace(content_type=None)
+    context.get_request_header = lambda request_index, name: model_handler.MSGPACK_CONTENT_TYPE if name == "Accept" else None
+    context.set_response_content_type = lambda request_index, content_type: setattr(context, "content_type", content_type)
+    image_dict = {"results": {"count": 1, "boxes": [0.1, 0.2, 0.3, 0.4], "class_ids": [0], "confidences": [0.9]}}
+    output = msgpack.unpackb(handler.serialize_output(image_dict, context))
+    assert context.content_type == model_handler.MSGPACK_CONTENT_TYPE
+    assert np.frombuffer(output["results"]["boxes"], dtype="<f4").tolist() == pytest.approx([0.1, 0.2, 0.3, 0.4])
@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+import pre_annotate
+
+
+class FakeSageMaker(object):
+    def __init__(self, container):
+        self.container = container
+
+    def describe_endpoint(self, EndpointName):
+        return {"EndpointConfigName": "config"}
+
+    def describe_endpoint_config(self, EndpointConfigName):
+        return {"ProductionVariants": [{"ModelName": "model"}]}
+
+    def describe_model(self, ModelName):
+        return {"PrimaryContainer": self.container}
+
+
+def test_endpoint_model_data_url():
+    sagemaker_client = FakeSageMaker({"Mode": "SingleModel", "ModelDataUrl": "s3://bucket/model.tar.gz"})
+    assert pre_annotate.get_endpoint_model_data_url(sagemaker_client, "ep") == "s3://bucket/model.tar.gz"
+
+
+@pytest.mark.parametrize("container", [
+    {"Mode": "MultiModel", "ModelDataUrl": "s3://bucket/models/"},
+    {"ModelDataUrl": "s3://bucket/models/"},
+])
+def test_endpoint_model_data_url_rejects_multi_model(container):
+    with pytest.raises(Exception, match="multi-model endpoint"):
+        pre_annotate.get_endpoint_model_data_url(FakeSageMaker(container), "ep")
+
+
+def test_adjustment_lambda_arns():
+    aws_config = {
+        "pre_human_arn": "arn:aws:lambda:ap-southeast-1:377565633583:function:PRE-BoundingBox",
+        "acs_arn": "arn:aws:lambda:ap-southeast-1:377565633583:function:ACS-BoundingBox",
+    }
+    assert pre_annotate.get_adjustment_lambda_arns(aws_config) == (
+        "arn:aws:lambda:ap-southeast-1:377565633583:function:PRE-AdjustmentBoundingBox",
+        "arn:aws:lambda:ap-southeast-1:377565633583:function:ACS-AdjustmentBoundingBox",
+    )
+    aws_config["acs_adjustment_arn"] = "arn:aws:lambda:us-east-1:432418664414:function:ACS-AdjustmentBoundingBox"
+    assert pre_annotate.get_adjustment_lambda_arns(aws_config)[1] == aws_config["acs_adjustment_arn"]
+
+
+class FakeS3(object):
+    def __init__(self, objects):
+        self.objects = objects
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_render_template(monkeypatch):
+    template = "{% for box in task.input.manifestLine.preannotation.annotations %}"
+    template += "{{ task.input.manifestLine.preannotation-metadata.class-map }}"
+    s3_client = FakeS3({("bucket", "templates/instructions.template"): template.encode("utf-8")})
+    monkeypatch.setattr(pre_annotate.boto3, "client", lambda service_name: s3_client)
+    template_uri = "s3://bucket/templates/instructions.template"
+    assert pre_annotate.render_template(template_uri, "preannotation") == template_uri
+    assert pre_annotate.render_template(template_uri, "model-boxes") == (
+        "s3://bucket/templates/instructions-model-boxes.template"
+    )
+    assert s3_client.objects[("bucket", "templates/instructions-model-boxes.template")].decode("utf-8") == (
+        "{% for box in task.input.manifestLine.model-boxes.annotations %}"
+        "{{ task.input.manifestLine.model-boxes-metadata.class-map }}"
+    )
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from s3_utils import iter_prefix_keys
+
+
+class FakeS3(object):
+    """
+    list_objects_v2 over a set of keys with the paging of S3 : keys and rolled up common prefixes
+    in key order, MaxKeys entries per page, ContinuationToken and StartAfter
+    """
+
+    def __init__(self, keys, delay=0):
+        self.keys = sorted(keys)
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, MaxKeys, ContinuationToken=None, StartAfter=None):
+        with self.lock:
+            self.requests.append((Prefix, ContinuationToken, StartAfter))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        marker = ContinuationToken or StartAfter or ""
+        contents, common_prefixes, last_entry, truncated = [], [], None, False
+        for key in self.keys:
+            if not key.startswith(Prefix) or key <= marker:
+                continue
+            rest = key[len(Prefix):]
+            if Delimiter in rest:
+                entry = Prefix + rest.split(Delimiter, 1)[0] + Delimiter
+                if entry == last_entry or entry <= marker:
+                    continue
+            else:
+                entry = key
+            if len(contents) + len(common_prefixes) == MaxKeys:
+                truncated = True
+                break
+            if entry == key:
+                contents.append({"Key": key, "ETag": f'"{key}"'})
+            else:
+                common_prefixes.append({"Prefix": entry})
+            last_entry = entry
+        with self.lock:
+            self.in_flight -= 1
+        response = {"Contents": contents, "CommonPrefixes": common_prefixes}
+        if truncated:
+            response["NextContinuationToken"] = last_entry
+        return response
+
+
+def make_keys():
+    flat = [f"images/{index:05d}.jpg" for index in range(2500)]
+    named = [f"images/{name}-{index}.png" for name in ["Ab", "cat", "dog", "zz"] for index in range(300)]
+    nested = [f"images/sub{folder}/{index}.JPG" for folder in range(3) for index in range(1200)]
+    other = [f"images/{index}.txt" for index in range(10)]
+    return flat + named + nested + other
+
+
+def test_lists_every_key_once():
+    keys = make_keys()
+    s3_client = FakeS3(keys)
+    stats = {}
+    listed = list(iter_prefix_keys(s3_client, "bucket", "images/", max_workers=4, stats=stats))
+    expected = [key for key in keys if not key.endswith(".txt")]
+    assert len(listed) == len(expected)
+    assert set(listed) == set(expected)
+    assert stats["objects"] == len(keys)
+    assert stats["prefixes"] == 4
+    # The flat level is split into key ranges listed with StartAfter
+    assert any(start_after for prefix, _, start_after in s3_client.requests if prefix == "images/")
+
+
+def test_bounds_requests_in_flight():
+    s3_client = FakeS3(make_keys(), delay=0.01)
+    listed = list(iter_prefix_keys(s3_client, "bucket", "images/", max_workers=3))
+    assert len(listed) > 0
+    assert s3_client.max_in_flight <= 3
+
+
+def test_close_cancels_queued_requests():
+    s3_client = FakeS3(make_keys(), delay=0.05)
+    keys = iter_prefix_keys(s3_client, "bucket", "images/", max_workers=2)
+    next(keys)
+    keys.close()
+    requests = len(s3_client.requests)
+    time.sleep(0.2)
+    assert len(s3_client.requests) == requests
+
+
+def test_with_etags():
+    s3_client = FakeS3(["manifests/a.manifest", "manifests/b/c.manifest", "manifests/d.json"])
+    listed = sorted(iter_prefix_keys(s3_client, "bucket", "manifests/", extensions=["manifest"], with_etags=True))
+    assert listed == [
+        ("manifests/a.manifest", '"manifests/a.manifest"'),
+        ("manifests/b/c.manifest", '"manifests/b/c.manifest"'),
+    ]
@@ -3,8 +3,11 @@ warnings.filterwarnings('ignore')
 
 
 import os 
+import time
 import argparse
 import json 
+import yaml
+import torch
 from loguru import logger 
 from ultralytics import YOLO
 import shutil 
@@ -43,6 +46,62 @@ def train(data_config, model_config):
     model = YOLO(model_config.get('model','yolov8n.pt'))
     model.train(**model_config)
 
+def export_inference_artifact(model_path, model_dir, half=False):
+    """
+    Writes a slimmed inference artifact of a training checkpoint into model_dir
+     - inference_weights.pt : state_dict of the fused model only (no optimizer, EMA or train args),
+                              saved in half precision when half is True. Being a plain state_dict it
+                              is loaded with torch.load(weights_only=True, mmap=True) by the handler,
+                              which needs torch >= 2.1 in the serving image
+     - inference_model.yaml : model architecture used to rebuild the network without the checkpoint.
+                              Scales are resolved into depth/width multiples so the file name does
+                              not need to encode the model scale
+    returns:
+        artifact : metadata stored in model.json under "artifact" (file names, class names, imgsz, ...)
+    """
+    start = time.perf_counter()
+    model = YOLO(model_path)
+    model.fuse()
+    checkpoint_load_time = time.perf_counter() - start
+    network = model.model.half() if half else model.model.float()
+
+    model_yaml = dict(network.yaml)
+    scales = model_yaml.pop('scales', None)
+    if scales:
+        scale = model_yaml.get('scale') or list(scales.keys())[0]
+        depth, width, max_channels = scales[scale]
+        model_yaml.update(depth_multiple=depth, width_multiple=width, max_channels=max_channels)
+    model_yaml.pop('yaml_file', None)
+    with open(os.path.join(model_dir, 'inference_model.yaml'), 'w') as f:
+        yaml.safe_dump(model_yaml, f, sort_keys=False)
+
+    weights_path = os.path.join(model_dir, 'inference_weights.pt')
+    torch.save(network.state_dict(), weights_path)
+
+    start = time.perf_counter()
+    if tuple(int(part) for part in torch.__version__.split('+')[0].split('.')[:2]) >= (2, 1):
+        torch.load(weights_path, map_location='cpu', mmap=True, weights_only=True)
+    else:
+        torch.load(weights_path, map_location='cpu')
+    artifact_load_time = time.perf_counter() - start
+    logger.info(
+        f"Checkpoint : {os.path.getsize(model_path) / 1e6:.2f} MB, load + fuse {checkpoint_load_time:.3f}s | "
+        f"Inference Artifact : {os.path.getsize(weights_path) / 1e6:.2f} MB, mmap load {artifact_load_time:.3f}s"
+    )
+
+    train_args = getattr(model, 'ckpt', None) or {}
+    artifact = {
+        "weights": "inference_weights.pt",
+        "config": "inference_model.yaml",
+        "task": model.task,
+        "names": {int(class_id): name for class_id, name in network.names.items()},
+        "imgsz": train_args.get('train_args', {}).get('imgsz', 640),
+        "half": half,
+        "fused": True,
+    }
+    return artifact
+
+
 def deploy_model(inference_config, deploy_config, model_dir, model_path, bucket_name):
     model_name = deploy_config.get('model_name')
     deploy_dir = deploy_config.get('deploy_dir')
@@ -61,6 +120,11 @@ def deploy_model(inference_config, deploy_config, model_dir, model_path, bucket_
     More parameters are available here: https://docs.ultralytics.com/cfg/
      """
     inference_config['weights'] = os.path.basename(model_path)
+    # Opt-in : the handler needs torch >= 2.1 to load the artifact and falls back to the checkpoint otherwise
+    if deploy_config.get('export_artifact', False):
+        inference_config['artifact'] = export_inference_artifact(
+            model_path=model_path, model_dir=model_dir, half=deploy_config.get('half', False)
+        )
     with open(os.path.join(model_dir,'model.json'),'w') as f:
         json.dump(inference_config, f)
 